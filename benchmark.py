@@ -0,0 +1,436 @@
+'''benchmark.py
+Usage:
+    benchmark.py run [--SIZES=1000,10000,100000] [--PORTS=48] [--FREE=0.3]
+                     [--CRITICAL=0.4] [--FINAL=0.3] [--SEED=1]
+                     [--CONFILE=switchports.yaml] [--REPEAT=1]
+                     [--WORKDIR=benchmarks] [--RESULTS=benchmarks.jsonl]
+                     [--LABEL=LABEL] [--PHASES]
+    benchmark.py generate <size> <outdir> [--PORTS=48] [--FREE=0.3]
+                     [--CRITICAL=0.4] [--FINAL=0.3] [--SEED=1]
+    benchmark.py compare [<base> <head>] [--RESULTS=benchmarks.jsonl]
+    benchmark.py startup [--BUDGET=50] [--RUNS=21] [--WORKDIR=benchmarks]
+                     [--RESULTS=benchmarks.jsonl] [--LABEL=LABEL]
+
+Options:
+    --SIZES=SIZES      Comma separated estate sizes, in ports
+                       [default: 1000,10000,100000]
+    --PORTS=N          Ports per switch [default: 48]
+    --FREE=RATIO       Share of the ports of the source switches that are free
+                       [default: 0.3]
+    --CRITICAL=RATIO   Share of the hosts that are in a critical vlan
+                       [default: 0.4]
+    --FINAL=RATIO      Share of the hosts marked with a final switch
+                       [default: 0.3]
+    --SEED=N           Seed of the estate generator [default: 1]
+    --CONFILE=FILE     State file passed to migrate.py, its extension selects
+                       the state backend [default: switchports.yaml]
+    --REPEAT=N         Number of runs of every size [default: 1]
+    --RUNS=N           Number of runs of every startup command, the median
+                       is taken [default: 21]
+    --WORKDIR=DIR      Directory the estates are generated and run in
+                       [default: benchmarks]
+    --RESULTS=FILE     JSON lines file results are appended to, and compared
+                       from [default: benchmarks.jsonl]
+    --LABEL=LABEL      Name of the version benchmarked, the git revision of
+                       migrate.py by default
+    --BUDGET=MS        Startup budget, startup fails if the median time of a
+                       command, less that of the interpreter on its own, is
+                       over it [default: 50]
+    --PHASES           Also save the --PROFILE report of every command with
+                       its result. Memory tracing slows the commands down, so
+                       their times are not comparable to runs without it.
+
+'''
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from docopt import docopt
+import csv
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+from migrate import DEFAULT_CRITICAL_VLANS
+
+MIGRATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'migrate.py')
+
+OTHER_VLANS = ('10', '20', '30', '40')
+
+# Commands timed for every estate, in the order they are run. Each is the
+# migrate.py command line, without --CONFILE, that calls the entry point
+# named. update writes to a state file of the same backend.
+STEPS = (
+    ('get_switchports_d', ['init', 'init.csv']),
+    ('mark_switchports_final', ['mark', 'final.csv']),
+    ('move_interfaces', ['move', '{source}', '{destination}']),
+    ('update_switchports', ['update', 'rundir/runsheet.csv',
+                            '--UPDATEFILE=updated_{confile}']),
+    ('finalize', ['final', '{source}', '{destination}',
+                  '--RUNSHEET=final.csv']),
+    )
+
+
+def get_port_id(index, ports_per_member=48):
+
+    '''
+    Return the interface name of port index of a switch, numbering the
+    ports of a stack member by member, Gi1/0/1 to Gi1/0/48, Gi2/0/1 and on.
+    '''
+    member, port = divmod(index, ports_per_member)
+    return 'Gi%d/0/%d' % (member + 1, port + 1)
+
+
+def generate_estate(size, ports_per_switch=48, free_ratio=0.3,
+                    critical_share=0.4, final_share=0.3, seed=1):
+
+    '''
+    Generate a synthetic estate of size ports, for migrate.py init and mark.
+
+    Half of the switches are old source switches with hosts on them, the
+    other half new destination switches with every port free. A host is in
+    one of the DEFAULT_CRITICAL_VLANS of migrate.py, critical without a
+    rules file, with probability critical_share, and final_share
+    of the hosts are marked with a destination switch as their final
+    switch, spread evenly over the destination switches.
+
+    Parameters
+    ----------
+    size:               integer, number of ports of the estate
+    ports_per_switch:   integer
+    free_ratio:         float, share of free ports on the source switches
+    critical_share:     float, share of hosts in a critical vlan
+    final_share:        float, share of hosts with a final switch
+    seed:               integer, the same seed gives the same estate
+
+    Returns
+    -------
+    estate_d : dictionary with keys
+        init_rows:      rows of the init CSV, headers included
+        final_rows:     rows of the final CSV, headers included
+        source:         list of source switch ids
+        destination:    list of destination switch ids
+    '''
+    rng = random.Random(seed)
+    switches = max(2, -(-size // ports_per_switch))
+    source = ['old%04d' % number for number in range(switches // 2)]
+    destination = ['new%04d' % number
+                   for number in range(switches - switches // 2)]
+    init_rows = [['switch_id', 'port', 'status', 'vlan', 'description']]
+    final_rows = [['host', 'switch', 'final', 'port']]
+    finals = 0
+    for switch_id in source:
+        for index in range(ports_per_switch):
+            port_id = get_port_id(index)
+            if rng.random() < free_ratio:
+                init_rows.append([switch_id, port_id, 'disabled', '',
+                                  'disabled'])
+                continue
+            if rng.random() < critical_share:
+                vlan = rng.choice(DEFAULT_CRITICAL_VLANS)
+            else:
+                vlan = rng.choice(OTHER_VLANS)
+            host = 'host-%s-%d' % (switch_id, index + 1)
+            init_rows.append([switch_id, port_id, 'connected', vlan, host])
+            if rng.random() < final_share:
+                final_rows.append([host, switch_id,
+                                   destination[finals % len(destination)],
+                                   port_id])
+                finals += 1
+    for switch_id in destination:
+        for index in range(ports_per_switch):
+            init_rows.append([switch_id, get_port_id(index), 'disabled', '',
+                              'disabled'])
+    return {'init_rows': init_rows, 'final_rows': final_rows,
+            'source': source, 'destination': destination}
+
+
+def write_estate(estate_d, outdir):
+
+    '''
+    Write the init.csv and final.csv of estate_d, as made by generate_estate,
+    to outdir.
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    for name, rows in (('init.csv', estate_d['init_rows']),
+                       ('final.csv', estate_d['final_rows'])):
+        with open(os.path.join(outdir, name), 'w', newline='') as csv_file:
+            csv.writer(csv_file).writerows(rows)
+
+
+def get_revision():
+
+    '''
+    Return the git revision of migrate.py, with -dirty appended if it has
+    uncommitted changes, or 'unknown' outside of a git checkout.
+    '''
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(MIGRATE), capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_command(arguments, rundir, log_file, env=None):
+
+    '''
+    Run migrate.py with arguments in rundir, end to end in its own process,
+    with the environment env, that of benchmark.py by default.
+
+    Returns
+    -------
+    (seconds, max_rss_kb) : wall time, and the peak resident memory of the
+        process in KiB, None where os.wait4 is not available
+    '''
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MIGRATE] + arguments,
+                               cwd=rundir, env=env, stdout=log_file,
+                               stderr=log_file)
+    if hasattr(os, 'wait4'):
+        status, rusage = os.wait4(process.pid, 0)[1:]
+        process.returncode = os.waitstatus_to_exitcode(status)
+        max_rss_kb = rusage.ru_maxrss
+    else:
+        process.wait()
+        max_rss_kb = None
+    seconds = time.perf_counter() - started
+    if process.returncode:
+        raise RuntimeError('migrate.py ' + ' '.join(arguments) + ' failed, '
+                           'see ' + log_file.name)
+    return seconds, max_rss_kb
+
+
+def run_benchmark(size, confile='switchports.yaml', workdir='benchmarks',
+                  phases=False, **estate_options):
+
+    '''
+    Generate an estate of size ports in workdir and time every command of
+    STEPS against it.
+
+    Parameters
+    ----------
+    size:           integer, number of ports of the estate
+    confile:        string, state file, its extension selects the backend
+    workdir:        string, directory the estate is generated and run in
+    phases:         boolean, save the --PROFILE report of every command
+    estate_options: passed on to generate_estate
+
+    Returns
+    -------
+    results_l : list of dictionaries, one per step
+    '''
+    logger = logging.getLogger()
+    rundir = os.path.join(workdir, '%d-%s' % (size, confile))
+    estate_d = generate_estate(size, **estate_options)
+    write_estate(estate_d, rundir)
+    for name in ('switchports', 'rundir', 'updated_switchports', 'cache'):
+        path = os.path.join(rundir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    names_d = {'source': ','.join(estate_d['source']),
+               'destination': ','.join(estate_d['destination']),
+               'confile': confile}
+    # Every run starts with an empty render cache, of its own
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(rundir, 'cache'))
+    results_l = []
+    for step, command in STEPS:
+        arguments = [argument.format(**names_d) for argument in command]
+        arguments.append('--CONFILE=' + confile)
+        if phases:
+            arguments.append('--REPORT=' + step + '.json')
+        with open(os.path.join(rundir, step + '.log'), 'w') as log_file:
+            seconds, max_rss_kb = run_command(arguments, rundir, log_file,
+                                              env)
+        result_d = {'step': step, 'seconds': round(seconds, 4),
+                    'max_rss_kb': max_rss_kb}
+        if phases:
+            with open(os.path.join(rundir, step + '.json')) as infile:
+                result_d['phases'] = json.load(infile)
+        logger.info('%d ports, %s: %.3f s, %s KiB', size, step, seconds,
+                    max_rss_kb)
+        results_l.append(result_d)
+    return results_l
+
+
+# Commands startup times, the shortest paths through migrate.py. status runs
+# against a small estate with a SQLite state file, which loads no port.
+STARTUP_COMMANDS = (
+    ('startup_help', ['--help']),
+    ('startup_status', ['status', '--CONFILE=switchports.db']),
+    )
+
+
+def run_startup(budget=50.0, repeat=21, workdir='benchmarks'):
+
+    '''
+    Time the startup of migrate.py, run as python -m migrate with its
+    bytecode cached, as a script called in a loop would be, and check the
+    median time of every command of STARTUP_COMMANDS against budget.
+
+    The budget is what migrate.py adds to the start of the interpreter,
+    python -c pass, which depends on the machine and its site packages
+    rather than on migrate.py. The commands are run in turn, so that they
+    share the noise of a busy machine.
+
+    Parameters
+    ----------
+    budget:     float, milliseconds
+    repeat:     integer, number of runs of every command
+    workdir:    string, directory the estate is generated and run in
+
+    Returns
+    -------
+    results_l : list of dictionaries, one per command, with the interpreter
+        on its own first for reference
+    '''
+    import py_compile
+
+    logger = logging.getLogger()
+    rundir = os.path.join(workdir, 'startup')
+    write_estate(generate_estate(1000), rundir)
+    py_compile.compile(MIGRATE)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(MIGRATE))
+    with open(os.path.join(rundir, 'init.log'), 'w') as log_file:
+        run_command(['init', 'init.csv', '--CONFILE=switchports.db'], rundir,
+                    log_file)
+    steps = (('startup_python', ['-c', 'pass']),) + tuple(
+        (step, ['-m', 'migrate'] + command)
+        for step, command in STARTUP_COMMANDS)
+    times_d = {step: [] for step, command in steps}
+    for run in range(repeat):
+        for step, command in steps:
+            started = time.perf_counter()
+            subprocess.run([sys.executable] + command, cwd=rundir, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+            times_d[step].append(time.perf_counter() - started)
+    results_l = []
+    for step, command in steps:
+        times = sorted(times_d[step])
+        seconds = times[len(times) // 2]
+        if step == 'startup_python':
+            python_seconds = seconds
+            logger.info('%s: %.1f ms', step, seconds * 1000)
+        else:
+            added = (seconds - python_seconds) * 1000
+            over = added > budget
+            logger.info('%s: %.1f ms, %.1f ms over the interpreter%s', step,
+                        seconds * 1000, added,
+                        ', over the budget of %g ms' % budget if over else '')
+        results_l.append({'step': step, 'seconds': round(seconds, 4),
+                          'max_rss_kb': None,
+                          'over_budget': step != 'startup_python' and over})
+    return results_l
+
+
+def load_results(results_file):
+
+    '''
+    Return the results saved in the JSON lines file results_file.
+    '''
+    with open(results_file) as infile:
+        return [json.loads(line) for line in infile if line.strip()]
+
+
+def compare_results(results_l, base=None, head=None):
+
+    '''
+    Print the fastest time and the peak memory of every size and step for
+    the versions labelled base and head, and the change between them.
+    base and head default to the two last versions benchmarked.
+
+    Returns
+    -------
+    rows : list of (confile, size, step, base seconds, head seconds)
+    '''
+    labels = list(dict.fromkeys(result['label'] for result in results_l))
+    if base is None:
+        if len(labels) < 2:
+            raise ValueError('Results of two versions are needed to compare, '
+                             'found ' + ', '.join(labels))
+        base, head = labels[-2:]
+    best_d = dict()
+    for result in results_l:
+        key = (result['label'], result['confile'], result['size'],
+               result['step'])
+        best = best_d.get(key)
+        if best is None or result['seconds'] < best['seconds']:
+            best_d[key] = result
+    keys = sorted({key[1:] for key in best_d
+                   if key[0] == base and (head,) + key[1:] in best_d})
+    if not keys:
+        raise ValueError('No results common to ' + base + ' and ' + head)
+    print('%-20s %8s %-24s %10s %10s %8s %10s %10s' % (
+        'State file', 'Ports', 'Step', base[:10], head[:10], 'Change',
+        'Base KiB', 'Head KiB'))
+    rows = []
+    for confile, size, step in keys:
+        base_d = best_d[(base, confile, size, step)]
+        head_d = best_d[(head, confile, size, step)]
+        change = (head_d['seconds'] / base_d['seconds'] - 1) * 100 \
+            if base_d['seconds'] else 0.0
+        print('%-20s %8d %-24s %10.3f %10.3f %+7.1f%% %10s %10s' % (
+            confile, size, step, base_d['seconds'], head_d['seconds'], change,
+            base_d['max_rss_kb'], head_d['max_rss_kb']))
+        rows.append((confile, size, step, base_d['seconds'],
+                     head_d['seconds']))
+    return rows
+
+
+def main(docopt_args):
+    """ main-entry point for program, expects dict with arguments from docopt() """
+
+    estate_options = {'ports_per_switch': int(docopt_args['--PORTS']),
+                      'free_ratio': float(docopt_args['--FREE']),
+                      'critical_share': float(docopt_args['--CRITICAL']),
+                      'final_share': float(docopt_args['--FINAL']),
+                      'seed': int(docopt_args['--SEED'])}
+    if docopt_args['generate']:
+        write_estate(generate_estate(int(docopt_args['<size>']),
+                                     **estate_options),
+                     docopt_args['<outdir>'])
+    elif docopt_args['run']:
+        label = docopt_args['--LABEL'] or get_revision()
+        confile = docopt_args['--CONFILE']
+        for repeat in range(int(docopt_args['--REPEAT'])):
+            for size in docopt_args['--SIZES'].split(','):
+                results_l = run_benchmark(int(size), confile,
+                                          docopt_args['--WORKDIR'],
+                                          docopt_args['--PHASES'],
+                                          **estate_options)
+                with open(docopt_args['--RESULTS'], 'a') as outfile:
+                    for result_d in results_l:
+                        record = {'label': label, 'time': time.time(),
+                                  'python': sys.version.split()[0],
+                                  'confile': confile, 'size': int(size)}
+                        record.update(estate_options)
+                        record.update(result_d)
+                        outfile.write(json.dumps(record) + '\n')
+    elif docopt_args['startup']:
+        results_l = run_startup(float(docopt_args['--BUDGET']),
+                                int(docopt_args['--RUNS']),
+                                docopt_args['--WORKDIR'])
+        with open(docopt_args['--RESULTS'], 'a') as outfile:
+            for result_d in results_l:
+                record = {'label': docopt_args['--LABEL'] or get_revision(),
+                          'time': time.time(),
+                          'python': sys.version.split()[0],
+                          'confile': 'switchports.db', 'size': 1000}
+                record.update(result_d)
+                outfile.write(json.dumps(record) + '\n')
+        if any(result_d['over_budget'] for result_d in results_l):
+            sys.exit(1)
+    elif docopt_args['compare']:
+        compare_results(load_results(docopt_args['--RESULTS']),
+                        docopt_args['<base>'], docopt_args['<head>'])
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    main(docopt(__doc__))
@@ -0,0 +1,169 @@
+'''fakedevice.py
+Stand-in switches for testing migrate.py collect and apply without network
+equipment. Each device of the devices CSV listens on its host and port, over
+plain TCP, and answers commands with the canned output of its capture file.
+
+Usage:
+    fakedevice.py <devicecsv> <capturedir> [--RECORD=DIR] [--DELAY=0]
+                                           [--FAIL=0]
+
+Options:
+    --RECORD=DIR       Directory to record the commands received by every
+                       device in, one <switch_id>.log per device
+    --DELAY=SECONDS    Time to wait before answering every command, to stand
+                       in for network and CLI latency [default: 0]
+    --FAIL=N           Close the first N connections to every device at
+                       once, to test retries [default: 0]
+
+The capture file of a device is <capturedir>/<switch_id>.txt, in the format
+migrate.py ingest reads. Every line with a prompt, such as
+'sw1#show interface status', starts the canned output of that command.
+Other commands answer with no output. conf t, interface, exit and end move
+between the configuration modes, so the prompt changes as on a switch.
+
+'''
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from docopt import docopt
+import asyncio
+import csv
+import logging
+import os
+import re
+import time
+
+PROMPT_RE = re.compile(r'^([\w.:/-]+)[#>]\s*(\S.*)$')
+
+
+def load_responses(capture_file):
+
+    '''
+    Return the canned output of every command in capture_file, as a
+    dictionary of command, output.
+    '''
+    responses_d = dict()
+    command = None
+    with open(capture_file) as infile:
+        for line in infile:
+            match = PROMPT_RE.match(line.rstrip('\r\n'))
+            if match:
+                command = match.group(2).strip()
+                responses_d[command] = []
+            elif command is not None:
+                responses_d[command].append(line.rstrip('\r\n'))
+    return {command: '\n'.join(lines).strip('\n')
+            for command, lines in responses_d.items()}
+
+
+class FakeDevice():
+    '''
+    One stand-in switch.
+
+    switch_id:      Name shown in the prompt
+    responses_d:    Dictionary of command, canned output
+    record_file:    File the commands received are appended to, or None
+    delay:          Seconds to wait before every answer
+    fail:           Connections still to be closed at once
+    '''
+
+    def __init__(self, switch_id, responses_d, record_file=None, delay=0.0,
+                 fail=0):
+
+        self.switch_id = switch_id
+        self.responses_d = responses_d
+        self.record_file = record_file
+        self.delay = delay
+        self.fail = fail
+        self.sessions = 0
+
+    def record(self, session, command):
+        if self.record_file is None:
+            return
+        with open(self.record_file, 'a') as outfile:
+            outfile.write('%d %.6f %s\n' % (session, time.time(), command))
+
+    async def handle(self, reader, writer):
+
+        '''
+        Serve one CLI session.
+        '''
+        if self.fail:
+            self.fail -= 1
+            writer.close()
+            return
+        self.sessions += 1
+        session = self.sessions
+        mode = ''
+        writer.write((self.switch_id + '#').encode())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                self.record(session, command)
+                words = command.split()
+                if words[:2] in (['conf', 't'], ['configure', 'terminal']):
+                    mode = '(config)'
+                elif words[:1] in (['interface'], ['int']) and mode:
+                    mode = '(config-if)'
+                elif words == ['exit']:
+                    mode = '(config)' if mode == '(config-if)' else ''
+                elif words == ['end']:
+                    mode = ''
+                output = self.responses_d.get(command, '')
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write((command + '\n' + output
+                              + ('\n' if output else '') + self.switch_id
+                              + mode + '#').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve_devices(devicecsv, capturedir, recorddir=None, delay=0.0,
+                        fail=0):
+
+    '''
+    Start a FakeDevice for every device of devicecsv, and serve them until
+    cancelled.
+    '''
+    logger = logging.getLogger()
+    with open(devicecsv, newline='') as csv_file:
+        devices_l = list(csv.DictReader(csv_file))
+    if recorddir:
+        os.makedirs(recorddir, exist_ok=True)
+    servers = []
+    for device_d in devices_l:
+        switch_id = device_d['switch_id']
+        capture_file = os.path.join(capturedir, switch_id + '.txt')
+        responses_d = load_responses(capture_file) \
+            if os.path.exists(capture_file) else {}
+        device = FakeDevice(switch_id, responses_d,
+                            os.path.join(recorddir, switch_id + '.log')
+                            if recorddir else None, delay, fail)
+        servers.append(await asyncio.start_server(
+            device.handle, device_d['host'], int(device_d['port'])))
+    logger.info('Serving %s devices', len(servers))
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def main(docopt_args):
+    """ main-entry point for program, expects dict with arguments from docopt() """
+
+    try:
+        asyncio.run(serve_devices(docopt_args['<devicecsv>'],
+                                  docopt_args['<capturedir>'],
+                                  docopt_args['--RECORD'],
+                                  float(docopt_args['--DELAY']),
+                                  int(docopt_args['--FAIL'])))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    main(docopt(__doc__))
@@ -2,32 +2,123 @@
 Usage:
     migrate.py init <initcsv>  [--CONFDIR=switchports]
                                 [--CONFILE=switchports.yaml]
+                                [--PROFILE] [--REPORT=FILE]
+    migrate.py ingest <capture>... [--CONFDIR=switchports]
+                                   [--CONFILE=switchports.yaml]
+                                   [--WORKERS=N]
+                                   [--PROFILE] [--REPORT=FILE]
+    migrate.py collect <devicecsv> [--CONFDIR=switchports]
+                                   [--CONFILE=switchports.yaml]
+                                   [--CONCURRENCY=10] [--TIMEOUT=30]
+                                   [--RETRIES=2] [--CAPTUREDIR=DIR]
+                                   [--PROFILE] [--REPORT=FILE]
     migrate.py mark <finalcsv> [--CONFDIR=switchports]
                                 [--CONFILE=switchports.yaml]
+                                [--PROFILE] [--REPORT=FILE]
     migrate.py move <source> <destination> [--CONFDIR=switchports]
                                            [--CONFILE=switchports.yaml]
                                            [--RUNDIR=rundir]
                                            [--RUNSHEET=runsheet.csv]
+                                           [--POLICY=most-free]
+                                           [--TEMPLATES=DIR] [--RULES=FILE]
+                                           [--PROFILE] [--REPORT=FILE]
     migrate.py update <updatecsv> [--CONFDIR=switchports]
                                 [--CONFILE=switchports.yaml]
                                 [--UPDATEDIR=updated_switchports]
                                 [--UPDATEFILE=updated_switchport.yaml]
-    migrate.py status <switch> [<port>] <status>  [--CONFDIR=switchports]
-                                                  [--CONFILE=switchports.yaml]
+                                [--PROFILE] [--REPORT=FILE]
+    migrate.py apply <runsheetcsv> <devicecsv> [--CONFDIR=switchports]
+                                [--CONFILE=switchports.yaml]
+                                [--UPDATEDIR=updated_switchports]
+                                [--UPDATEFILE=updated_switchport.yaml]
+                                [--CONCURRENCY=10] [--TIMEOUT=30]
+                                [--RETRIES=2] [--DRYRUN]
+                                [--PROFILE] [--REPORT=FILE]
+    migrate.py status [<switch>...] [--CONFDIR=switchports]
+                                    [--CONFILE=switchports.yaml]
+                                    [--FORMAT=text] [--RULES=FILE]
+                                    [--PROFILE] [--REPORT=FILE]
+    migrate.py classify [<switch>...] [--CONFDIR=switchports]
+                                      [--CONFILE=switchports.yaml]
+                                      [--RULES=FILE] [--LIST]
+                                      [--FORMAT=text]
+                                      [--PROFILE] [--REPORT=FILE]
+    migrate.py diff [--CONFDIR=switchports] [--CONFILE=switchports.yaml]
+                    [--UPDATEDIR=updated_switchports]
+                    [--UPDATEFILE=updated_switchport.yaml]
+                    [--ASOF=N] [--FORMAT=text]
+                    [--PROFILE] [--REPORT=FILE]
+    migrate.py simulate <scenariocsv> [--CONFDIR=switchports]
+                                      [--CONFILE=switchports.yaml]
+                                      [--POLICY=most-free] [--WORKERS=N]
+                                      [--FORMAT=text] [--RULES=FILE]
+                                      [--PROFILE] [--REPORT=FILE]
     migrate.py final <source> <destination> [--CONFDIR=switchports]
                                            [--CONFILE=switchports.yaml]
                                            [--RUNDIR=rundir]
                                            [--RUNSHEET=runsheet.csv]
+                                           [--TEMPLATES=DIR]
+                                           [--PROFILE] [--REPORT=FILE]
+    migrate.py flatten [--CONFDIR=switchports] [--CONFILE=switchports.yaml]
+                       [--RUNDIR=rundir] [--RUNSHEET=runsheet.csv]
+                       [--TEMPLATES=DIR] [--PROFILE] [--REPORT=FILE]
+    migrate.py convert <newconfile> [--CONFDIR=switchports]
+                                    [--CONFILE=switchports.yaml]
+                                    [--ASOF=N]
+                                    [--PROFILE] [--REPORT=FILE]
+    migrate.py compact [--CONFDIR=switchports] [--CONFILE=switchports.yaml]
+                       [--PROFILE] [--REPORT=FILE]
+    migrate.py serve [--SOCKET=migrate.sock]
 
 Options:
     --CONFDIR=DIR      Directory where file storing state infromation of interfaces
                        is stored. [default: switchports]
     --CONFILE=FILE     Filename storing state information of interfaces,
-                       generated by migrate.py init [default: switchports.yaml]
+                       generated by migrate.py init. The extension selects the
+                       state backend: .yaml/.yml (YAML object dump), .db/.sqlite
+                       (SQLite), .json (columnar) or .shards (a directory with
+                       one file per switch) [default: switchports.yaml]
     --RUNSHEET=FILE    Filename of runsheet generated by move commmand
                        [default: runsheet.csv]
     --RUNDIR=DIR       Direcotryu where runsheet generated by move command is
                        stored [default: rundir]
+    --POLICY=POLICY    How move spreads hosts over the destination switches:
+                       most-free, round-robin, weighted (by switch size) or
+                       vlan (keep hosts of a vlan together) [default: most-free]
+    --TEMPLATES=DIR    Directory of port profile templates, <profile>.enable and
+                       <profile>.disable, with an optional profiles.yaml mapping
+                       switches to profiles. Without it the built in profile
+                       is used.
+    --FORMAT=FORMAT    Output of status, classify, diff and simulate, text or
+                       json [default: text]
+    --RULES=FILE       YAML file of the rules selecting the critical hosts
+                       move relocates, see CriticalRules. MIGRATE_RULES
+                       names it for every command, and critical_rules.yaml
+                       is read if it exists. Without one, the hosts in vlans
+                       1296 and 1297 are critical.
+    --LIST             Also list the critical hosts classify finds
+    --WORKERS=N        Number of processes ingest parses captures with, the
+                       number of CPUs by default, or simulate runs
+                       scenarios in, one by default
+    --CONCURRENCY=N    Switches of the same site collect and apply connect to
+                       at the same time [default: 10]
+    --TIMEOUT=SECONDS  Time to wait for a switch to connect or answer
+                       [default: 30]
+    --RETRIES=N        Times a switch is retried after an error, apply only
+                       retries connecting [default: 2]
+    --DRYRUN           Print the commands apply would push to each switch
+    --CAPTUREDIR=DIR   Also save what collect gets from each switch in DIR,
+                       as capture files ingest can read
+    --ASOF=N           Convert the state, or diff from the state, as it was
+                       after move journal entry N
+    --PROFILE          Print the wall time, rows and peak memory of each phase
+                       of the command when it ends
+    --REPORT=FILE      Also save the profile, as JSON if FILE ends in .json,
+                       or as a cProfile dump for pstats if it ends in .prof.
+                       Implies --PROFILE.
+    --SOCKET=FILE      Unix socket serve listens on. Other commands are sent
+                       to the serve listening on MIGRATE_SOCKET, if it is set
+                       [default: migrate.sock]
     --UPDATEDIR=DIR    Direcotry where updated state information of interfaces
                        [default: updated_switchports]
     --UPDATEFILE=FILE  Filename of updated state information of interfaces
@@ -37,19 +128,22 @@ Options:
 
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import abc
 from collections import defaultdict
-from collections import OrderedDict
-from docopt import docopt
-from pathlib import Path
-import copy
 import csv
 import errno
-import logging.config
-import operator
-import pprint as pp
+import functools
+import heapq
+import itertools
+import logging
 import os
-import yaml
+import sys
+import time
+import types
 
+# Modules that are slow to import, such as yaml, docopt, logging.config and
+# pprint, are imported by the functions that use them, so that a command
+# only pays for what it needs. See the startup budget in benchmark.py.
 
 def setup_logging(
     default_path='access_6_logging.yaml',
@@ -64,13 +158,436 @@ def setup_logging(
     if value:
         path = value
     if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
+        from logging.config import dictConfig
+        dictConfig(load_cached_yaml(path))
     else:
         logging.basicConfig(level=default_level)
 
 
+def get_cache_dir():
+
+    '''
+    Return the directory migrate.py keeps caches in, $XDG_CACHE_HOME/migrate
+    or ~/.cache/migrate.
+    '''
+    return os.path.join(os.getenv('XDG_CACHE_HOME')
+                        or os.path.expanduser(os.path.join('~', '.cache')),
+                        'migrate')
+
+
+def load_cached_yaml(path):
+
+    '''
+    Return the content of the YAML file path, such as the logging
+    configuration or the critical host rules.
+
+    Parsing it needs yaml, which takes longer to import than most commands
+    take to run. The parsed content is cached with marshal, keyed by the
+    path, size and modification time of the file, so yaml is only imported
+    when the file changed.
+    '''
+    import marshal
+    import zlib
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = (path, stat.st_size, stat.st_mtime_ns)
+    cache_file = os.path.join(get_cache_dir(), 'yaml-%08x.marshal'
+                              % zlib.crc32(path.encode()))
+    try:
+        with open(cache_file, 'rb') as infile:
+            cached_signature, content = marshal.load(infile)
+        if tuple(cached_signature) == signature:
+            return content
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    import yaml
+    with open(path, 'rt') as f:
+        content = yaml.safe_load(f.read())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as outfile:
+            marshal.dump((signature, content), outfile)
+        os.replace(cache_file + '.tmp', cache_file)
+    except (OSError, ValueError):
+        # Not cacheable, such as a read only home or objects in the file
+        pass
+    return content
+
+
+def pformat(value):
+
+    '''
+    pprint.pformat, importing pprint only when a debug message is emitted.
+    '''
+    import pprint
+    return pprint.pformat(value)
+
+
+# Per-port debug messages in loops are only logged for one port in
+# TRACE_SAMPLE, set MIGRATE_TRACE_SAMPLE=1 to trace every port
+TRACE_SAMPLE = max(1, int(os.getenv('MIGRATE_TRACE_SAMPLE', '100')))
+
+# Containers longer than this are cut short by summarize
+SUMMARY_LIMIT = 10
+
+
+class LazyFormat():
+    '''
+    Debug log argument that is only formatted if the record is emitted, for
+    example logger.debug('%s', LazyFormat(pformat, switchports_d)).
+
+    function:       Function returning the text
+    args:           Arguments passed to function
+    '''
+
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+def summarize(value):
+
+    '''
+    Return a short description of value for debug logs. Dictionaries of
+    dictionaries, such as switchports_d, are counted rather than dumped, and
+    other containers are cut to SUMMARY_LIMIT items.
+    '''
+    if isinstance(value, dict):
+        items = list(itertools.islice(value.items(), SUMMARY_LIMIT))
+        if items and all(isinstance(item, dict) for key, item in items):
+            return '%d switches, %d ports: %s%s' % (
+                len(value), sum(len(item) for item in value.values()),
+                ', '.join(str(key) for key, item in items),
+                ', ...' if len(value) > SUMMARY_LIMIT else '')
+        text = pformat(dict(items))
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = list(itertools.islice(value, SUMMARY_LIMIT))
+        text = pformat(items)
+    else:
+        return pformat(value)
+    if len(value) > SUMMARY_LIMIT:
+        text += ' ... %d more' % (len(value) - SUMMARY_LIMIT)
+    return text
+
+
+def lazy_summary(value):
+
+    '''
+    Return a LazyFormat of summarize(value), for use as a debug argument.
+    '''
+    return LazyFormat(summarize, value)
+
+
+class PortTracer():
+    '''
+    Sampled per-port debug tracing for loops over the inventory.
+
+    Whether debug logging is on is checked once, when the tracer is made.
+    Loops should test the enabled attribute before calling, so that tracing
+    costs a single boolean test per port when debug logging is off:
+
+        trace = PortTracer(logger)
+        for port in ports:
+            if trace.enabled:
+                trace('port %s', port)
+
+    logger:         logging.Logger to write to
+    enabled:        True if debug logging is on
+    sample:         Log one call in sample, the first one included
+    count:          Number of calls so far
+    '''
+
+    __slots__ = ('logger', 'enabled', 'sample', 'count')
+
+    def __init__(self, logger, sample=None):
+
+        self.logger = logger
+        self.enabled = logger.isEnabledFor(logging.DEBUG)
+        self.sample = sample or TRACE_SAMPLE
+        self.count = 0
+
+    def __call__(self, msg, *args):
+        self.count += 1
+        if self.count % self.sample == 1 or self.sample == 1:
+            self.logger.debug(msg + ' [%s]', *args, self.count)
+
+
+class Profiler():
+    '''
+    Per phase wall time, row counts and peak memory of a command, see the
+    --PROFILE option.
+
+    Functions decorated with profiled are phases. Time spent in a phase
+    called from another phase, such as configure_ports called by
+    match_final_state, is only counted for the inner phase, so the phase
+    times add up to the time of the command. Generator phases are timed
+    while they produce each row, as their rows stream through write_csv_file.
+
+    With trace_memory, tracemalloc follows every allocation, and the peak is
+    that of the stretches of time the phase was running. This makes the
+    command a lot slower, but is left to the caller as the peak memory of
+    large inventories is often what matters.
+
+    phases_d:       Dictionary of phase name, [calls, rows, seconds, peak]
+    stack:          Names of the phases entered and not left
+    counters_d:     Dictionary of counter name, total, such as the hits and
+                    misses of the RenderCache
+    '''
+
+    __slots__ = ('phases_d', 'stack', 'trace_memory', 'started', 'mark',
+                 'total', 'counters_d')
+
+    def __init__(self, trace_memory=True):
+
+        self.phases_d = dict()
+        self.counters_d = dict()
+        self.stack = []
+        self.trace_memory = trace_memory
+        self.started = self.mark = None
+        self.total = 0.0
+
+    def start(self):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.started = self.mark = time.perf_counter()
+
+    def stop(self):
+        self.total = time.perf_counter() - self.started
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def _switch(self):
+        # Charge the time and memory since the last switch to the phase on
+        # top of the stack
+        now = time.perf_counter()
+        if self.stack:
+            phase = self.phases_d[self.stack[-1]]
+            phase[2] += now - self.mark
+            if self.trace_memory:
+                import tracemalloc
+                phase[3] = max(phase[3], tracemalloc.get_traced_memory()[1])
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        self.mark = now
+
+    def enter(self, name):
+        self._switch()
+        if name not in self.phases_d:
+            self.phases_d[name] = [0, 0, 0.0, 0]
+        self.phases_d[name][0] += 1
+        self.stack.append(name)
+
+    def leave(self, rows=0):
+        self._switch()
+        self.phases_d[self.stack.pop()][1] += rows
+
+    def iterate(self, name, iterable):
+        '''
+        Yield from iterable, timing the production of each item as phase
+        name, and counting a row per item.
+        '''
+        iterator = iter(iterable)
+        while True:
+            self._switch()
+            self.stack.append(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._switch()
+                self.stack.pop()
+            self.phases_d[name][1] += 1
+            yield item
+
+    def count(self, name, value):
+        self.counters_d[name] = self.counters_d.get(name, 0) + value
+
+    def report(self):
+        '''
+        Return the profile as a dictionary, for the JSON report.
+        '''
+        phases = [{'phase': name, 'calls': calls, 'rows': rows,
+                   'seconds': round(seconds, 6), 'peak_bytes': peak}
+                  for name, (calls, rows, seconds, peak)
+                  in self.phases_d.items()]
+        return {'total_seconds': round(self.total, 6),
+                'other_seconds': round(self.total - sum(
+                    phase[2] for phase in self.phases_d.values()), 6),
+                'trace_memory': self.trace_memory,
+                'phases': phases,
+                'counters': dict(self.counters_d)}
+
+    def summary(self):
+        '''
+        Return the profile as a text table, slowest phase first.
+        '''
+        lines = ['%-24s %8s %10s %10s %7s %10s' % (
+            'Phase', 'Calls', 'Rows', 'Seconds', '%', 'Peak MiB')]
+        total = self.total or 1.0
+        other = self.total - sum(phase[2] for phase in self.phases_d.values())
+        phases = sorted(self.phases_d.items(), key=lambda item: -item[1][2])
+        for name, (calls, rows, seconds, peak) in phases:
+            lines.append('%-24s %8d %10d %10.3f %7.1f %10s' % (
+                name, calls, rows, seconds, 100 * seconds / total,
+                '%.1f' % (peak / 2**20) if self.trace_memory else '-'))
+        lines.append('%-24s %8s %10s %10.3f %7.1f %10s' % (
+            '(other)', '', '', other, 100 * other / total, ''))
+        lines.append('%-24s %8s %10s %10.3f %7.1f %10s' % (
+            'Total', '', '', self.total, 100.0, ''))
+        for name, value in self.counters_d.items():
+            lines.append('%-24s %8s %10d' % (name, '', value))
+        return '\n'.join(lines)
+
+# The Profiler of the running command, None unless --PROFILE is given
+PROFILER = None
+
+
+def profiled(rows=None):
+
+    '''
+    Decorator making a function a phase of the Profiler, named after the
+    function. It only costs a test of PROFILER when profiling is off.
+
+    Generator functions are timed as their rows are produced, and count a
+    row per item. Other functions count rows(result) rows if rows is given.
+    '''
+    def decorator(function):
+        name = function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = PROFILER
+            if profiler is None:
+                return function(*args, **kwargs)
+            profiler.enter(name)
+            count = 0
+            try:
+                result = function(*args, **kwargs)
+                if rows is not None and \
+                        not isinstance(result, types.GeneratorType):
+                    count = rows(result)
+            finally:
+                profiler.leave(count)
+            if isinstance(result, types.GeneratorType):
+                return profiler.iterate(name, result)
+            return result
+        return wrapper
+    return decorator
+
+
+SWITCHPORT_FIELDS = ('switch_id', 'port_id', 'status', 'vlan', 'description',
+                     'configuration', 'final')
+
+
+# Interface types, by their full name and the short name show interface
+# status uses, which is the canonical form of port ids
+INTERFACE_TYPES = (
+    ('FastEthernet', 'Fa'),
+    ('GigabitEthernet', 'Gi'),
+    ('GigE', 'Gi'),
+    ('TwoGigabitEthernet', 'Tw'),
+    ('FiveGigabitEthernet', 'Fi'),
+    ('TenGigabitEthernet', 'Te'),
+    ('TenGigE', 'Te'),
+    ('TwentyFiveGigE', 'Twe'),
+    ('FortyGigabitEthernet', 'Fo'),
+    ('FortyGigE', 'Fo'),
+    ('HundredGigE', 'Hu'),
+    ('AppGigabitEthernet', 'Ap'),
+    ('Ethernet', 'Eth'),
+    ('Port-channel', 'Po'),
+    ('Vlan', 'Vl'),
+    ('Loopback', 'Lo'),
+    ('Tunnel', 'Tu'),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_interface_type(name):
+
+    '''
+    Return the short name of the interface type name, given as its short
+    name, full name, or any unambiguous abbreviation of the full name, as
+    the switch CLI accepts, in any case. Unknown types are returned as they
+    are.
+    '''
+    lower = name.lower()
+    shorts = {short for full, short in INTERFACE_TYPES
+              if short.lower() == lower}
+    if not shorts:
+        shorts = {short for full, short in INTERFACE_TYPES
+                  if full.lower().startswith(lower)}
+    return shorts.pop() if len(shorts) == 1 else name
+
+
+@functools.lru_cache(maxsize=None)
+def parse_port(name):
+
+    '''
+    Parse an interface name, such as GigabitEthernet1/0/2, gi1/0/2 or
+    Po10, once.
+
+    Returns
+    -------
+    (port_id, key) : the canonical port id, interned, such as Gi1/0/2, and
+        its natural sort key, (type, numbers, port_id), so that Gi1/0/2
+        sorts before Gi1/0/10. Names that do not parse are kept as they are,
+        and sort by name.
+    '''
+    import re
+
+    name = name.strip()
+    match = re.match(r'([A-Za-z][A-Za-z-]*?)\s*(\d+(?:[/:.]\d+)*)$', name)
+    if match is None:
+        port_id = sys.intern(name)
+        return port_id, (port_id, (), port_id)
+    kind = get_interface_type(match.group(1))
+    port_id = sys.intern(kind + match.group(2))
+    return port_id, (kind, tuple(int(number) for number in
+                                 re.split('[/:.]', match.group(2))), port_id)
+
+
+@functools.lru_cache(maxsize=None)
+def canonical_port(name):
+
+    '''
+    Return the canonical, interned port id of interface name. Port ids are
+    used in this form as keys everywhere, so names read from CSVs and
+    captures go through it.
+    '''
+    return parse_port(name)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def port_key(port_id):
+
+    '''
+    Return the natural sort key of port_id, for sorted(..., key=port_key).
+    '''
+    return parse_port(port_id)[1]
+
+
+def sort_ports(ports_d):
+
+    '''
+    Return ports_d, a dictionary of port id to SwitchPort, in natural port
+    order.
+    '''
+    return {port_id: ports_d[port_id]
+            for port_id in sorted(ports_d, key=port_key)}
+
+
 class SwitchPort():
     '''
     Class holds information about unique Switch / interface combinations.
@@ -90,18 +607,677 @@ class SwitchPort():
                     interface.
     final='' :      Default string of the final switch for the host.
 
+    Instances use __slots__ rather than a per-instance __dict__, and the
+    switch_id, port_id, status, vlan and final strings are interned, as the
+    same few values repeat on every port of the inventory. Code assigning new
+    values to these attributes should pass them through sys.intern as well.
+    port_id is made canonical by canonical_port, so GigabitEthernet1/0/2 is
+    stored as Gi1/0/2.
+
     '''
 
+    __slots__ = SWITCHPORT_FIELDS
+
     def __init__(self, switch_id, port_id, status, vlan, description, configuration = '',
             final=''):
 
-        self.switch_id = switch_id
-        self.port_id = port_id
-        self.status = status
-        self.vlan = vlan
+        intern = sys.intern
+        self.switch_id = intern(switch_id)
+        self.port_id = canonical_port(port_id)
+        self.status = intern(status)
+        self.vlan = intern(vlan)
         self.description = description
         self.configuration = configuration
-        self.final = final
+        self.final = intern(final)
+
+    def __repr__(self):
+        return 'SwitchPort(' + ', '.join(repr(getattr(self, field))
+                                         for field in SWITCHPORT_FIELDS) + ')'
+
+def is_free_port(port):
+
+    '''
+    Return True if port can be given to a host: it is disabled, and not
+    marked with a .final, which moving a host onto it would overwrite.
+    '''
+    return port.status == 'disabled' and not port.final
+
+
+class FreePortIndex():
+    '''
+    Per-switch index of free ports, see is_free_port.
+
+    The index is stored with the state so that finding spare ports does not
+    need a scan of every port of every switch. Each switch keeps a list of
+    port ids in natural order, see port_key. Ports are handed out from the
+    end of the list, so the highest port id is allocated first and runs are
+    repeatable.
+
+    ports_d:        Dictionary of switch_id to sorted list of free port ids
+    '''
+
+    __slots__ = ('ports_d',)
+
+    def __init__(self, ports_d=None):
+
+        self.ports_d = dict()
+        for switch_id, ports in (ports_d or {}).items():
+            self.ports_d[sys.intern(switch_id)] = sorted(
+                (canonical_port(port) for port in ports), key=port_key)
+
+    @classmethod
+    def from_switchports(cls, switchports_d):
+
+        '''
+        Build the index with a single scan of switchports_d.
+        '''
+        index = cls()
+        for switch_id, ports_d in switchports_d.items():
+            index.ports_d[switch_id] = sorted(
+                (port_id for port_id, port in ports_d.items()
+                 if is_free_port(port)), key=port_key)
+        return index
+
+    def to_dict(self):
+        return {switch_id: list(ports)
+                for switch_id, ports in self.ports_d.items()}
+
+    def subset(self, switch_ids):
+
+        '''
+        Return a copy of the index holding only switch_ids. Planning works on
+        a copy so that ports handed out for a run sheet stay free in the
+        stored state until the run sheet is applied by update.
+        '''
+        index = FreePortIndex()
+        for switch_id in switch_ids:
+            index.ports_d[switch_id] = list(self.ports_d.get(switch_id, ()))
+        return index
+
+    def ports(self, switch_id):
+
+        '''
+        Return the sorted list of free port ids on switch_id. The list is the
+        index itself, callers must not modify it.
+        '''
+        return self.ports_d.get(switch_id, [])
+
+    def count(self, switch_id):
+        return len(self.ports_d.get(switch_id, ()))
+
+    def pop(self, switch_id):
+
+        '''
+        Remove and return the next free port id on switch_id, or None if the
+        switch has no free ports.
+        '''
+        ports = self.ports_d.get(switch_id)
+        if not ports:
+            return None
+        return ports.pop()
+
+    @staticmethod
+    def _bisect(ports, port_id):
+
+        '''
+        Return where port_id is, or would go, in the sorted list ports.
+        '''
+        key = port_key(port_id)
+        low, high = 0, len(ports)
+        while low < high:
+            middle = (low + high) // 2
+            if port_key(ports[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def claim(self, switch_id, port_id):
+
+        '''
+        Remove port_id from the free ports of switch_id, if it is there.
+        '''
+        ports = self.ports_d.get(switch_id)
+        if ports:
+            idx = self._bisect(ports, port_id)
+            if idx < len(ports) and ports[idx] == port_id:
+                del ports[idx]
+
+    def release(self, switch_id, port_id):
+
+        '''
+        Add port_id to the free ports of switch_id, if it is not there.
+        '''
+        ports = self.ports_d.setdefault(switch_id, [])
+        idx = self._bisect(ports, port_id)
+        if idx == len(ports) or ports[idx] != port_id:
+            ports.insert(idx, port_id)
+
+
+# Vlans of the mission critical hosts that move relocates, when no rules
+# file selects them otherwise
+DEFAULT_CRITICAL_VLANS = ('1296', '1297')
+DEFAULT_RULES = {'include': [{'name': 'critical-vlans',
+                              'vlans': list(DEFAULT_CRITICAL_VLANS)}]}
+# Rules file read when neither --RULES nor MIGRATE_RULES names one
+DEFAULT_RULES_FILE = 'critical_rules.yaml'
+RULE_KEYS = ('name', 'vlans', 'switches', 'ports', 'description')
+
+
+class SwitchMatcher():
+    '''
+    Set of switch ids and shell style patterns of them, as in profiles.yaml.
+    Patterns are combined into one regex, and the answer for each switch id
+    is remembered, as the same few switches are asked about for every port.
+
+    names:          frozenset of switch ids
+    regex:          compiled regex of the patterns, or None
+    '''
+
+    __slots__ = ('names', 'regex', '_seen_d')
+
+    def __init__(self, patterns):
+
+        import fnmatch
+        import re
+
+        self.names = frozenset(pattern for pattern in patterns
+                               if not any(char in pattern for char in '*?['))
+        wildcards = [fnmatch.translate(pattern) for pattern in patterns
+                     if pattern not in self.names]
+        self.regex = re.compile('|'.join(wildcards)) if wildcards else None
+        self._seen_d = dict()
+
+    def __contains__(self, switch_id):
+
+        seen = self._seen_d.get(switch_id)
+        if seen is None:
+            seen = self._seen_d[switch_id] = switch_id in self.names or (
+                self.regex is not None
+                and self.regex.match(switch_id) is not None)
+        return seen
+
+
+class CriticalRules():
+    '''
+    Rules selecting the mission critical hosts, compiled once into a
+    predicate. A rules file looks like:
+
+        groups:
+          core: ['distsw_3*', access_12]
+        include:
+          - vlans: [1296, 1297, '2000-2099']
+          - name: payments
+            description: '^(db|pay)-'
+            switches: [core]
+        exclude:
+          - description: '(?i)decom'
+          - ports: ['access_12:Gi1/0/48']
+
+    A rule matches a port when every condition it has matches: the vlan is
+    in vlans, which may hold ranges, the switch is in switches, which may
+    hold groups and shell style patterns, switch:port is in ports, and the
+    description matches the regex. A host is critical when an include rule
+    and no exclude rule match it. Disabled ports are never hosts.
+
+    Vlans, switches and ports become frozenset lookups. The description
+    regexes of every rule are combined into a single regex, of one optional
+    lookahead per rule, so a description is scanned once for all of them.
+
+    rules_d:        Dictionary the rules were compiled from
+    signature:      Hash of the rules, 'default' for DEFAULT_RULES.
+                    Aggregates counted with other rules are counted again.
+    include_l:      List of compiled include rules, (name, vlans, switches,
+                    ports, group), None for a condition the rule does not
+                    have. group names the rule in regex.
+    exclude_l:      Likewise for exclude rules
+    regex:          Combined description regex, or None
+    vlan_d:         Dictionary of vlan to rule name, when every rule is an
+                    include rule on vlans only, else None
+    '''
+
+    __slots__ = ('rules_d', 'signature', 'include_l', 'exclude_l', 'regex',
+                 'vlan_d')
+
+    def __init__(self, rules_d, source='rules', signature=None):
+
+        import re
+
+        if not isinstance(rules_d, dict):
+            raise ValueError('Rules in ' + source + ' are not a mapping')
+        unknown = set(rules_d) - {'groups', 'include', 'exclude'}
+        if unknown:
+            raise ValueError('Unknown keys ' + ', '.join(sorted(unknown))
+                             + ' in ' + source)
+        groups_d = {str(name): [str(pattern) for pattern in patterns]
+                    for name, patterns in (rules_d.get('groups') or {}).items()}
+        patterns_l = []
+        self.rules_d = rules_d
+        if signature is None:
+            import hashlib
+            import json
+
+            signature = hashlib.sha1(json.dumps(
+                rules_d, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.signature = signature
+        self.include_l, self.exclude_l = (
+            [self._compile(rule_d, kind, number, source, groups_d, patterns_l)
+             for number, rule_d in enumerate(rules_d.get(kind) or (), 1)]
+            for kind in ('include', 'exclude'))
+        self.regex = None
+        if patterns_l:
+            self.regex = re.compile('(?s)' + ''.join(
+                '(?=.*?(?P<%s>%s))?' % (group, pattern)
+                for group, pattern in patterns_l))
+        self.vlan_d = None
+        if not self.exclude_l and all(
+                rule[2] is None and rule[3] is None and rule[4] is None
+                for rule in self.include_l):
+            self.vlan_d = dict()
+            for name, vlans, switches, ports, group in reversed(
+                    self.include_l):
+                self.vlan_d.update(dict.fromkeys(vlans, name))
+
+    @staticmethod
+    def _compile(rule_d, kind, number, source, groups_d, patterns_l):
+
+        '''
+        Compile one rule, adding its description regex to patterns_l.
+        '''
+        import re
+
+        name = '%s %d' % (kind, number)
+        if not isinstance(rule_d, dict) or not rule_d:
+            raise ValueError('Empty ' + name + ' in ' + source)
+        name = str(rule_d.get('name', name))
+        unknown = set(rule_d) - set(RULE_KEYS)
+        if unknown or set(rule_d) == {'name'}:
+            raise ValueError('Rule ' + name + ' in ' + source + ' needs '
+                             'some of ' + ', '.join(RULE_KEYS[1:])
+                             + (', not ' + ', '.join(sorted(unknown))
+                                if unknown else ''))
+
+        def get_list(key):
+            values = rule_d.get(key)
+            if values is None:
+                return None
+            return [str(value) for value in
+                    (values if isinstance(values, list) else [values])]
+
+        vlans = get_list('vlans')
+        if vlans is not None:
+            vlan_s = set()
+            for vlan in vlans:
+                first, _, last = vlan.partition('-')
+                try:
+                    vlan_s.update(str(number) for number in
+                                  range(int(first), int(last or first) + 1))
+                except ValueError:
+                    raise ValueError('Bad vlan ' + vlan + ' in rule ' + name
+                                     + ' of ' + source)
+            vlans = frozenset(sys.intern(vlan) for vlan in vlan_s)
+        switches = get_list('switches')
+        if switches is not None:
+            switches = SwitchMatcher([pattern for value in switches
+                                      for pattern in groups_d.get(value,
+                                                                  [value])])
+        ports = get_list('ports')
+        if ports is not None:
+            ports = frozenset(ports)
+        group = None
+        if 'description' in rule_d:
+            pattern = str(rule_d['description'])
+            try:
+                re.compile(pattern)
+            except re.error as error:
+                raise ValueError('Bad description regex in rule ' + name
+                                 + ' of ' + source + ': ' + str(error))
+            # Flags at the start of a pattern only apply to its part of the
+            # combined regex
+            flags = re.match(r'\(\?([aiLmsux]+)\)', pattern)
+            if flags:
+                pattern = '(?%s:%s)' % (flags.group(1), pattern[flags.end():])
+            group = 'r%d' % len(patterns_l)
+            patterns_l.append((group, pattern))
+        return (name, vlans, switches, ports, group)
+
+    def _find(self, rule_l, port, groups_d):
+
+        '''
+        Return the name of the first rule of rule_l matching port, or None.
+        '''
+        for name, vlans, switches, ports, group in rule_l:
+            if vlans is not None and port.vlan not in vlans:
+                continue
+            if switches is not None and port.switch_id not in switches:
+                continue
+            if ports is not None and \
+                    port.switch_id + ':' + port.port_id not in ports:
+                continue
+            if group is not None:
+                if not groups_d:
+                    groups_d.update(
+                        self.regex.match(port.description).groupdict())
+                if groups_d[group] is None:
+                    continue
+            return name
+        return None
+
+    def classify(self, port):
+
+        '''
+        Return the name of the include rule selecting the host on port, or
+        None if it is not critical.
+        '''
+        if port.status == 'disabled':
+            return None
+        if self.vlan_d is not None:
+            return self.vlan_d.get(port.vlan)
+        groups_d = dict()
+        name = self._find(self.include_l, port, groups_d)
+        if name is None or self._find(self.exclude_l, port, groups_d):
+            return None
+        return name
+
+    def __call__(self, port):
+        return self.classify(port) is not None
+
+
+# The CriticalRules of the command running, see get_critical_rules
+CRITICAL_RULES = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_rules():
+    return CriticalRules(DEFAULT_RULES, 'DEFAULT_RULES', 'default')
+
+
+def set_critical_rules(rules_file=None):
+
+    '''
+    Compile the rules of rules_file, or else of the file named by
+    MIGRATE_RULES, or else of DEFAULT_RULES_FILE if it exists, or else
+    DEFAULT_RULES, and make them the rules of the commands that follow.
+
+    Returns
+    -------
+    rules : CriticalRules
+    '''
+    global CRITICAL_RULES
+    rules_file = rules_file or os.getenv('MIGRATE_RULES')
+    if rules_file is None and os.path.exists(DEFAULT_RULES_FILE):
+        rules_file = DEFAULT_RULES_FILE
+    if rules_file is None:
+        CRITICAL_RULES = get_default_rules()
+    else:
+        CRITICAL_RULES = CriticalRules(load_cached_yaml(rules_file) or {},
+                                       rules_file)
+    return CRITICAL_RULES
+
+
+def get_critical_rules():
+
+    '''
+    Return the CriticalRules in force, DEFAULT_RULES unless set otherwise
+    with set_critical_rules.
+    '''
+    return CRITICAL_RULES or set_critical_rules()
+
+
+class Aggregates():
+    '''
+    Counters over the inventory, kept up to date as ports change so that
+    status queries never scan the ports.
+
+    switches_d:     Dictionary of switch_id to a list of counts
+                    [ports, free ports, hosts not on their .final switch]
+    critical_d:     Dictionary of switch_id to a dictionary of vlan to the
+                    number of critical hosts, as selected by the
+                    CriticalRules in force
+    rules:          signature of the CriticalRules the hosts were counted
+                    with. Counters saved before there were rules were
+                    counted with DEFAULT_RULES.
+    '''
+
+    __slots__ = ('switches_d', 'critical_d', 'rules')
+
+    def __init__(self, aggregates_d=None):
+
+        if aggregates_d is None:
+            self.rules = get_critical_rules().signature
+            aggregates_d = {}
+        else:
+            self.rules = aggregates_d.get('rules') or \
+                get_default_rules().signature
+        self.switches_d = {switch_id: list(counts) for switch_id, counts in
+                           aggregates_d.get('switches', {}).items()}
+        self.critical_d = {switch_id: dict(vlans_d) for switch_id, vlans_d in
+                           aggregates_d.get('critical', {}).items()}
+
+    @classmethod
+    def from_switchports(cls, switchports_d):
+
+        '''
+        Count the aggregates with a single scan of switchports_d.
+        '''
+        aggregates = cls()
+        for ports_d in switchports_d.values():
+            for port in ports_d.values():
+                aggregates.add(port)
+        return aggregates
+
+    def to_dict(self):
+        return {'switches': self.switches_d, 'critical': self.critical_d,
+                'rules': self.rules}
+
+    def add(self, port, sign=1):
+
+        '''
+        Count port in, or out with sign=-1. Code changing a port removes it
+        before the change and adds it back after.
+        '''
+        switch_id = port.switch_id
+        counts = self.switches_d.get(switch_id)
+        if counts is None:
+            counts = self.switches_d[switch_id] = [0, 0, 0]
+        counts[0] += sign
+        if port.status == 'disabled':
+            counts[1] += sign
+            return
+        if port.final and port.final != switch_id:
+            counts[2] += sign
+        if get_critical_rules()(port):
+            vlans_d = self.critical_d.setdefault(switch_id, {})
+            vlans_d[port.vlan] = vlans_d.get(port.vlan, 0) + sign
+            if not vlans_d[port.vlan]:
+                del vlans_d[port.vlan]
+                if not vlans_d:
+                    del self.critical_d[switch_id]
+
+    def remove(self, port):
+        self.add(port, -1)
+
+
+# Fields of SwitchPort compared by diff, and hashed into the fingerprint of
+# each switch
+DIFF_FIELDS = ('status', 'vlan', 'description', 'final')
+
+
+def fingerprint_switch(ports_d):
+
+    '''
+    Return a hash of the ports of a switch, over their port_id and
+    DIFF_FIELDS. Switches with the same fingerprint have no port for diff
+    to report.
+    '''
+    import hashlib
+
+    return hashlib.sha1('\n'.join(
+        '\0'.join((port_id, port.status, port.vlan, port.description,
+                   port.final))
+        for port_id, port in sorted(ports_d.items())).encode()).hexdigest()
+
+
+class Inventory(dict):
+    '''
+    Dictionary of dictionaries, each subdictionary is
+    ('<interface>', SwitchPort()), keyed by switch_id. This is the
+    switchports_d passed around by every subcommand.
+
+    Indexes derived from the ports are kept as attributes, and are saved
+    with the state by backends that can store them:
+
+    free_ports:     FreePortIndex of the 'disabled' ports of every switch
+    journal_seq:    Sequence number of the last move journal entry applied
+    journal_base:   Sequence number of the last journal entry in the saved
+                    snapshot, the entries after it were replayed on load
+    aggregates:     Aggregates, counters the status command reports from
+    fingerprints:   Dictionary of switch_id to the fingerprint_switch of
+                    switches known to be unchanged since it was computed.
+                    Code changing the ports of a switch calls changed().
+    loader:         ShardLoader or SqliteLoader, or None. When set, switches
+                    are only loaded the first time they are looked up, and
+                    iterating the inventory only sees the switches loaded so
+                    far. Use load_all() before scanning the whole estate.
+    '''
+
+    __slots__ = ('free_ports', 'journal_seq', 'journal_base', 'aggregates',
+                 'fingerprints', 'loader')
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.free_ports = None
+        self.journal_seq = 0
+        self.journal_base = 0
+        self.aggregates = None
+        self.fingerprints = dict()
+        self.loader = None
+
+    def __missing__(self, switch_id):
+
+        if self.loader is None:
+            raise KeyError(switch_id)
+        ports_d, free_port_l = self.loader(switch_id)
+        self[switch_id] = ports_d
+        self.reindex().ports_d[switch_id] = free_port_l
+        return ports_d
+
+    @profiled()
+    def preload(self, switch_ids):
+
+        '''
+        Make sure switch_ids are loaded, raising KeyError for an unknown
+        switch.
+        '''
+        for switch_id in switch_ids:
+            self[switch_id]
+
+    @profiled()
+    def load_all(self):
+
+        '''
+        Load every switch of a lazily loaded inventory.
+        '''
+        if self.loader is None:
+            return
+        free_ports = self.reindex()
+        for switch_id, ports_d, free_port_l in self.loader.items():
+            if switch_id not in self:
+                self[switch_id] = ports_d
+                free_ports.ports_d[switch_id] = free_port_l
+        self.loader = None
+
+    def sort(self):
+
+        '''
+        Put the loaded switches in id order, and the ports of each in
+        natural order, the order every state backend loads them in.
+        '''
+        for switch_id, ports_d in sorted(self.items()):
+            del self[switch_id]
+            self[switch_id] = sort_ports(ports_d)
+
+    def switch_ids(self):
+
+        '''
+        Return the ids of every switch, loaded or not.
+        '''
+        if self.loader is None:
+            return list(self)
+        return sorted(set(self).union(self.loader.switch_ids()))
+
+    def changed(self, *switch_ids):
+
+        '''
+        Forget the fingerprints of switch_ids, whose ports were changed.
+        '''
+        for switch_id in switch_ids:
+            self.fingerprints.pop(switch_id, None)
+
+    def get_fingerprint(self, switch_id):
+
+        '''
+        Return the fingerprint_switch of switch_id, loading and hashing the
+        switch only if its fingerprint is not known.
+        '''
+        fingerprint = self.fingerprints.get(switch_id)
+        if fingerprint is None:
+            fingerprint = self.fingerprints[switch_id] = \
+                fingerprint_switch(self[switch_id])
+        return fingerprint
+
+    def get_meta(self):
+
+        '''
+        Return the indexes as a dictionary that backends can serialise as
+        JSON.
+        '''
+        fingerprints = {switch_id: self.get_fingerprint(switch_id)
+                        for switch_id in self}
+        if self.loader is not None:
+            # Switches never looked up keep the fingerprint they had
+            fingerprints = dict(self.fingerprints, **fingerprints)
+        return {'free_ports': self.reindex().to_dict(),
+                'aggregates': self.get_aggregates().to_dict(),
+                'fingerprints': fingerprints,
+                'journal_seq': self.journal_seq}
+
+    def set_meta(self, meta):
+
+        '''
+        Restore indexes saved by get_meta. Missing indexes are rebuilt.
+        '''
+        if 'free_ports' in meta:
+            self.free_ports = FreePortIndex(meta['free_ports'])
+        if 'aggregates' in meta:
+            self.aggregates = Aggregates(meta['aggregates'])
+        self.fingerprints = dict(meta.get('fingerprints', {}))
+        self.journal_seq = self.journal_base = meta.get('journal_seq', 0)
+        self.reindex()
+
+    @profiled()
+    def reindex(self):
+
+        '''
+        Build any index that is missing, return the free port index.
+        '''
+        if self.free_ports is None:
+            self.free_ports = FreePortIndex.from_switchports(self)
+        return self.free_ports
+
+    def get_aggregates(self):
+
+        '''
+        Return the Aggregates, counting them if they were not saved with the
+        state, or were counted with other CriticalRules.
+        '''
+        if self.aggregates is None or \
+                self.aggregates.rules != get_critical_rules().signature:
+            self.load_all()
+            self.aggregates = Aggregates.from_switchports(self)
+        return self.aggregates
+
 
 def get_switchports_d(initcsv, confdir,confile):
     '''
@@ -114,6 +1290,10 @@ def get_switchports_d(initcsv, confdir,confile):
     confdir: directory yaml file will be stored in
     confile: filename of yaml file
 
+    Ports are keyed by their canonical port id, so rows naming the same
+    port twice, such as Gi1/0/1 and GigabitEthernet1/0/1, are reported
+    with raise_row_errors and nothing is saved.
+
     Returns
     -------
     None
@@ -124,608 +1304,4418 @@ def get_switchports_d(initcsv, confdir,confile):
     '''
 
     logger = logging.getLogger()
-    switchports_d = dict()
+    switchports_d = Inventory()
 
     logger.info('File: %s', initcsv)
+    # Row each port was read from, to report the rows naming it again
+    rows_d, errors = dict(), []
     with open(initcsv) as csvfile:
         reader = csv.reader(csvfile)
         next(reader) #skip headers
-        for row in reader:
+        for number, row in enumerate(reader, 2):
             switch_id, port, status, vlan, description = row
             if switch_id not in switchports_d.keys():
                 switchports_d[switch_id] = dict()
-            switchports_d[switch_id][port] = SwitchPort(switch_id, port,
-                    status, vlan, description)
+            port = SwitchPort(switch_id, port, status, vlan, description)
+            first = rows_d.setdefault((switch_id, port.port_id), number)
+            if first != number:
+                errors.append((number, '%s:%s is %s, already read from row %s'
+                               % (switch_id, row[1], port.port_id, first)))
+                continue
+            switchports_d[switch_id][port.port_id] = port
         logger.debug('row: %s', row)
-    logger.debug('switchport dictionary: %s ', pp.pformat(switchports_d))
+    if errors:
+        raise_row_errors(initcsv, errors)
+    switchports_d.reindex()
+    switchports_d.get_aggregates()
+    logger.debug('switchport dictionary: %s ', lazy_summary(switchports_d))
     dump_switchports(switchports_d, confdir, confile)
 
-def dump_switchports(switchports_d, confdir, confile):
+# Values of the Status column of show interface status. A port whose Name
+# runs into the Status column is found by searching for one of these.
+INTERFACE_STATUSES = ('connected', 'notconnect', 'disabled', 'err-disabled',
+                      'inactive', 'sfpAbsent', 'xcvrAbsen', 'monitoring',
+                      'suspended', 'noOperMem', 'notconnec', 'faulty')
+
+
+@functools.lru_cache(maxsize=None)
+def get_capture_parsers():
+
+    '''
+    Compile the regular expressions ingest parses CLI captures with, once
+    per process.
+
+    Returns
+    -------
+    parsers : dictionary of compiled patterns
+        prompt:         a command line, with the switch name in group 1
+        status:         the header of show interface status
+        description:    the header of show interface description
+        status_value:   a known Status value inside a status row
+    '''
+    import re
+
+    return {
+        'prompt': re.compile(r'^([\w.:/-]+)[#>]\s*\S'),
+        'status': re.compile(r'^Port\s+Name\s+Status\s+Vlan\b'),
+        'description': re.compile(
+            r'^Interface\s+Status\s+Protocol\s+Description'),
+        'status_value': re.compile(
+            r'\s(' + '|'.join(INTERFACE_STATUSES) + r')\s+(\S+)'),
+        }
+
+
+def get_columns(header, names):
+
+    '''
+    Return the start offset in header of each column in names, so that rows
+    under header can be sliced by column.
+    '''
+    columns = []
+    start = 0
+    for name in names:
+        start = header.index(name, start)
+        columns.append(start)
+        start += len(name)
+    return columns
+
+
+def parse_capture(lines, switch_id=None):
+
+    '''
+    Parse the output of show interface status and/or show interface
+    description from one switch.
+
+    Columns are found from the table headers, so the widths of any platform
+    are read right. Tables end at the first blank line or prompt.
+
+    Parameters
+    ----------
+    lines:          iterable of strings, the captured output
+    switch_id:      string, the switch, or None to take it from the prompt
+                    of the first command
+
+    Returns
+    -------
+    (switch_id, status_l, description_d, skipped_l)
+        switch_id:      string, or None if it was not given and there is no
+                        prompt
+        status_l:       list of (port_id, status, vlan, name) from show
+                        interface status, in capture order
+        description_d:  dictionary of port_id, description from show
+                        interface description
+        skipped_l:      list of the lines of show interface status that
+                        could not be parsed, for the caller to report
+    '''
+    parsers = get_capture_parsers()
+    status_l = []
+    skipped_l = []
+    description_d = dict()
+    table = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        prompt = parsers['prompt'].match(line)
+        if prompt:
+            switch_id = switch_id or prompt.group(1)
+            table = None
+        elif parsers['status'].match(line):
+            table = 'status'
+            name_start, status_start = get_columns(line, ('Name', 'Status'))
+        elif parsers['description'].match(line):
+            table = 'description'
+            description_start = get_columns(line, ('Description',))[0]
+        elif not line.strip():
+            table = None
+        elif line.startswith('-'):
+            # Rule under the header
+            continue
+        elif table == 'status':
+            port_id = line.split(None, 1)[0]
+            fields = line[status_start:].split()
+            if len(fields) >= 2 and fields[0] in INTERFACE_STATUSES:
+                name = line[name_start:status_start].strip()
+                status_l.append((port_id, fields[0], fields[1], name))
+                continue
+            # The name ran into the Status column
+            match = parsers['status_value'].search(line, len(port_id))
+            if match is None:
+                skipped_l.append(line)
+                continue
+            name = line[len(port_id):match.start()].strip()
+            status_l.append((port_id, match.group(1), match.group(2), name))
+        elif table == 'description':
+            port_id = line.split(None, 1)[0]
+            description_d[port_id] = line[description_start:].strip()
+    return switch_id, status_l, description_d, skipped_l
+
+
+# Extensions of capture files, stripped from the file name when it names the
+# switch. collect saves captures with the first.
+CAPTURE_EXTENSIONS = ('.txt', '.log')
+
+
+def parse_capture_file(capture_file):
+
+    '''
+    Parse a capture file of one switch with parse_capture. The switch is
+    named by the prompt of the first command in the file, or by the file
+    name without its extension, if it is one of CAPTURE_EXTENSIONS, if
+    there is no prompt. Switch names may hold dots, as in sw1.site.example.
+
+    This runs in the worker processes of ingest, so it returns plain tuples
+    rather than SwitchPorts.
+    '''
+    with open(capture_file, errors='replace') as infile:
+        switch_id, status_l, description_d, skipped_l = parse_capture(infile)
+    if switch_id is None:
+        switch_id = os.path.basename(capture_file)
+        root, extension = os.path.splitext(switch_id)
+        if extension.lower() in CAPTURE_EXTENSIONS:
+            switch_id = root
+    return switch_id, status_l, description_d, skipped_l
+
+
+def get_capture_ports(status_l, description_d):
+
+    '''
+    Return the ports of a switch as (port_id, status, vlan, description),
+    from the tables returned by parse_capture. Descriptions come from show
+    interface description, or the Name column when a port is not in it.
+    '''
+    description_d = {canonical_port(port_id): description
+                     for port_id, description in description_d.items()}
+    return [(port_id, status, vlan, description_d.get(port_id, name))
+            for port_id, status, vlan, name in
+            ((canonical_port(port_id), status, vlan, name)
+             for port_id, status, vlan, name in status_l)]
+
+
+def refresh_switch(switchports_d, switch_id, port_l):
+
+    '''
+    Replace switch_id in switchports_d with the ports in port_l, keeping the
+    .final and configuration of the ports it already had. The indexes of
+    switchports_d have to be rebuilt afterwards.
+
+    Parameters
+    ----------
+    switchports_d : Inventory
+    switch_id:      string
+    port_l:         list of (port_id, status, vlan, description)
+
+    Returns
+    -------
+    (added, changed, removed) : integers, counts of ports
+    '''
+    old_ports_d = switchports_d.get(switch_id, {})
+    new_ports_d = dict()
+    added = changed = 0
+    for port_id, status, vlan, description in port_l:
+        port_id = canonical_port(port_id)
+        old = old_ports_d.get(port_id)
+        if old is None:
+            added += 1
+            new_ports_d[port_id] = SwitchPort(switch_id, port_id, status,
+                                              vlan, description)
+            continue
+        if (old.status, old.vlan, old.description) != \
+                (status, vlan, description):
+            changed += 1
+        new_ports_d[port_id] = SwitchPort(switch_id, port_id, status, vlan,
+                                          description, old.configuration,
+                                          old.final)
+    switchports_d[switch_id] = new_ports_d
+    switchports_d.changed(switch_id)
+    return added, changed, len(old_ports_d.keys() - new_ports_d.keys())
+
+
+def load_or_create_switchports(confdir, confile):
+
+    '''
+    Return the fully loaded Inventory of the state file, or an empty one if
+    there is no state file yet.
+    '''
+    if not os.path.exists(os.path.join(confdir, confile)):
+        return Inventory()
+    switchports_d = load_switchports(confdir, confile)
+    switchports_d.load_all()
+    return switchports_d
+
+
+def dump_refreshed_switchports(switchports_d, confdir, confile):
+
+    '''
+    Rebuild the indexes of switchports_d after refresh_switch, and save it.
+    '''
+    switchports_d.free_ports = None
+    switchports_d.aggregates = None
+    switchports_d.reindex()
+    switchports_d.get_aggregates()
+    dump_switchports(switchports_d, confdir, confile)
+
+
+def parse_capture_files(capture_files, workers=None):
+
+    '''
+    Parse capture_files with parse_capture_file, in a pool of workers
+    processes when there are enough files to be worth it, and merge them
+    per switch.
+
+    Parameters
+    ----------
+    capture_files:  list of strings, paths of capture files
+    workers:        integer, number of processes, the number of CPUs if None
+
+    Returns
+    -------
+    (ports_d, skipped)
+        ports_d:    dictionary of switch_id, list of (port_id, status, vlan,
+                    description). Descriptions come from show interface
+                    description, or the Name column when a port is not in it.
+        skipped:    integer, the show interface status lines that could not
+                    be parsed, each logged with its switch
+    '''
+    logger = logging.getLogger()
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(capture_files) >= 2 * workers:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed_l = list(executor.map(
+                parse_capture_file, capture_files,
+                chunksize=max(1, len(capture_files) // (4 * workers))))
+    else:
+        parsed_l = [parse_capture_file(capture_file)
+                    for capture_file in capture_files]
+    status_d = defaultdict(dict)
+    description_d = defaultdict(dict)
+    skipped = 0
+    for capture_file, (switch_id, status_l, descriptions, skipped_l) in zip(
+            capture_files, parsed_l):
+        if not status_l and not descriptions:
+            logger.warning('No interface table found in %s', capture_file)
+        for line in skipped_l:
+            logger.warning('%s: skipped show interface status line in %s: '
+                           '%r', switch_id, capture_file, line)
+        skipped += len(skipped_l)
+        for row in status_l:
+            status_d[switch_id][row[0]] = row
+        description_d[switch_id].update(descriptions)
+    ports_d = dict()
+    for switch_id in status_d.keys() | description_d.keys():
+        if not status_d[switch_id]:
+            logger.warning('No show interface status for %s, skipped',
+                           switch_id)
+            continue
+        ports_d[switch_id] = get_capture_ports(status_d[switch_id].values(),
+                                               description_d[switch_id])
+    return ports_d, skipped
+
+
+def ingest_switchports(capture_files, confdir, confile, workers=None):
+
+    '''
+    Refresh the state from raw CLI captures of show interface status and
+    show interface description, rather than a hand made init CSV.
+
+    Every switch found in the captures replaces the one in the state, if
+    there is a state file, keeping the .final and configuration of the ports
+    it still has. Other switches are left as they are.
+
+    Parameters
+    ----------
+    capture_files:  list of strings, passed by docopt.
+                    Capture files, one or more per switch
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    workers:        integer, passed by docopt.
+                    Number of parsing processes, the number of CPUs if None
+
+    Returns
+    -------
+    None
+
+    Calls
+    -----
+    parse_capture_files(capture_files, workers)
+    dump_refreshed_switchports(switchports_d, confdir, confile)
+    '''
+    logger = logging.getLogger()
+    ports_d, skipped = parse_capture_files(capture_files, workers)
+    switchports_d = load_or_create_switchports(confdir, confile)
+    added = changed = removed = 0
+    for switch_id, port_l in sorted(ports_d.items()):
+        counts = refresh_switch(switchports_d, switch_id, port_l)
+        added, changed, removed = (added + counts[0], changed + counts[1],
+                                   removed + counts[2])
+    logger.info('Ingested %s switches from %s files: %s ports added, %s '
+                'changed, %s removed, %s status lines skipped', len(ports_d),
+                len(capture_files), added, changed, removed, skipped)
+    dump_refreshed_switchports(switchports_d, confdir, confile)
+
+# Commands collect runs on every switch, in a single session
+COLLECT_COMMANDS = ('terminal length 0', 'show interface status',
+                    'show interface description')
+
+# Seconds before the first retry of a switch, doubled for every retry after
+RETRY_DELAY = 1.0
+
+
+class CliSession(abc.ABC):
+    '''
+    Interactive CLI session with a switch, the base of the transports in
+    CLI_TRANSPORTS. Subclasses open the connection. The output of a command
+    is read up to the next prompt, a line ending in # or >, so a session
+    can be reused for any number of commands.
+
+    device_d:       Row of the devices CSV, with switch_id, host and port
+    timeout:        Seconds to wait for the connection and for each prompt
+    prompt:         The last prompt seen
+    '''
+
+    def __init__(self, device_d, timeout=30.0):
+
+        self.device_d = device_d
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.prompt = None
+
+    @abc.abstractmethod
+    async def open(self):
+        '''
+        Connect to the switch and read up to its first prompt.
+        '''
+
+    async def read_chunk(self):
+        return await self.reader.read(65536)
+
+    def write(self, text):
+        self.writer.write(text)
+
+    async def read_until_prompt(self):
+        '''
+        Return the output up to the next prompt, without the prompt.
+        '''
+        import asyncio
+
+        prompt_re = get_session_prompt()
+        buffer = ''
+        while True:
+            chunk = await asyncio.wait_for(self.read_chunk(), self.timeout)
+            if not chunk:
+                raise EOFError('Connection to ' + self.device_d['switch_id']
+                               + ' closed')
+            buffer += chunk
+            match = prompt_re.search(buffer)
+            if match:
+                self.prompt = match.group(1)
+                return buffer[:match.start()]
+
+    async def run(self, command):
+        '''
+        Run command and return its output, without the echoed command.
+        '''
+        self.write(command + '\n')
+        output = await self.read_until_prompt()
+        first, newline, rest = output.partition('\n')
+        return rest if first.strip() == command else output
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class TcpSession(CliSession):
+    '''
+    CLI session over plain TCP, as served by terminal servers, and by
+    fakedevice.py for testing.
+    '''
+
+    async def open(self):
+        import asyncio
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            self.device_d['host'], int(self.device_d.get('port') or 23)),
+            self.timeout)
+        self.reader, self.writer = reader, writer
+        await self.read_until_prompt()
+
+    async def read_chunk(self):
+        return (await self.reader.read(65536)).decode(errors='replace')
+
+    def write(self, text):
+        self.writer.write(text.encode())
+
+
+class SshSession(CliSession):
+    '''
+    CLI session over SSH, with asyncssh, which is only needed for this
+    transport. The user is the username column of the devices CSV or
+    MIGRATE_USERNAME, and the password MIGRATE_PASSWORD, or keys and the
+    SSH agent are used. Host keys are checked against ~/.ssh/known_hosts.
+    '''
+
+    async def open(self):
+        import asyncio
+        try:
+            import asyncssh
+        except ImportError:
+            raise ValueError('The ssh transport needs asyncssh, install it '
+                             'with pip install asyncssh')
+
+        options = {'port': int(self.device_d.get('port') or 22)}
+        username = self.device_d.get('username') or \
+            os.getenv('MIGRATE_USERNAME')
+        if username:
+            options['username'] = username
+        if os.getenv('MIGRATE_PASSWORD'):
+            options['password'] = os.getenv('MIGRATE_PASSWORD')
+        self.connection = await asyncio.wait_for(
+            asyncssh.connect(self.device_d['host'], **options), self.timeout)
+        process = await self.connection.create_process(term_type='vt100')
+        self.reader, self.writer = process.stdout, process.stdin
+        await self.read_until_prompt()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.connection.close()
+
+
+CLI_TRANSPORTS = {
+    'tcp': TcpSession,
+    'ssh': SshSession,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_session_prompt():
+
+    '''
+    Return the compiled pattern of a prompt at the end of CLI output, such
+    as sw1# or sw1(config-if)#, with the prompt in group 1.
+    '''
+    import re
+
+    return re.compile(r'(?:^|\n)([\w.:/-]+(?:\([\w-]+\))?[#>]) ?$')
+
+
+def get_session(device_d, timeout):
+
+    '''
+    Return a CliSession for the transport column of device_d, tcp if it has
+    none, raising ValueError for an unknown transport.
+    '''
+    transport = device_d.get('transport') or 'tcp'
+    try:
+        return CLI_TRANSPORTS[transport](device_d, timeout)
+    except KeyError:
+        raise ValueError('Unknown transport ' + transport + ' for '
+                         + device_d['switch_id'] + ', use one of '
+                         + ', '.join(sorted(CLI_TRANSPORTS)))
+
+
+def load_devices(devicecsv):
+
+    '''
+    Load the devices CSV, with the headers switch_id, host and optionally
+    port, site, transport and username.
+
+    Returns
+    -------
+    devices_l : list of dictionaries, one per row
+    '''
+    with open(devicecsv, newline='') as csv_file:
+        devices_l = list(csv.DictReader(csv_file))
+    for device_d in devices_l:
+        if not device_d.get('switch_id') or not device_d.get('host'):
+            raise ValueError('Every device in ' + devicecsv + ' needs a '
+                             'switch_id and a host')
+    return devices_l
+
+
+async def run_session(device_d, commands, semaphore, timeout=30.0,
+                      retries=2):
+
+    '''
+    Run commands on a switch in a single session, holding semaphore while
+    connected. Connection errors and timeouts are retried, after RETRY_DELAY
+    seconds, doubling every time.
+
+    Returns
+    -------
+    outputs : list of strings, the output of every command
+    '''
+    import asyncio
+
+    logger = logging.getLogger()
+    for attempt in range(retries + 1):
+        async with semaphore:
+            session = get_session(device_d, timeout)
+            try:
+                await session.open()
+                return [await session.run(command) for command in commands]
+            except (OSError, EOFError, asyncio.TimeoutError) as error:
+                if attempt == retries:
+                    raise
+                logger.warning('%s: %s, retrying', device_d['switch_id'],
+                               error or type(error).__name__)
+            finally:
+                await session.close()
+        await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+async def collect_devices(devices_l, switchports_d, concurrency=10,
+                          timeout=30.0, retries=2, capturedir=None):
+
+    '''
+    Collect COLLECT_COMMANDS from every device concurrently, at most
+    concurrency sessions per site, and refresh each switch in switchports_d
+    as soon as its output arrives.
+
+    Returns
+    -------
+    (failed_l, skipped)
+        failed_l:   list of switch ids that could not be collected
+        skipped:    integer, the show interface status lines that could not
+                    be parsed, each logged with its switch
+    '''
+    import asyncio
+
+    logger = logging.getLogger()
+    semaphores_d = defaultdict(lambda: asyncio.Semaphore(concurrency))
+
+    async def collect(device_d):
+        try:
+            return device_d, await run_session(
+                device_d, COLLECT_COMMANDS,
+                semaphores_d[device_d.get('site') or ''], timeout, retries)
+        except Exception as error:
+            return device_d, error
+
+    failed_l = []
+    skipped = 0
+    tasks = [asyncio.ensure_future(collect(device_d))
+             for device_d in devices_l]
+    for task in asyncio.as_completed(tasks):
+        device_d, outputs = await task
+        switch_id = device_d['switch_id']
+        if isinstance(outputs, Exception):
+            logger.error('%s: collect failed, %s', switch_id,
+                         outputs or type(outputs).__name__)
+            failed_l.append(switch_id)
+            continue
+        text = '\n'.join(outputs)
+        if capturedir:
+            with open(os.path.join(capturedir, switch_id
+                                   + CAPTURE_EXTENSIONS[0]), 'w') as outfile:
+                outfile.write(text)
+        status_l, description_d, skipped_l = parse_capture(
+            text.splitlines(), switch_id)[1:]
+        for line in skipped_l:
+            logger.warning('%s: skipped show interface status line: %r',
+                           switch_id, line)
+        skipped += len(skipped_l)
+        if not status_l:
+            logger.error('%s: no show interface status in the output',
+                         switch_id)
+            failed_l.append(switch_id)
+            continue
+        added, changed, removed = refresh_switch(
+            switchports_d, switch_id,
+            get_capture_ports(status_l, description_d))
+        logger.info('%s: %s ports, %s added, %s changed, %s removed',
+                    switch_id, len(status_l), added, changed, removed)
+    return failed_l, skipped
+
+
+def collect_switchports(devicecsv, confdir, confile, concurrency=10,
+                        timeout=30.0, retries=2, capturedir=None):
+
+    '''
+    Refresh the state by collecting show interface status and show interface
+    description from the switches in devicecsv, as ingest would from
+    captures of them.
+
+    Parameters
+    ----------
+    devicecsv:      string, passed by docopt.
+                    CSV of switch_id, host, port, site, transport, username
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    concurrency:    integer, passed by docopt.
+                    Sessions open at the same time per site
+    timeout:        float, passed by docopt.
+                    Seconds to wait for a connection or a prompt
+    retries:        integer, passed by docopt.
+                    Times a switch is retried after an error
+    capturedir:     string, passed by docopt.
+                    Directory to also save the output of each switch in, in
+                    the capture format of ingest
+
+    Returns
+    -------
+    failed_l : list of switch ids that could not be collected, and keep
+        their previous state
+    '''
+    import asyncio
+
+    logger = logging.getLogger()
+    devices_l = load_devices(devicecsv)
+    if capturedir:
+        os.makedirs(capturedir, exist_ok=True)
+    switchports_d = load_or_create_switchports(confdir, confile)
+    failed_l, skipped = asyncio.run(collect_devices(
+        devices_l, switchports_d, concurrency, timeout, retries, capturedir))
+    logger.info('Collected %s of %s switches, %s status lines skipped',
+                len(devices_l) - len(failed_l), len(devices_l), skipped)
+    if failed_l:
+        logger.error('Not collected: %s', ', '.join(sorted(failed_l)))
+    if len(failed_l) < len(devices_l):
+        dump_refreshed_switchports(switchports_d, confdir, confile)
+    return failed_l
+
+# Tag used by the original YAML object dumps. It is kept when writing so that
+# files stay readable by older copies of migrate.py run as a script.
+SWITCHPORT_YAML_TAG = 'tag:yaml.org,2002:python/object:__main__.SwitchPort'
+
+COLUMNAR_FORMAT = 'switchports-columnar'
+COLUMNAR_VERSION = 2
+SQLITE_VERSION = 1
+
+
+def _yaml_loader():
+
+    '''
+    Build a safe YAML loader that understands the SwitchPort object tags.
+
+    yaml.load over the full Python object loader is both slow and unsafe, so
+    only the SwitchPort tags written by dump_switchports are accepted.
+
+    Returns
+    -------
+    loader : subclass of yaml.SafeLoader (the C version when available)
+    '''
+    import yaml
+
+    base = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    class SwitchPortLoader(base):
+        pass
+
+    def construct_switchport(loader, node):
+        values = loader.construct_mapping(node)
+        return SwitchPort(**{field: values.get(field, '')
+                             for field in SWITCHPORT_FIELDS})
+
+    for module in ('__main__', 'migrate'):
+        SwitchPortLoader.add_constructor(
+            'tag:yaml.org,2002:python/object:' + module + '.SwitchPort',
+            construct_switchport)
+    return SwitchPortLoader
+
+
+def _yaml_dumper():
+
+    '''
+    Build a YAML dumper writing SwitchPort in the original object dump format.
+
+    Returns
+    -------
+    dumper : subclass of yaml.Dumper (the C version when available)
+    '''
+    import yaml
+
+    base = getattr(yaml, 'CDumper', yaml.Dumper)
+
+    class SwitchPortDumper(base):
+        pass
+
+    def represent_switchport(dumper, switchport):
+        return dumper.represent_mapping(SWITCHPORT_YAML_TAG,
+                {field: getattr(switchport, field)
+                 for field in SWITCHPORT_FIELDS})
+
+    SwitchPortDumper.add_representer(SwitchPort, represent_switchport)
+    SwitchPortDumper.add_representer(Inventory,
+                                     SwitchPortDumper.represent_dict)
+    return SwitchPortDumper
+
+
+def load_yaml_state(switchports_file):
+
+    '''
+    Loads instances of SwitchPort from a YAML object dump.
+
+    Parameters
+    ----------
+    switchports_file: string, path of the yaml file
+
+    Returns
+    -------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    '''
+    import yaml
+
+    with open(switchports_file, 'r') as infile:
+        loaded_d = yaml.load(infile, Loader=_yaml_loader())
+    # Keys as written, the ports hold their canonical id
+    switchports_d = Inventory(
+        (switch_id, sort_ports({port.port_id: port
+                                for port in ports_d.values()}))
+        for switch_id, ports_d in loaded_d.items())
+    switchports_d.reindex()
+    return switchports_d
+
+
+def dump_yaml_state(switchports_d, switchports_file):
+
+    '''
+    Dumps instances of SwitchPort to a YAML object dump. The original format
+    has no room for the Inventory indexes, they are rebuilt on load.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    switchports_file: string, path of the yaml file
+
+    Returns
+    -------
+    None
+    '''
+    import yaml
+
+    with open(switchports_file, 'w') as outfile:
+        yaml.dump(switchports_d, outfile, Dumper=_yaml_dumper(),
+                  default_flow_style=False)
+
+
+class SqliteLoader():
+    '''
+    Loads single switches from a SQLite state database.
+
+    path:           String, path of the database
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+
+    def _rows(self, where='', parameters=()):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path)
+        try:
+            yield from connection.execute(
+                'SELECT ' + ', '.join(SWITCHPORT_FIELDS) + ' FROM switchports '
+                + where + ' ORDER BY switch_id, port_id', parameters)
+        finally:
+            connection.close()
+
+    def switch_ids(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path)
+        try:
+            return [row[0] for row in connection.execute(
+                'SELECT DISTINCT switch_id FROM switchports '
+                'ORDER BY switch_id')]
+        finally:
+            connection.close()
+
+    def __call__(self, switch_id):
+
+        '''
+        Return (ports_d, free_port_l) of switch_id, raise KeyError if the
+        switch is not in the database.
+        '''
+        ports_d = sort_ports({port.port_id: port for port in (
+            SwitchPort(*row)
+            for row in self._rows('WHERE switch_id = ?', (switch_id,)))})
+        if not ports_d:
+            raise KeyError(switch_id)
+        return ports_d, [port_id for port_id, port in ports_d.items()
+                         if is_free_port(port)]
+
+    def items(self):
+
+        '''
+        Yield (switch_id, ports_d, free_port_l) for every switch, reading the
+        database in a single pass.
+        '''
+        for switch_id, rows in itertools.groupby(self._rows(),
+                                                 key=lambda row: row[0]):
+            ports_d = sort_ports({port.port_id: port for port in
+                                  (SwitchPort(*row) for row in rows)})
+            yield switch_id, ports_d, [port_id
+                                       for port_id, port in ports_d.items()
+                                       if is_free_port(port)]
+
+
+def load_sqlite_state(switchports_file):
+
+    '''
+    Opens a SQLite state database. Only the Inventory indexes are read,
+    switches are loaded the first time they are looked up.
+
+    Parameters
+    ----------
+    switchports_file: string, path of the database
+
+    Returns
+    -------
+    switchports_d : Inventory, dictionary of dictionaries, each subdictionary
+            is ('<interface>', SwitchPort()), loaded lazily
+    '''
+    import json
+    import sqlite3
+
+    if not os.path.exists(switchports_file):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                switchports_file)
+    connection = sqlite3.connect(switchports_file)
+    try:
+        version = connection.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or int(version[0]) != SQLITE_VERSION:
+            raise ValueError('Unsupported state database version in '
+                             + switchports_file)
+        meta = connection.execute(
+            "SELECT value FROM meta WHERE key = 'inventory'").fetchone()
+    finally:
+        connection.close()
+    switchports_d = Inventory()
+    switchports_d.free_ports = FreePortIndex()
+    switchports_d.loader = SqliteLoader(switchports_file)
+    switchports_d.set_meta(json.loads(meta[0]) if meta else {})
+    return switchports_d
+
+
+def dump_sqlite_state(switchports_d, switchports_file):
+
+    '''
+    Dumps instances of SwitchPort to a SQLite database.
+
+    The database is built next to the target and renamed over it, so a
+    failed dump never leaves a half written state file behind.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    switchports_file: string, path of the database
+
+    Returns
+    -------
+    None
+    '''
+    import json
+    import sqlite3
+
+    tmp_file = switchports_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    connection = sqlite3.connect(tmp_file)
+    try:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, '
+                           'value TEXT)')
+        connection.execute('CREATE TABLE switchports (switch_id TEXT, '
+                           'port_id TEXT, status TEXT, vlan TEXT, '
+                           'description TEXT, configuration TEXT, final TEXT, '
+                           'PRIMARY KEY (switch_id, port_id)) WITHOUT ROWID')
+        connection.execute("INSERT INTO meta VALUES ('version', ?)",
+                           (str(SQLITE_VERSION),))
+        if isinstance(switchports_d, Inventory):
+            connection.execute("INSERT INTO meta VALUES ('inventory', ?)",
+                               (json.dumps(switchports_d.get_meta()),))
+        connection.executemany(
+            'INSERT INTO switchports VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((port.switch_id, port.port_id, port.status, port.vlan,
+              port.description, port.configuration, port.final)
+             for ports_d in switchports_d.values()
+             for port in ports_d.values()))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_file, switchports_file)
+
+
+def load_columnar_state(switchports_file):
+
+    '''
+    Loads instances of SwitchPort from a versioned columnar JSON file.
+
+    The file holds one array per SwitchPort field. Columns with few distinct
+    values (switch_id, status, vlan, final) are stored as indexes into a
+    shared string table. The Inventory indexes are stored under 'meta'.
+    Since version 2 the ports of each switch are stored in natural order,
+    version 1 files are sorted on load.
+
+    Parameters
+    ----------
+    switchports_file: string, path of the json file
+
+    Returns
+    -------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    '''
+    import json
+
+    with open(switchports_file, 'r') as infile:
+        state = json.load(infile)
+    version = state.get('version')
+    if state.get('format') != COLUMNAR_FORMAT or \
+            version not in (1, COLUMNAR_VERSION):
+        raise ValueError('Unsupported columnar state file ' + switchports_file)
+    strings = state['strings']
+    columns = state['columns']
+    switchports_d = Inventory()
+    for switch_idx, port_id, status_idx, vlan_idx, description, \
+            configuration, final_idx in zip(*(columns[field]
+                                              for field in SWITCHPORT_FIELDS)):
+        switch_id = strings[switch_idx]
+        ports_d = switchports_d.get(switch_id)
+        if ports_d is None:
+            ports_d = switchports_d[switch_id] = dict()
+        port = SwitchPort(switch_id, port_id, strings[status_idx],
+                          strings[vlan_idx], description, configuration,
+                          strings[final_idx])
+        ports_d[port.port_id] = port
+    if version == 1:
+        # version 1 files hold the ports of a switch in lexical order
+        for switch_id, ports_d in switchports_d.items():
+            switchports_d[switch_id] = sort_ports(ports_d)
+    switchports_d.set_meta(state.get('meta', {}))
+    return switchports_d
+
+
+def dump_columnar_state(switchports_d, switchports_file):
+
+    '''
+    Dumps instances of SwitchPort to a versioned columnar JSON file.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    switchports_file: string, path of the json file
+
+    Returns
+    -------
+    None
+    '''
+    import json
+
+    strings_d = dict()
+    columns = {field: [] for field in SWITCHPORT_FIELDS}
+    encoded = ('switch_id', 'status', 'vlan', 'final')
+    for switch_id in sorted(switchports_d):
+        ports_d = switchports_d[switch_id]
+        for port_id in sorted(ports_d, key=port_key):
+            port = ports_d[port_id]
+            for field in SWITCHPORT_FIELDS:
+                value = getattr(port, field)
+                if field in encoded:
+                    value = strings_d.setdefault(value, len(strings_d))
+                columns[field].append(value)
+    state = {'format': COLUMNAR_FORMAT, 'version': COLUMNAR_VERSION,
+             'strings': list(strings_d), 'columns': columns}
+    if isinstance(switchports_d, Inventory):
+        state['meta'] = switchports_d.get_meta()
+    tmp_file = switchports_file + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(state, outfile, separators=(',', ':'))
+    os.replace(tmp_file, switchports_file)
+
+
+SHARDED_FORMAT = 'switchports-shards'
+SHARDED_VERSION = 1
+SHARD_MANIFEST = 'manifest.json'
+
+
+class ShardLoader():
+    '''
+    Loads single switches from a sharded state directory.
+
+    The directory holds one JSON shard per switch and a manifest.json
+    listing every switch with its shard file and a hash of the shard.
+
+    path:           String, the state directory
+    manifest:       Dictionary read from manifest.json
+    '''
+
+    def __init__(self, path, manifest):
+
+        self.path = path
+        self.manifest = manifest
+
+    def switch_ids(self):
+        return list(self.manifest['switches'])
+
+    def __call__(self, switch_id):
+
+        '''
+        Return (ports_d, free_port_l) of switch_id, raise KeyError if the
+        switch is not in the manifest.
+        '''
+        import json
+
+        entry = self.manifest['switches'][switch_id]
+        with open(os.path.join(self.path, entry['file']), 'r') as infile:
+            shard = json.load(infile)
+        ports_d = dict()
+        for port_id, status, vlan, description, configuration, final in \
+                shard['ports']:
+            port = SwitchPort(switch_id, port_id, status, vlan, description,
+                              configuration, final)
+            ports_d[port.port_id] = port
+        return sort_ports(ports_d), sorted(
+            (canonical_port(port) for port in shard['free_ports']),
+            key=port_key)
+
+    def items(self):
+
+        '''
+        Yield (switch_id, ports_d, free_port_l) for every switch.
+        '''
+        for switch_id in self.switch_ids():
+            yield (switch_id,) + self(switch_id)
+
+
+def load_sharded_state(switchports_dir):
+
+    '''
+    Opens a sharded state directory. Only the manifest is read, switches are
+    loaded from their shard the first time they are looked up.
+
+    Parameters
+    ----------
+    switchports_dir: string, path of the state directory
+
+    Returns
+    -------
+    switchports_d : Inventory, dictionary of dictionaries, each subdictionary
+            is ('<interface>', SwitchPort()), loaded lazily
+    '''
+    import json
+
+    with open(os.path.join(switchports_dir, SHARD_MANIFEST), 'r') as infile:
+        manifest = json.load(infile)
+    if manifest.get('format') != SHARDED_FORMAT or \
+            manifest.get('version') != SHARDED_VERSION:
+        raise ValueError('Unsupported sharded state directory '
+                         + switchports_dir)
+    switchports_d = Inventory()
+    switchports_d.free_ports = FreePortIndex()
+    switchports_d.loader = ShardLoader(switchports_dir, manifest)
+    switchports_d.set_meta(manifest.get('meta', {}))
+    return switchports_d
+
+
+def dump_sharded_state(switchports_d, switchports_dir):
+
+    '''
+    Dumps instances of SwitchPort to a sharded state directory.
+
+    Only shards whose content changed are rewritten, the hash of each shard
+    is kept in the manifest. Switches of a lazily loaded inventory that were
+    never looked up are left as they are.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    switchports_dir: string, path of the state directory
+
+    Returns
+    -------
+    None
+    '''
+    import hashlib
+    import json
+    from urllib.parse import quote
+
+    logger = logging.getLogger()
+    loader = getattr(switchports_d, 'loader', None)
+    if loader is not None and \
+            os.path.abspath(loader.path) != os.path.abspath(switchports_dir):
+        switchports_d.load_all()
+        loader = None
+    manifest_file = os.path.join(switchports_dir, SHARD_MANIFEST)
+    old_switches = dict()
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as infile:
+            old_switches = json.load(infile).get('switches', {})
+    os.makedirs(switchports_dir, exist_ok=True)
+    if isinstance(switchports_d, Inventory):
+        free_ports = switchports_d.reindex()
+    else:
+        free_ports = FreePortIndex.from_switchports(switchports_d)
+    # Unloaded switches of a lazy inventory keep their shard
+    switches = dict(old_switches) if loader is not None else dict()
+    written = 0
+    for switch_id, ports_d in switchports_d.items():
+        shard = {'switch_id': switch_id,
+                 'ports': [[port.port_id, port.status, port.vlan,
+                            port.description, port.configuration, port.final]
+                           for port in sort_ports(ports_d).values()],
+                 'free_ports': free_ports.ports(switch_id)}
+        data = json.dumps(shard, separators=(',', ':')).encode()
+        digest = hashlib.sha1(data).hexdigest()
+        entry = {'file': quote(switch_id, safe='') + '.json', 'hash': digest}
+        switches[switch_id] = entry
+        if old_switches.get(switch_id) == entry:
+            continue
+        tmp_file = os.path.join(switchports_dir, entry['file'] + '.tmp')
+        with open(tmp_file, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(tmp_file, os.path.join(switchports_dir, entry['file']))
+        written += 1
+    for switch_id, entry in old_switches.items():
+        if switch_id not in switches:
+            shard_file = os.path.join(switchports_dir, entry['file'])
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+    meta = dict()
+    if isinstance(switchports_d, Inventory):
+        meta = switchports_d.get_meta()
+        # Free ports are kept in the shards
+        del meta['free_ports']
+    manifest = {'format': SHARDED_FORMAT, 'version': SHARDED_VERSION,
+                'switches': switches, 'meta': meta}
+    with open(manifest_file + '.tmp', 'w') as outfile:
+        json.dump(manifest, outfile, separators=(',', ':'))
+    os.replace(manifest_file + '.tmp', manifest_file)
+    if loader is not None:
+        loader.manifest = manifest
+    logger.info('Wrote %s of %s shards', written, len(switches))
+
+
+# Maps the --CONFILE extension to the (load, dump, keeps_meta) tuple for that
+# backend. keeps_meta is True if the backend saves the Inventory indexes,
+# which the move journal relies on.
+STATE_BACKENDS = {
+    '.yaml': (load_yaml_state, dump_yaml_state, False),
+    '.yml': (load_yaml_state, dump_yaml_state, False),
+    '.db': (load_sqlite_state, dump_sqlite_state, True),
+    '.sqlite': (load_sqlite_state, dump_sqlite_state, True),
+    '.json': (load_columnar_state, dump_columnar_state, True),
+    '.shards': (load_sharded_state, dump_sharded_state, True),
+}
+
+
+def get_state_backend(confile):
+
+    '''
+    Select the state backend from the extension of confile.
+
+    Parameters
+    ----------
+    confile: string passed by docopt, filename of the state file
+
+    Returns
+    -------
+    (load, dump, keeps_meta) : tuple from STATE_BACKENDS
+    '''
+    extension = os.path.splitext(confile)[1].lower()
+    try:
+        return STATE_BACKENDS[extension]
+    except KeyError:
+        raise ValueError('No state backend for ' + confile + ', use one of '
+                         + ', '.join(sorted(STATE_BACKENDS)))
+
+
+@profiled()
+def dump_switchports(switchports_d, confdir, confile):
+
+    '''
+    Dumps instances of Switchport to the state file, in the format selected
+    by the extension of confile.
+
+    A full dump is a new snapshot that already holds every journaled move,
+    so any move journal next to the state file is removed.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    confdir: string passed by docopt, the direcotry the file will be saved in
+    confile: string passed by docopt, the filename that instances of SwitchPort
+            will be saved in
+    Returns
+    -------
+    None
+
+    '''
+    switchport_file = os.path.join(
+                    os.getcwd(), confdir, confile)
+    logging.info('switchport_file: %s', switchport_file)
+    dump = get_state_backend(confile)[1]
+    if STATE_CACHE is not None and \
+            STATE_CACHE.defer(switchports_d, confdir, confile):
+        # serve saves it later
+        print('Switchport configuration generated, stored in directory',
+              confdir, ', file', confile)
+        return
+    if isinstance(switchports_d, Inventory) and dump is not dump_sharded_state:
+        # Only a sharded directory can keep the switches never looked up
+        switchports_d.load_all()
+    os.makedirs(os.path.dirname(switchport_file), exist_ok=True)
+    dump(switchports_d, switchport_file)
+    if isinstance(switchports_d, Inventory):
+        switchports_d.journal_base = switchports_d.journal_seq
+    journal_file = get_journal_file(confdir, confile)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+    print('Switchport configuration generated, stored in directory', confdir,
+        ', file', confile)
+
+@profiled()
+def load_switchports(confdir,confile, as_of=None):
+
+    '''
+    Loads instances of SwitchPort from the state file, in the format selected
+    by the extension of confile, then replays the move journal next to it.
+
+    Parameters
+    ----------
+    confdir: string passed by docopt, the directory the file will be read from
+    confile: string passed by docopt, the file with instances of
+        SwitchPort
+    as_of: integer, replay the move journal only up to this entry. The
+        entries before the last snapshot can not be replayed.
+
+    Returns
+    -------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    '''
+    logger = logging.getLogger()
+    cached = STATE_CACHE is not None and as_of is None
+    if cached:
+        switchports_d = STATE_CACHE.get(confdir, confile)
+        if switchports_d is not None:
+            logger.info('### Using SwitchPort dictionary of Dir %s, file %s '
+                        'kept by serve', confdir, confile)
+            return switchports_d
+    switchports_file = os.path.join(confdir, confile)
+    load, dump, keeps_meta = get_state_backend(confile)
+    switchports_d = load(switchports_file)
+    if as_of is not None and as_of < switchports_d.journal_seq:
+        raise ValueError('Journal entry ' + str(as_of) + ' is older than the '
+                         'snapshot in ' + switchports_file + ', which holds '
+                         'entries up to ' + str(switchports_d.journal_seq))
+    if keeps_meta:
+        replay_journal(switchports_d, get_journal_file(confdir, confile),
+                       as_of)
+    logger.debug('switchport dictionary: %s ', lazy_summary(switchports_d))
+    logger.info('### Loaded SwitchPort dictionary from Dir %s, file %s',
+                confdir, confile)
+    if cached:
+        STATE_CACHE.put(switchports_d, confdir, confile)
+    return switchports_d
+
+# update_switchports compacts the move journal into a new snapshot once it
+# holds more than COMPACT_ENTRIES entries
+COMPACT_ENTRIES = 10000
+
+def get_journal_file(confdir, confile):
+
+    '''
+    Return the path of the move journal kept next to a state file.
+    '''
+    return os.path.join(confdir, confile + '.journal')
+
+@profiled()
+def apply_move(switchports_d, from_switch, from_port, to_switch, to_port,
+               vlan, description):
+
+    '''
+    Apply one host move to switchports_d: the host configuration and .final
+    go to the new port, the old port is blanked and becomes free.
+
+    Parameters
+    ----------
+    switchports_d : Inventory, dictionary of dictionaries, each subdictionary
+            is ('<interface>', SwitchPort())
+    from_switch, from_port: strings, where the host was
+    to_switch, to_port: strings, where the host is now
+    vlan: string, vlan of the host
+    description: string, description of the host
+
+    Returns
+    -------
+    final : string, the .final carried over to the new port
+
+    Mutates
+    -------
+    switchports_d
+    '''
+    from_port = canonical_port(from_port)
+    to_port = canonical_port(to_port)
+    old = switchports_d[from_switch][from_port]
+    new = switchports_d[to_switch][to_port]
+    aggregates = switchports_d.get_aggregates()
+
+    aggregates.remove(old)
+    aggregates.remove(new)
+
+    # Need to move the final attribute with the rest of the config
+    # Do this first as .final on the old interface is getting blanked
+    new.vlan, new.description, new.status, new.final =\
+            sys.intern(vlan), description, 'connected', old.final
+
+    #Blank everything, it's a free port now
+    old.vlan, old.description, old.status, old.final =\
+    '','', 'disabled',''
+    # Keep the free port index in step with the status flips
+    free_ports = switchports_d.reindex()
+    free_ports.claim(to_switch, to_port)
+    free_ports.release(from_switch, from_port)
+    aggregates.add(old)
+    aggregates.add(new)
+    switchports_d.changed(from_switch, to_switch)
+    return new.final
+
+@profiled(rows=int)
+def replay_journal(switchports_d, journal_file, as_of=None):
+
+    '''
+    Apply the entries of a move journal newer than the snapshot in
+    switchports_d.
+
+    Parameters
+    ----------
+    switchports_d : Inventory loaded from the snapshot
+    journal_file: string, path of the journal, it need not exist
+    as_of: integer, the last entry to apply, all entries if None
+
+    Returns
+    -------
+    count : integer, the number of entries applied
+    '''
+    import json
+
+    logger = logging.getLogger()
+    if not os.path.exists(journal_file):
+        return 0
+    count = 0
+    with open(journal_file, 'r') as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            seq = entry['seq']
+            if seq <= switchports_d.journal_seq:
+                continue
+            if as_of is not None and seq > as_of:
+                break
+            apply_move(switchports_d, entry['from_switch'],
+                       entry['from_port'], entry['to_switch'],
+                       entry['to_port'], entry['vlan'], entry['description'])
+            switchports_d.journal_seq = seq
+            count += 1
+    logger.info('Replayed %s journal entries from %s', count, journal_file)
+    return count
+
+def append_journal(journal_file, entries):
+
+    '''
+    Append move entries to a journal and sync it to disk.
+
+    Parameters
+    ----------
+    journal_file: string, path of the journal
+    entries: list of dictionaries, as built by update_switchports
+
+    Returns
+    -------
+    None
+    '''
+    import json
+
+    with open(journal_file, 'a') as outfile:
+        for entry in entries:
+            outfile.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+def compact_switchports(confdir, confile):
+
+    '''
+    Fold the move journal of a state file into a new snapshot.
+
+    Parameters
+    ----------
+    confdir: string passed by docopt, the directory of the state file
+    confile: string passed by docopt, the state file
+
+    Returns
+    -------
+    None
+
+    Calls
+    -----
+    load_switchports(confdir, confile)
+    dump_switchports(switchports_d, confdir, confile)
+    '''
+    logger = logging.getLogger()
+    switchports_d = load_switchports(confdir, confile)
+    logger.info('Compacting %s journal entries into %s',
+                switchports_d.journal_seq - switchports_d.journal_base, confile)
+    dump_switchports(switchports_d, confdir, confile)
+
+def convert_switchports(newconfile, confdir, confile, as_of=None):
+
+    '''
+    One-shot conversion of a state file to another backend, for example from
+    the original YAML dump to SQLite.
+
+    Parameters
+    ----------
+    newconfile: string passed by docopt, filename to write the state to. Its
+                extension selects the new backend.
+    confdir:    string passed by docopt, directory holding both state files
+    confile:    string passed by docopt, the existing state file
+    as_of:      integer, write the state as of this move journal entry
+
+    Returns
+    -------
+    None
+
+    Calls
+    -----
+    load_switchports(confdir, confile, as_of)
+    dump_switchports(switchports_d, confdir, newconfile)
+    '''
+    logger = logging.getLogger()
+    logger.info('Converting %s to %s in dir %s', confile, newconfile, confdir)
+    switchports_d = load_switchports(confdir, confile, as_of)
+    dump_switchports(switchports_d, confdir, newconfile)
+
+# Fields read from the CSVs of mark and update, with the headers each field
+# may go by. Headers are matched ignoring case, spaces and underscores.
+MARK_COLUMNS = {'switch': ('switch', 'switch_id'),
+                'port': ('port', 'interface'),
+                'final': ('final',)}
+UPDATE_COLUMNS = {'description': ('description', 'host'),
+                  'from_switch': ('from switch',),
+                  'from_port': ('from interface', 'from port'),
+                  'to_switch': ('to switch',),
+                  'to_port': ('to interface', 'to port'),
+                  'vlan': ('vlan',)}
+
+# Positions of the columns of MARK_COLUMNS and UPDATE_COLUMNS in the CSVs
+# read before columns were found by their headers. They are used for a CSV
+# whose header names none of the columns.
+MARK_POSITIONS = (1, 3, 2)
+UPDATE_POSITIONS = (0, 1, 2, 4, 5, 6)
+
+
+def get_header_key(name):
+    return ''.join(name.lower().replace('_', ' ').split())
+
+
+def read_columns(csvfile, columns_d, positions=None):
+
+    '''
+    Read the rows of a CSV by the headers of its columns rather than by
+    their position.
+
+    A header naming none of the columns is taken for one of the CSVs written
+    for older copies of migrate.py, and its columns are read by positions,
+    with a warning. A header naming only some of them is an error.
+
+    Parameters
+    ----------
+    csvfile:    string, path of the CSV
+    columns_d:  dictionary of field, tuple of the headers it may go by
+    positions:  tuple of the position of every field of columns_d, or None
+                to raise ValueError when the header names none of them
+
+    Returns
+    -------
+    rows : list of (number, values), number being the row of the CSV, the
+           header is row 1, and values a tuple of the fields of columns_d
+    errors : list of (number, message) of the rows missing fields
+    '''
+    from operator import itemgetter
+
+    with open(csvfile, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = [get_header_key(name) for name in next(reader, [])]
+        indexes, missing = [], []
+        for field, names in columns_d.items():
+            for name in names:
+                if get_header_key(name) in header:
+                    indexes.append(header.index(get_header_key(name)))
+                    break
+            else:
+                missing.append(names[0])
+        if positions is not None and len(missing) == len(columns_d):
+            logging.getLogger().warning(
+                '%s has none of the headers %s, reading columns %s by '
+                'position', csvfile, ', '.join(
+                    names[0] for names in columns_d.values()),
+                ', '.join(str(index + 1) for index in positions))
+            indexes, missing = list(positions), []
+        if missing:
+            raise ValueError(csvfile + ' has no ' + ', '.join(missing)
+                             + ' column')
+        get_values = itemgetter(*indexes)
+        width = max(indexes) + 1
+        rows, errors = [], []
+        for number, row in enumerate(reader, 2):
+            if len(row) >= width:
+                rows.append((number, get_values(row)))
+            elif any(row):
+                errors.append((number, 'has %s columns, %s are needed'
+                               % (len(row), width)))
+    return rows, errors
+
+
+def find_port(switchports_d, switch_id, port_id):
+
+    '''
+    Return (port, None) for the SwitchPort of switch_id and port_id, or
+    (None, message) if there is no such port.
+    '''
+    try:
+        ports_d = switchports_d[switch_id]
+    except KeyError:
+        return None, 'unknown switch ' + switch_id
+    port = ports_d.get(port_id)
+    if port is None:
+        return None, 'unknown port ' + switch_id + ':' + port_id
+    return port, None
+
+
+def raise_row_errors(csvfile, errors):
+
+    '''
+    Log every error found in the rows of csvfile, then raise ValueError.
+    '''
+    logger = logging.getLogger()
+    for number, message in sorted(errors):
+        logger.error('%s row %s: %s', csvfile, number, message)
+    raise ValueError('%s rows of %s have errors, nothing was applied'
+                     % (len(errors), csvfile))
+
+
+@profiled()
+def check_marks(switchports_d, rows):
+
+    '''
+    Check the rows of a mark CSV against switchports_d, without changing it.
+
+    Parameters
+    ----------
+    switchports_d : Inventory
+    rows : list of (number, (switch_id, port_id, final)), from read_columns
+
+    Returns
+    -------
+    marks : list of (switch_id, port_id, final) to apply
+    errors : list of (number, message), a port that is unknown or marked
+             with two different finals
+    '''
+    marks, errors = [], []
+    marked_d = dict()
+    for number, (switch_id, port_id, final) in rows:
+        port_id = canonical_port(port_id)
+        port, error = find_port(switchports_d, switch_id, port_id)
+        if error is None:
+            first, first_final = marked_d.setdefault((switch_id, port_id),
+                                                     (number, final))
+            if first_final != final:
+                error = '%s:%s marked with final %s, row %s marks it with %s' \
+                        % (switch_id, port_id, final, first, first_final)
+        if error is None:
+            marks.append((switch_id, port_id, final))
+        else:
+            errors.append((number, error))
+    return marks, errors
+
+
+@profiled()
+def check_moves(switchports_d, rows):
+
+    '''
+    Check the rows of an update CSV against switchports_d, without changing
+    it. Each row is checked against the state as the rows before it leave
+    it, so that a port freed by a row can be taken by a later one, and a
+    host parked by a row can be moved on by a later one, as in the run
+    sheets of final and flatten. Rows are matched to ports by switch, port
+    and status. A description other than the one held is logged and then
+    written, so that a corrected run sheet can be applied.
+
+    Parameters
+    ----------
+    switchports_d : Inventory
+    rows : list of (number, (description, from_switch, from_port, to_switch,
+           to_port, vlan)), from read_columns
+
+    Returns
+    -------
+    moves : list of (from_switch, from_port, to_switch, to_port, vlan,
+            description) to apply
+    errors : list of (number, message), for unknown switches and ports, a
+             source that is already disabled, and a destination that is not a free port, being in use, reserved
+             for a host that is not up or marked with a final, unless an
+             earlier row freed it, or that is taken by an earlier row
+    '''
+    logger = logging.getLogger()
+    moves, errors = [], []
+    # Ports the rows so far freed, with the row, and took a host to, with
+    # the row and the description of the host
+    freed_d, taken_d = dict(), dict()
+    for number, (description, from_switch, from_port, to_switch, to_port,
+                 vlan) in rows:
+        from_port, to_port = canonical_port(from_port), canonical_port(to_port)
+        source_key, destination_key = (from_switch, from_port), \
+                (to_switch, to_port)
+        source, error = find_port(switchports_d, from_switch, from_port)
+        if error is None:
+            destination, error = find_port(switchports_d, to_switch, to_port)
+        if error is not None:
+            pass
+        elif source_key == destination_key:
+            error = 'moves %s:%s onto itself' % source_key
+        elif source_key in freed_d:
+            error = 'source %s:%s was freed by row %s' \
+                    % (source_key + (freed_d[source_key],))
+        elif source_key not in taken_d and source.status == 'disabled':
+            error = 'source %s:%s is already disabled' % source_key
+        elif destination_key in taken_d:
+            error = 'destination %s:%s is taken by row %s' \
+                    % (destination_key + (taken_d[destination_key][0],))
+        elif destination_key in freed_d:
+            pass
+        elif destination.status == 'connected':
+            error = 'destination %s:%s is in use by %s' \
+                    % (destination_key + (destination.description,))
+        elif destination.status != 'disabled':
+            # Configured for a host that is not up, so not a free port
+            error = 'destination %s:%s is reserved, status %s' \
+                    % (destination_key + (destination.status,))
+        elif destination.final:
+            error = 'destination %s:%s is marked with final %s' \
+                    % (destination_key + (destination.final,))
+        if error is not None:
+            errors.append((number, error))
+            continue
+        held = taken_d[source_key][1] if source_key in taken_d \
+            else source.description
+        if held != description:
+            # A corrected run sheet may fix a description, it is written
+            logger.warning('%s:%s holds %r, row %s describes it as %r',
+                           from_switch, from_port, held, number, description)
+        taken_d.pop(source_key, None)
+        freed_d.pop(destination_key, None)
+        freed_d[source_key] = number
+        taken_d[destination_key] = (number, description)
+        moves.append((from_switch, from_port, to_switch, to_port, vlan,
+                      description))
+    return moves, errors
+
+def mark_switchports_final(finalcsv, confdir, confile):
+
+    '''
+    Critical hosts have been assigned to specific switches. At the end of the
+    task, hosts needto be on the correct switch.
+
+    Function takes in a csv file and writes it to a list. Every row is
+    checked before any port is marked, and the errors of all rows are
+    reported together, so a bad CSV leaves the state as it was.
+
+    Parameters
+    ----------
+    finalcsv: string passed by docopt, relative path where csv file is located.
+                Matching on switch and port as there are multiple duplicate
+                descriptions. Columns are found by their headers, see
+                MARK_COLUMNS: the current switch, the current port and the
+                final switch to migrate to. Without any of those headers
+                they are columns 2, 4 and 3, see MARK_POSITIONS.
+    confdir: string passed by docopt, directory where the yaml file with
+                instances of SwitchPort will is loaded from
+    confile: string passed by docopt, file with instances of SwitchPort
+
+    Returns
+    -------
+    None
+
+    Mutates
+    -------
+    switchports_d
+
+    Calls
+    -----
+    dump_switchports
+    '''
+
+    logger=logging.getLogger()
+    logging.info('### Getting switchport dictionary ###')
+    switchports_d = load_switchports(confdir,confile)
+    aggregates = switchports_d.get_aggregates()
+    logger.debug('switchports_d: %s', lazy_summary(switchports_d))
+    logger.info('Getting Final State information')
+    rows, errors = read_columns(finalcsv, MARK_COLUMNS, MARK_POSITIONS)
+    logging.info('Read %s rows from CSV %s', len(rows), finalcsv)
+    marks, check_errors = check_marks(switchports_d, rows)
+    if errors or check_errors:
+        raise_row_errors(finalcsv, errors + check_errors)
+    free_ports = switchports_d.reindex()
+    trace = PortTracer(logger)
+    for cur_switch, cur_port, final_switch in marks:
+        port = switchports_d[cur_switch][cur_port]
+        aggregates.remove(port)
+        port.final = sys.intern(final_switch)
+        aggregates.add(port)
+        # A marked port is not handed out, see is_free_port
+        if is_free_port(port):
+            free_ports.release(cur_switch, cur_port)
+        else:
+            free_ports.claim(cur_switch, cur_port)
+        switchports_d.changed(cur_switch)
+        if trace.enabled:
+            trace('Switch:%s, port:%s marked with final:%s',
+                  cur_switch, cur_port, final_switch)
+    logging.info('%s ports marked', len(marks))
+    dump_switchports(switchports_d, confdir, confile)
+
+@profiled()
+def assign_final_state(switchports_d, free_ports, source_t, destination_t):
+
+    '''
+    Assign every host on the source switches whose .final is one of the
+    destination switches a free port on its final switch, in a single pass.
+
+    Each host can only go to one switch, and every free port on a switch is
+    as good as any other, so the assignment problem reduces to filling each
+    final switch up to its free port count. Hosts are taken in source switch
+    and port order, and ports from free_ports in index order, so the output
+    is deterministic. Hosts beyond the capacity of their final switch are
+    yielded as unplaceable rather than dropped.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    free_ports : FreePortIndex of the destination switches, assigned ports
+            are popped from it
+    source_t: tuple of source switch IDs
+    destination_t: tuple of destination switch IDs
+
+    Yields
+    ------
+    (from_port, to_port) : tuple of SwitchPort, to_port is None when the
+            final switch of from_port has no free port left
+    '''
+    logger = logging.getLogger()
+    destination_s = set(destination_t)
+    assigned = unplaceable = 0
+    for source in source_t:
+        for source_value in switchports_d[source].values():
+            # if source_value.final matches its own switch_id, it's in the
+            # right place
+            final = source_value.final
+            if final not in destination_s or final == source_value.switch_id:
+                continue
+            to_port_id = free_ports.pop(final)
+            if to_port_id is None:
+                unplaceable += 1
+                yield (source_value, None)
+                continue
+            assigned += 1
+            yield (source_value, switchports_d[final][to_port_id])
+    logger.info('%s hosts assigned to final switch, %s unplaceable',
+                assigned, unplaceable)
+
+@profiled()
+def match_final_state(switchports_d, free_ports, source_t, destination_t,
+                      renderer=None, moved=None):
+
+    '''
+    Matches attritbute final of instances of SwitchPort, with
+    to_switch. Ports are assigned by assign_final_state and each match is
+    passed off to configure_ports.
+
+    Hosts whose final switch has no free port left are logged as
+    unplaceable, and keep their status so they can still be moved by the
+    allocator.
+
+    This is a generator, rows are yielded as soon as they are decided. Matched
+    hosts are only added to moved as the rows are consumed, so the generator
+    must be exhausted before allocating the remaining hosts. The state itself
+    is not changed, so it can be planned against again.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    free_ports : FreePortIndex of the destination switches, ports are popped
+            from it as they are allocated
+            source_t: string of comma separated switch IDs
+            destination_t: string of comma separated switch IDs
+    renderer : PortRenderer passed on to configure_ports
+    moved : set, the SwitchPorts of matched hosts are added to it
+
+    Yields
+    ------
+    final_run_sheet row : list of elements:
+        from_port.switch_id : string
+        from_port.port_id : string
+        disable_config : string
+        to_port.switch_id : string
+        to_port.port_id : string
+        from_port.vlan : string
+        enable_config : string
+        Final : 'Final'
+
+    '''
+
+
+    logger = logging.getLogger()
+    count = 0
+    trace = PortTracer(logger)
+    for source_value, to_port in assign_final_state(switchports_d, free_ports,
+                                                    source_t, destination_t):
+        if to_port is None:
+            logger.warning('No free port on final switch %s for %s:%s (%s)',
+                    source_value.final, source_value.switch_id,
+                    source_value.port_id, source_value.description)
+            continue
+        if trace.enabled:
+            trace('source_value.final: %s, to_port %s:%s',
+                  source_value.final, to_port.switch_id, to_port.port_id)
+        count += 1
+        if moved is not None:
+            moved.add(source_value)
+        configured_ports = configure_ports((source_value, to_port), renderer)
+        configured_ports.append('Final')
+        yield configured_ports
+    logging.info('%s ports matched to final switch', count)
+
+@profiled()
+def move_critical_hosts(switchports_d, free_ports, source_t, destination_t,
+                        policy='most-free', renderer=None, moved=frozenset()):
+
+    '''
+    Spread the critical hosts left on the source switches over the free
+    ports of the destination switches, with the Allocator for policy.
+
+    This is a generator, rows are yielded as soon as they are decided. The
+    allocator is created on the first row, so free_ports reflects any
+    matches to final switches made before.
+
+    Parameters
+    ----------
+    switchports_d : dictionary of dictionaries, each subdictionary is
+            ('<interface>', SwitchPort())
+    free_ports : FreePortIndex of the destination switches, ports are popped
+            from it as they are allocated
+    source_t: tuple of source switch IDs
+    destination_t: tuple of destination switch IDs
+    policy: string, a key of ALLOCATION_POLICIES
+    renderer : PortRenderer passed on to configure_ports
+    moved : set of SwitchPorts already moved, such as by match_final_state
+
+    Yields
+    ------
+    run sheet row : list, as returned by configure_ports
+    '''
+    logger = logging.getLogger()
+    trace = PortTracer(logger)
+    for source_port, to_port in allocate_critical_hosts(
+            switchports_d, free_ports, source_t, destination_t, policy, moved):
+        if to_port is None:
+            logger.warning('No free port left for %s:%s',
+                    source_port.switch_id, source_port.port_id)
+            continue
+        if trace.enabled:
+            trace('Matched vlan %s, source_port %s, to_port: %s',
+                  source_port.vlan, source_port, to_port)
+        ports = (source_port, to_port)
+        yield configure_ports(ports, renderer)
+
+def allocate_critical_hosts(switchports_d, free_ports, source_t, destination_t,
+                            policy='most-free', moved=frozenset()):
+
+    '''
+    Allocate the critical hosts left on the source switches a free port on
+    the destination switches, with the Allocator for policy. This is the
+    plan of move_critical_hosts, without the configuration.
+
+    Yields
+    ------
+    (source_port, to_port) : tuple of SwitchPort, to_port is None when no
+            destination has a free port left
+    '''
+    count = 0
+    critical = get_critical_rules()
+    allocator = get_allocator(policy, destination_t, free_ports, switchports_d)
+    for source in source_t:
+        for source_port in switchports_d[source].values():
+            if critical(source_port) and source_port not in moved:
+                count += 1
+                yield (source_port, allocator.allocate(source_port))
+    logging.info('%s not mached to final swtich', count)
+
+class Allocator(abc.ABC):
+    '''
+    Allocates free ports on the destination switches to hosts being moved.
+    Each policy is a subclass giving the priority of a destination.
+
+    Each policy keeps the destination switches in a priority queue, so that
+    every decision costs O(log D) for D destination switches. Keys end with
+    the position of the switch in <destination>, so ties always go to the
+    switch listed first and runs are repeatable.
+
+    destination_t:  tuple of destination switch ids
+    free_ports:     FreePortIndex of the destination switches, allocated
+                    ports are popped from it
+    switchports_d:  dictionary of dictionaries, each subdictionary is
+                    ('<interface>', SwitchPort())
+    allocated_l:    number of ports allocated on each destination
+    '''
+
+    def __init__(self, destination_t, free_ports, switchports_d):
+
+        self.destination_t = destination_t
+        self.free_ports = free_ports
+        self.switchports_d = switchports_d
+        self.allocated_l = [0] * len(destination_t)
+        # Heap entries whose key no longer matches key_l[idx] are stale and
+        # are dropped when they reach the top.
+        self.key_l = [None] * len(destination_t)
+        self.heap = []
+        for idx, switch_id in enumerate(destination_t):
+            if free_ports.count(switch_id):
+                self.key_l[idx] = self.priority(idx)
+                self.heap.append((self.key_l[idx], idx))
+        heapq.heapify(self.heap)
+
+    @abc.abstractmethod
+    def priority(self, idx):
+
+        '''
+        Heap key of destination idx, the lowest key is allocated first.
+        '''
+
+    def choose(self, source_port):
+
+        '''
+        Return the index in destination_t to allocate source_port to, or None
+        if every destination is full.
+        '''
+        heap = self.heap
+        while heap and heap[0][0] != self.key_l[heap[0][1]]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][1]
+
+    def allocate(self, source_port):
+
+        '''
+        Allocate a free port to source_port.
+
+        Returns
+        -------
+        to_port : SwitchPort on a destination switch, or None if there are no
+                  free ports left
+        '''
+        idx = self.choose(source_port)
+        if idx is None:
+            return None
+        switch_id = self.destination_t[idx]
+        to_port_id = self.free_ports.pop(switch_id)
+        self.allocated_l[idx] += 1
+        if self.free_ports.count(switch_id):
+            self.key_l[idx] = self.priority(idx)
+            heapq.heappush(self.heap, (self.key_l[idx], idx))
+        else:
+            self.key_l[idx] = None
+        return self.switchports_d[switch_id][to_port_id]
+
+
+class MostFreeAllocator(Allocator):
+    '''
+    Allocate from the destination with the most free ports left.
+    '''
+
+    def priority(self, idx):
+        return (-self.free_ports.count(self.destination_t[idx]), idx)
+
+
+class RoundRobinAllocator(Allocator):
+    '''
+    Allocate from each destination in turn, skipping full switches.
+    '''
+
+    def priority(self, idx):
+        return (self.allocated_l[idx], idx)
+
+
+class WeightedAllocator(Allocator):
+    '''
+    Allocate in proportion to the size of each destination switch, so a
+    48 port switch takes twice the hosts of a 24 port switch.
+    '''
+
+    def priority(self, idx):
+        capacity = len(self.switchports_d[self.destination_t[idx]]) or 1
+        return ((self.allocated_l[idx] + 1) / capacity, idx)
+
+
+class VlanAllocator(MostFreeAllocator):
+    '''
+    Keep hosts of the same vlan on the same destination switch while it has
+    free ports. The first host of each vlan goes to the destination with
+    the most free ports.
+    '''
+
+    def __init__(self, destination_t, free_ports, switchports_d):
+
+        super().__init__(destination_t, free_ports, switchports_d)
+        self.vlan_d = dict()
+
+    def choose(self, source_port):
+        idx = self.vlan_d.get(source_port.vlan)
+        if idx is None or self.key_l[idx] is None:
+            idx = super().choose(source_port)
+            if idx is not None:
+                self.vlan_d[source_port.vlan] = idx
+        return idx
+
+
+# Maps --POLICY to the Allocator implementing it
+ALLOCATION_POLICIES = {
+    'most-free': MostFreeAllocator,
+    'round-robin': RoundRobinAllocator,
+    'weighted': WeightedAllocator,
+    'vlan': VlanAllocator,
+}
+
+
+def get_allocator(policy, destination_t, free_ports, switchports_d):
+
+    '''
+    Create the Allocator for policy.
+
+    Parameters
+    ----------
+    policy:         string passed by docopt, a key of ALLOCATION_POLICIES
+    destination_t:  tuple of destination switch ids
+    free_ports:     FreePortIndex of the destination switches
+    switchports_d:  dictionary of dictionaries, each subdictionary is
+                    ('<interface>', SwitchPort())
+
+    Returns
+    -------
+    allocator : instance of Allocator
+    '''
+    try:
+        allocator_class = ALLOCATION_POLICIES[policy]
+    except KeyError:
+        raise ValueError('Unknown allocation policy ' + policy + ', use one of '
+                         + ', '.join(sorted(ALLOCATION_POLICIES)))
+    return allocator_class(destination_t, free_ports, switchports_d)
+
+# Built in port profile. Templates are str.format strings taking the fields
+# in TEMPLATE_FIELDS. Files in --TEMPLATES override or add to these.
+DEFAULT_ENABLE_TEMPLATE = (
+    '! Move {old_switch}:{old_port}to{new_switch}:{new_port}\n'
+    '!show interface {new_port}status\n'
+    '! If status is disabled, proceed with configuration\n'
+    'conf t\n'
+    ' interface {new_port}\n'
+    ' description {description}\n'
+    ' switchport access vlan {vlan}\n'
+    ' switchport trunk encapsulation dot1q\n'
+    ' switchport mode access\n'
+    ' switchport nonegotiate\n'
+    ' switchport port-security maximum 3\n'
+    ' switchport port-security\n'
+    ' switchport port-security aging time 2\n'
+    ' switchport port-security violation restrict\n'
+    ' switchport port-security aging type inactivity\n'
+    ' srr-queue bandwidth share 1 42 53 4\n'
+    ' srr-queue bandwidth shape 300 0 0 0\n'
+    ' priority-queue out\n'
+    ' spanning-tree portfast\n'
+    ' service-policy input ACCESS-CONDTRUST-PMAP\n'
+    ' no shut\n'
+    ' end\n'
+    '!\n')
+
+DEFAULT_DISABLE_TEMPLATE = (
+    '! disable configuration for {old_switch}:{old_port}\n'
+    'show interface {old_port}status\n'
+    '! If notconnect and patch has been moved, disable\n'
+    'conf t\n'
+    ' interface {old_port}\n'
+    ' description disabled\n'
+    ' shutdown\n'
+    ' end\n'
+    '!\n')
+
+TEMPLATE_FIELDS = ('old_switch', 'old_port', 'new_switch', 'new_port', 'vlan',
+                   'description')
+
+# Conversions of template fields, as in {description!r}
+TEMPLATE_CONVERSIONS = {'r': repr, 's': str, 'a': ascii}
+
+
+class PortTemplate():
+    '''
+    A port configuration template, parsed and checked once when it is
+    loaded.
+
+    The template is split into its literal text and its replacement fields
+    up front, so rendering a row only puts the values of the row between
+    the literals, rather than parsing the template again as str.format
+    would.
+
+    name:       String, name of the template, <profile>.enable or
+                <profile>.disable
+    text:       String, the template in str.format syntax
+    parts:      List of the literal text of the template, with None where a
+                field goes
+    fields:     List of (index in parts, field, format spec, conversion),
+                spec and conversion being None if the field has none
+    '''
+
+    __slots__ = ('name', 'text', 'parts', 'fields')
+
+    def __init__(self, name, text):
+
+        import string
+
+        self.name = name
+        self.text = text
+        self.parts = []
+        self.fields = []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if literal:
+                self.parts.append(literal)
+            if field is None:
+                continue
+            if field not in TEMPLATE_FIELDS:
+                raise ValueError('Unknown field {' + field + '} in template '
+                                 + name + ', use one of '
+                                 + ', '.join(TEMPLATE_FIELDS))
+            self.fields.append((len(self.parts), field, spec or None,
+                                conversion))
+            self.parts.append(None)
+
+    def render(self, **fields_d):
+
+        '''
+        Return the configuration for the TEMPLATE_FIELDS in fields_d, as
+        text.format(**fields_d) would.
+        '''
+        parts = self.parts.copy()
+        for index, field, spec, conversion in self.fields:
+            value = fields_d[field]
+            if conversion is not None:
+                value = TEMPLATE_CONVERSIONS[conversion](value)
+            if spec is not None:
+                # A spec can hold fields too, such as {description:{vlan}}
+                value = format(value, spec.format(**fields_d)
+                               if '{' in spec else spec)
+            parts[index] = value
+        try:
+            return ''.join(parts)
+        except TypeError:
+            # A field without a spec that is not a string
+            return ''.join(map(str, parts))
+
+
+class PortRenderer():
+    '''
+    Renders enable and disable port configurations from named port profiles.
+
+    A profile is a pair of templates. The built in 'default' profile is the
+    configuration this script has always generated. A template directory
+    can add profiles, or replace the default, with files named
+    <profile>.enable and <profile>.disable. An optional profiles.yaml in the
+    same directory maps switch ids, or shell style patterns of them, to a
+    profile, for example:
+
+        'distsw_3*': c3850
+        access_12: legacy
+
+    Switches that match no pattern use 'default'. The enable template is
+    picked by the switch the host moves to, the disable template by the
+    switch it moves from.
+
+    profiles_d:     Dictionary of profile name to (enable, disable) tuple of
+                    PortTemplate
+    switch_l:       List of (pattern, profile name) from profiles.yaml
+    '''
+
+    def __init__(self, templatedir=None):
+
+        self.profiles_d = {'default': (
+            PortTemplate('default.enable', DEFAULT_ENABLE_TEMPLATE),
+            PortTemplate('default.disable', DEFAULT_DISABLE_TEMPLATE))}
+        self.switch_l = []
+        self._switch_d = dict()
+        if templatedir:
+            self.load(templatedir)
+
+    def load(self, templatedir):
+
+        '''
+        Load and compile every template in templatedir.
+        '''
+        logger = logging.getLogger()
+        templates_d = dict()
+        for filename in sorted(os.listdir(templatedir)):
+            profile, kind = os.path.splitext(filename)
+            if kind not in ('.enable', '.disable'):
+                continue
+            with open(os.path.join(templatedir, filename)) as infile:
+                templates_d[(profile, kind)] = PortTemplate(filename,
+                                                            infile.read())
+        for profile in sorted({profile for profile, kind in templates_d}):
+            default_enable, default_disable = self.profiles_d['default']
+            self.profiles_d[profile] = (
+                templates_d.get((profile, '.enable'), default_enable),
+                templates_d.get((profile, '.disable'), default_disable))
+            logger.info('Loaded port profile %s from %s', profile,
+                        templatedir)
+        profiles_file = os.path.join(templatedir, 'profiles.yaml')
+        if os.path.exists(profiles_file):
+            import yaml
+            with open(profiles_file) as infile:
+                switch_d = yaml.safe_load(infile) or {}
+            for pattern, profile in switch_d.items():
+                if profile not in self.profiles_d:
+                    raise ValueError('Unknown port profile ' + str(profile)
+                                     + ' for ' + str(pattern) + ' in '
+                                     + profiles_file)
+                self.switch_l.append((str(pattern), profile))
+        self._switch_d.clear()
+
+    def profile(self, switch_id):
+
+        '''
+        Return the (enable, disable) templates for switch_id.
+        '''
+        templates = self._switch_d.get(switch_id)
+        if templates is None:
+            import fnmatch
+
+            name = 'default'
+            for pattern, profile in self.switch_l:
+                if fnmatch.fnmatchcase(switch_id, pattern):
+                    name = profile
+                    break
+            templates = self._switch_d[switch_id] = self.profiles_d[name]
+        return templates
+
+    def enable(self, old_switch, old_port, new_switch, new_port, vlan,
+               description):
+        return get_render_cache().render(self.profile(new_switch)[0],
+                                         old_switch, old_port, new_switch,
+                                         new_port, vlan, description)
+
+    def disable(self, old_switch, old_port, new_switch, new_port, vlan,
+                description):
+        return get_render_cache().render(self.profile(old_switch)[1],
+                                         old_switch, old_port, new_switch,
+                                         new_port, vlan, description)
+
+
+DEFAULT_RENDERER = PortRenderer()
+
+# Rendered configurations are kept up to this many characters, across runs
+RENDER_CACHE_CHARS = 32 * 2 ** 20
+RENDER_CACHE_FILE = 'render.marshal'
+RENDER_CACHE_VERSION = 1
+
+
+class RenderCache():
+    '''
+    Port configurations rendered by PortRenderer, saved under get_cache_dir
+    so that planning a wave again, in a later run, only renders the rows
+    whose inputs changed.
+
+    Configurations are keyed by the fingerprint of their template and the
+    TEMPLATE_FIELDS they were rendered with. A changed template, or a
+    profiles.yaml picking another one for a switch, misses without anything
+    being invalidated, and what was rendered from the old one ages out. The
+    least recently used configurations are evicted once the cache holds
+    more than max_chars characters.
+
+    path:           String, the file the cache is loaded from and saved to,
+                    or None to keep it in memory only
+    entries_d:      OrderedDict of key, configuration, least recently used
+                    first
+    chars:          Characters of the configurations in entries_d
+    max_chars:      Integer, the bound on chars
+    hits, misses:   Counters of the lookups since the cache was created
+    saved:          (hits, misses) when the cache was last saved
+    '''
+
+    __slots__ = ('path', 'entries_d', 'chars', 'max_chars', 'hits', 'misses',
+                 'saved', '_fingerprints_d')
+
+    def __init__(self, path=None, max_chars=RENDER_CACHE_CHARS):
+
+        from collections import OrderedDict
+
+        self.path = path
+        self.entries_d = OrderedDict()
+        self.chars = 0
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self.saved = (0, 0)
+        self._fingerprints_d = dict()
+
+    @classmethod
+    def load(cls, path, max_chars=RENDER_CACHE_CHARS):
+
+        '''
+        Return the cache saved to path, or an empty one if there is none
+        or it can not be read.
+        '''
+        import marshal
+
+        cache = cls(path, max_chars)
+        try:
+            with open(path, 'rb') as infile:
+                version, entries = marshal.load(infile)
+            if version == RENDER_CACHE_VERSION:
+                for key, config in entries:
+                    cache.entries_d[key] = config
+                    cache.chars += len(config)
+                cache.evict()
+        except (OSError, EOFError, ValueError, TypeError):
+            cache.entries_d.clear()
+            cache.chars = 0
+        return cache
+
+    def save(self):
+
+        '''
+        Save the cache to path, if anything was rendered since it was last
+        saved.
+        '''
+        import marshal
+
+        saved_misses = self.saved[1]
+        self.saved = (self.hits, self.misses)
+        if self.path is None or self.misses == saved_misses:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'wb') as outfile:
+                marshal.dump((RENDER_CACHE_VERSION,
+                              list(self.entries_d.items())), outfile)
+            os.replace(self.path + '.tmp', self.path)
+        except (OSError, ValueError):
+            # Not cacheable, such as a read only home
+            logging.getLogger().debug('Render cache not saved to %s',
+                                      self.path)
+
+    def fingerprint(self, template):
+
+        '''
+        Return the fingerprint of the text of template.
+        '''
+        fingerprint = self._fingerprints_d.get(template.text)
+        if fingerprint is None:
+            import hashlib
+
+            fingerprint = self._fingerprints_d[template.text] = sys.intern(
+                hashlib.sha1(template.text.encode()).hexdigest()[:16])
+        return fingerprint
+
+    def evict(self):
+        entries_d = self.entries_d
+        while self.chars > self.max_chars:
+            self.chars -= len(entries_d.popitem(last=False)[1])
+
+    def render(self, template, old_switch, old_port, new_switch, new_port,
+               vlan, description):
+
+        '''
+        Return the configuration of template for the fields, rendering it
+        only if it is not cached.
+        '''
+        key = (self.fingerprint(template), old_switch, old_port, new_switch,
+               new_port, vlan, description)
+        entries_d = self.entries_d
+        config = entries_d.get(key)
+        if config is not None:
+            entries_d.move_to_end(key)
+            self.hits += 1
+            return config
+        self.misses += 1
+        config = entries_d[key] = template.render(
+            old_switch=old_switch, old_port=old_port, new_switch=new_switch,
+            new_port=new_port, vlan=vlan, description=description)
+        self.chars += len(config)
+        self.evict()
+        return config
+
+
+# The RenderCache, loaded the first time a configuration is rendered, and
+# kept by serve between commands
+RENDER_CACHE = None
+
+
+def get_render_cache():
+
+    '''
+    Return the RenderCache, loading it from get_cache_dir the first time.
+    '''
+    global RENDER_CACHE
+    if RENDER_CACHE is None:
+        RENDER_CACHE = RenderCache.load(os.path.join(get_cache_dir(),
+                                                     RENDER_CACHE_FILE))
+    return RENDER_CACHE
+
+
+def save_render_cache():
+
+    '''
+    Save the RenderCache, if it was used, and report its hits and misses
+    since it was last saved, in the log and in the profile of the command.
+    '''
+    cache = RENDER_CACHE
+    if cache is None:
+        return
+    hits, misses = (cache.hits - cache.saved[0], cache.misses - cache.saved[1])
+    if not (hits or misses):
+        return
+    logging.getLogger().info('Render cache: %s hits, %s misses, %s '
+                             'configurations cached', hits, misses,
+                             len(cache.entries_d))
+    if PROFILER is not None:
+        PROFILER.count('render_cache_hits', hits)
+        PROFILER.count('render_cache_misses', misses)
+    cache.save()
+
+
+# write_csv_file flushes the run sheet to disk on the first row and then
+# every FLUSH_ROWS rows
+FLUSH_ROWS = 1000
+
+
+def get_enable_port(old_switch, old_port, new_switch, new_port, vlan, description):
+
+    '''
+    Generate enable port configuration from the default port profile, as
+    DEFAULT_RENDERER.enable does.
+
+    Parameters
+    ----------
+
+    old_switch : string
+    old_port: string
+    new_switch: string
+    new_port: string
+    vlan: string
+    description : string
+
+    Returns
+    -------
+    enable_port_config : string
+
+    '''
+    return(DEFAULT_RENDERER.enable(old_switch, old_port, new_switch, new_port,
+                                   vlan, description))
+
+def get_disable_port(old_switch, old_port, new_switch, new_port, vlan, description):
+
+    '''
+    Generate disable port configuration from the default port profile, as
+    DEFAULT_RENDERER.disable does.
+
+    Parameters
+    ----------
+
+    old_switch : string
+    old_port: string
+    new_switch: string
+    new_port: string
+    vlan: string
+    description : string
+
+    Returns
+    -------
+    disable_port_config : string
+
+    '''
+    return(DEFAULT_RENDERER.disable(old_switch, old_port, new_switch, new_port,
+                                    vlan, description))
+
+
+@profiled()
+def configure_ports(ports, renderer=None):
+
+    '''
+    Configure ports, return list of configuruations.
+
+    Parameters
+    ----------
+    ports: tuple
+        (from_port, to_port)
+        from_port: instance of SwitchPorts
+        to_port: instance of SwitchPorts
+    renderer: PortRenderer with the port profiles to use, the built in
+        default profile if None
+
+    Returns
+    -------
+    run_sheet_list: list of elements:
+
+        from_port.switch_id : string
+        from_port.port_id : string
+        disable_config : string
+        to_port.switch_id : string
+        to_port.port_id : string
+        from_port.vlan : string
+        enable_config : string
+
+    Mutates
+    -------
+    Instances of SwitchPort
+    '''
+    from_port, to_port = ports[0], ports[1]
+    renderer = renderer or DEFAULT_RENDERER
+    # Generate the run sheet
+    disable_config = renderer.disable(from_port.switch_id,
+            from_port.port_id, to_port.switch_id, to_port.port_id,
+            from_port.vlan, from_port.description)
+    enable_config = renderer.enable(from_port.switch_id,from_port.port_id,
+            to_port.switch_id, to_port.port_id, from_port.vlan,
+            from_port.description)
+    run_sheet_list = ([from_port.description,from_port.switch_id, from_port.port_id,
+        disable_config, to_port.switch_id, to_port.port_id, from_port.vlan,
+        enable_config])
+    return(run_sheet_list)
+
+
+def move_interfaces(rundir, runsheet, confdir, confile, source, destination,
+                    policy='most-free', templatedir=None):
+
+    '''
+    Function generates enable and disable configuation for moving interfaces from one or more switches to one ore more
+    switches.
+
+    First, SwitchPorts.final is checked. If destination switch matches, an interface from that switch is allocated. All
+    other interfaces are distributed over the destination switches by the Allocator for policy.
+
+    Parameters
+    ----------
+    rundir:         string, passed by docopt.
+                    The directory to save the run sheet to.
+    runsheet:       string, passed by docopt.
+                    The file to save the run sheet to.
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    source:         string, passed by docopt.
+                    Comma separated list of switch ids
+    destination:    string, passed by docopt.
+                    Comm separated list of switch ids
+    policy:         string, passed by docopt.
+                    Allocation policy, a key of ALLOCATION_POLICIES
+    templatedir:    string, passed by docopt.
+                    Directory of port profile templates, see PortRenderer
+
+    Returns
+    -------
+    None
+
+    Calls
+    -----
+    load_switchports(confdir, confile)
+    match_final_state(switchports_d, free_ports, source_t, destination_t,
+                      renderer, moved)
+    move_critical_hosts(switchports_d, free_ports, source_t, destination_t,
+                        policy, renderer, moved)
+    write_csv_file(run_sheet, rundir, runsheet)
+    save_render_cache()
+    '''
+
+    logger = logging.getLogger()
+    logger.debug('rundir %s, runsheet %s, confdir %s, confile %s, source %s, '
+                 'destination %s', rundir, runsheet, confdir, confile, source,
+                 destination)
+
+    # Load the switchport dictionary and the port profiles.
+    switchports_d = load_switchports(confdir, confile)
+    renderer = PortRenderer(templatedir)
+
+    # Need turn $source and $destination in to tuples
+    source_t = tuple(source.split(','))
+    destination_t = tuple(destination.split(','))
+
+    # Free ports of the destination switches, taken from the stored index.
+    # It is already sorted, so the run is repeatable.
+    switchports_d.preload(source_t + destination_t)
+    free_ports = switchports_d.reindex().subset(destination_t)
+    logger.debug('Free ports %s', lazy_summary(free_ports.ports_d))
+
+    # Match final destinations before allocating randomly, then match rest of
+    # the ports. Rows stream through to the run sheet as they are decided.
+    moved = set()
+    run_sheet = itertools.chain(
+        match_final_state(switchports_d, free_ports, source_t, destination_t,
+                          renderer, moved),
+        move_critical_hosts(switchports_d, free_ports, source_t, destination_t,
+                            policy, renderer, moved))
+    write_csv_file(run_sheet, rundir, runsheet)
+    save_render_cache()
+
+@profiled(rows=int)
+def write_csv_file(runsheet, outdir, outname):
+    '''
+    Writes rows to csv_file.
+
+    runsheet can be any iterable, including a generator. Rows are written as
+    they arrive and the file is flushed every FLUSH_ROWS rows, so the start
+    of a large run sheet is on disk while the rest is still being planned.
+
+    Parametes
+    ---------
+    runsheet :  iterable of lists, the rows of the run sheet
+    outdir:     string, name of output directory
+    outname:    string, name of output file
+
+    Returns
+    -------
+    count : integer, the number of rows written
+    '''
+
+    # Create directory if required.
+    path_filename = os.getcwd() + '/' + outdir + '/' + outname
+    logging.debug('path_filename: %s', path_filename)
+    os.makedirs(os.path.dirname(path_filename), exist_ok=True)
+    # Write csv file
+    logging.info('Writing %s to dir %s', outname, outdir)
+    count = 0
+    with open(path_filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Description','From Switch','From Interface',
+                         'Disable Configuration', 'To Switch',
+                         'To Interface', 'vlan', 'Enable Configuration'])
+        for row in runsheet:
+            writer.writerow(row)
+            count += 1
+            if (count - 1) % FLUSH_ROWS == 0:
+                csv_file.flush()
+    logging.info('%s rows written to %s', count, outname)
+    return(count)
+
+def update_switchports(updatecsv, confdir, confile, updatedir, updatefile):
 
     '''
-    Dumps instances of Switchport to a yaml file.
+    Load switchport state. Update switchport state from CSV Save switchport
+    state.
+
+    Columns are found by their headers, see UPDATE_COLUMNS, or by
+    UPDATE_POSITIONS if the header names none of them. Every row is
+    checked by check_moves before any move is applied, and the errors of all
+    rows are reported together, so a bad CSV leaves the state as it was.
+
+    When the updated state file is the state file itself, and its backend
+    keeps the Inventory indexes, the moves are appended to its journal
+    rather than rewriting the whole state. The journal is compacted into a
+    new snapshot once it holds more than COMPACT_ENTRIES entries.
 
     Parameters
     ----------
-    switchports_d : dictionary of dictionaries, each subdictionary is
-            ('<interface>', SwitchPort())
-    confdir: string passed by docopt, the direcotry the file will be saved in
-    confile: string passed by docopt, the filename that instances of SwitchPort
-            will be saved in
+    condir:      string, the dirctory where existing switchport state information is
+                 stored
+    confile:     string, the name of the file storing swtichport state
+    updatedir:   string, name of the directory where updated switchport state is
+                 written.
+    updatefile:  string, name of the file storing switchport state
+
     Returns
     -------
     None
-
     '''
     logger = logging.getLogger()
-    switchport_file = os.path.join(
-                    os.getcwd(), confdir, confile)
-    logging.info('switchport_file: %s', switchport_file)
-    os.makedirs(os.path.dirname(switchport_file), exist_ok=True)
-    with open(switchport_file, 'w') as outfile:
-            yaml.dump(switchports_d, outfile, default_flow_style=False)
-    print('Switchport configuration generated, stored in directory', confdir,
-        ', file', confile)
+    logger.info('Loading switchport state from dir: %s, file %s',confdir,
+            confile)
+    switchports_d = load_switchports(confdir, confile)
+    logger.debug('switchports_d: %s', lazy_summary(switchports_d))
+    path_filename = os.getcwd() + '/' + updatedir + '/' + updatefile
+    logging.debug('path_filename: %s', path_filename)
+    os.makedirs(os.path.dirname(path_filename), exist_ok=True)
+    in_place = os.path.abspath(path_filename) == \
+        os.path.abspath(os.path.join(confdir, confile))
+    journal = in_place and get_state_backend(confile)[2]
+    # Read csv file, and check every row before any move is applied
+    logging.info('Reading %s from dir %s', updatedir, updatefile)
+    rows, errors = read_columns(updatecsv, UPDATE_COLUMNS,
+                                UPDATE_POSITIONS)
+    moves, check_errors = check_moves(switchports_d, rows)
+    if errors or check_errors:
+        raise_row_errors(updatecsv, errors + check_errors)
+    entries = []
+    for from_switch, from_port, to_switch, to_port, vlan, description in moves:
+        final = apply_move(switchports_d, from_switch, from_port,
+                           to_switch, to_port, vlan, description)
+        switchports_d.journal_seq += 1
+        entries.append({'seq': switchports_d.journal_seq,
+                        'from_switch': from_switch,
+                        'from_port': from_port, 'to_switch': to_switch,
+                        'to_port': to_port, 'vlan': vlan,
+                        'description': description, 'final': final})
+    if not journal:
+        dump_switchports(switchports_d, updatedir, updatefile)
+        return
+    append_journal(get_journal_file(confdir, confile), entries)
+    print('Journaled', len(entries), 'moves in directory', confdir, ', file',
+          confile + '.journal')
+    if switchports_d.journal_seq - switchports_d.journal_base > \
+            COMPACT_ENTRIES:
+        logger.info('Compacting journal of %s', confile)
+        dump_switchports(switchports_d, confdir, confile)
+
+
+def get_config_lines(block):
+
+    '''
+    Return the configuration commands of a configuration block of a run
+    sheet, without the comments, the exec commands around them, conf t and
+    end.
+    '''
+    lines = []
+    configuring = False
+    for line in block.splitlines():
+        command = line.strip()
+        if not command or command.startswith('!'):
+            continue
+        if command in ('conf t', 'configure terminal'):
+            configuring = True
+        elif command == 'end':
+            configuring = False
+        elif configuring:
+            lines.append(command)
+    return lines
 
-def load_switchports(confdir,confile):
+
+def plan_apply(rows):
 
     '''
-    Loads instances of SwitchPort from a yaml file.
+    Group the configuration of run sheet rows by switch. Blocks keep the
+    order of the rows, so that a port parked by one row and moved on by a
+    later one, as in flatten run sheets, ends up right. Every command keeps
+    the index of its row, so that only the rows a switch did not take are
+    failed.
+
+    Raises ValueError, before anything is pushed, if a block has no
+    configuration commands, such as one rendered without conf t, as its
+    row would be applied to the state without the switch being changed.
 
     Parameters
     ----------
-    confdir: string passed by docopt, the directory the file will be read from
-    confile: string passed by docopt, the yaml file with instances of
-        SwitchPort
+    rows : list of run sheet rows, as written by write_csv_file
 
     Returns
     -------
-    switchports_d : dictionary of dictionaries, each subdictionary is
-            ('<interface>', SwitchPort())
+    commands_d : dictionary of switch_id, list of (row index, configuration
+                 command)
+    '''
+    commands_d = defaultdict(list)
+    empty_l = []
+    for index, row in enumerate(rows):
+        from_switch, disable_config, to_switch, enable_config = \
+                row[1], row[3], row[4], row[7]
+        for switch_id, block in ((from_switch, disable_config),
+                                 (to_switch, enable_config)):
+            commands = get_config_lines(block)
+            if not commands:
+                empty_l.append(str(index + 2))
+            commands_d[switch_id].extend((index, command)
+                                         for command in commands)
+    if empty_l:
+        raise ValueError('Run sheet rows ' + ', '.join(
+            sorted(set(empty_l), key=int)) + ' have a block without '
+            'configuration commands, nothing was applied')
+    return commands_d
+
+
+def get_failed_rows(rows, commands_d, errors_d, accepted_d):
+
+    '''
+    Return the rows of a run sheet not applied, and the ones among them
+    whose disable block was accepted by their source switch while their
+    enable block was not. Those hosts have lost their old port without
+    getting the new one.
+
+    Parameters
+    ----------
+    rows : list of run sheet rows, as passed to plan_apply
+    commands_d : dictionary made by plan_apply
+    errors_d, accepted_d : dictionaries returned by configure_devices
+
+    Returns
+    -------
+    (failed_s, outage_s) : sets of row indexes
+    '''
+    failed_s = set()
+    disable_failed_s = set()
+    for switch_id in errors_d:
+        commands = commands_d.get(switch_id, ())
+        accepted = accepted_d.get(switch_id, 0)
+        taken_d = defaultdict(int)
+        for index, command in commands[:accepted]:
+            taken_d[index] += 1
+        for index, command in commands[accepted:]:
+            failed_s.add(index)
+            # The disable block comes first in the commands of its row
+            if rows[index][1] == switch_id and \
+                    taken_d[index] < len(get_config_lines(rows[index][3])):
+                disable_failed_s.add(index)
+    return failed_s, failed_s - disable_failed_s
+
+
+async def configure_device(device_d, commands, semaphore, timeout=30.0,
+                           retries=2):
+
+    '''
+    Push commands to a switch in a single session, inside one conf t.
+    Connecting is retried like run_session, but once configuration has
+    started nothing is sent twice. Any other error, such as an unknown
+    transport or an SSH login refused, fails the switch at once.
+
+    Returns
+    -------
+    (accepted, error) : the number of commands the switch accepted, and an
+        error string, None if every command was accepted. The session is
+        ended at the first command the switch rejects with a % message.
+    '''
+    import asyncio
+
+    logger = logging.getLogger()
+    switch_id = device_d['switch_id']
+    accepted = 0
+    for attempt in range(retries + 1):
+        async with semaphore:
+            session = None
+            try:
+                session = get_session(device_d, timeout)
+                try:
+                    await session.open()
+                except (OSError, EOFError, asyncio.TimeoutError) as error:
+                    if attempt == retries:
+                        return accepted, 'connect failed, ' + str(
+                            error or type(error).__name__)
+                    logger.warning('%s: %s, retrying', switch_id,
+                                   error or type(error).__name__)
+                else:
+                    await session.run('conf t')
+                    for command in commands:
+                        output = await session.run(command)
+                        errors = [line for line in output.splitlines()
+                                  if line.startswith('%')]
+                        if errors:
+                            await session.run('end')
+                            return accepted, command + ': ' + errors[0]
+                        accepted += 1
+                    await session.run('end')
+                    return accepted, None
+            except (OSError, EOFError, asyncio.TimeoutError) as error:
+                return accepted, 'session failed, ' + str(
+                    error or type(error).__name__)
+            except Exception as error:
+                return accepted, type(error).__name__ + ', ' + str(error)
+            finally:
+                if session is not None:
+                    await session.close()
+        await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+async def configure_devices(commands_d, devices_d, concurrency=10,
+                            timeout=30.0, retries=2):
+
+    '''
+    Run configure_device for every switch of commands_d, as made by
+    plan_apply, concurrently, at most concurrency sessions per site.
+
+    Returns
+    -------
+    errors_d : dictionary of switch_id, error for the switches that failed
+    accepted_d : dictionary of switch_id, number of commands accepted
     '''
+    import asyncio
+
     logger = logging.getLogger()
-    switchports_file = os.path.join(confdir, confile)
-    with open(switchports_file, 'r') as infile:
-        switchports_d = yaml.load(infile)
-    logger.debug('switchport dictionary: %s ',
-    pp.pformat(switchports_d))
-    logger.info('### Loaded SwitchPort dictionary from Dir %s, file %s',
-                confdir, confile)
-    return switchports_d
+    semaphores_d = defaultdict(lambda: asyncio.Semaphore(concurrency))
+    errors_d = dict()
+    accepted_d = dict.fromkeys(commands_d, 0)
 
-def mark_switchports_final(finalcsv, confdir, confile):
+    async def configure(switch_id):
+        device_d = devices_d.get(switch_id)
+        if device_d is None:
+            errors_d[switch_id] = 'not in the devices CSV'
+        else:
+            # An error escaping here would cancel the sessions of every
+            # other switch in the middle of their conf t
+            try:
+                accepted_d[switch_id], error = await configure_device(
+                    device_d, [command for index, command
+                               in commands_d[switch_id]],
+                    semaphores_d[device_d.get('site') or ''], timeout,
+                    retries)
+            except Exception as exception:
+                error = type(exception).__name__ + ', ' + str(exception)
+            if error is not None:
+                errors_d[switch_id] = error
+        if switch_id in errors_d:
+            logger.error('%s: apply failed, %s', switch_id,
+                         errors_d[switch_id])
+        else:
+            logger.info('%s: %s commands applied', switch_id,
+                        len(commands_d[switch_id]))
+
+    await asyncio.gather(*(configure(switch_id) for switch_id in commands_d))
+    return errors_d, accepted_d
+
+
+def apply_runsheet(runsheetcsv, devicecsv, confdir, confile, updatedir,
+                   updatefile, concurrency=10, timeout=30.0, retries=2,
+                   dryrun=False):
 
     '''
-    Critical hosts have been assigned to specific switches. At the end of the
-    task, hosts needto be on the correct switch.
+    Push the configuration of a run sheet to the switches, one session and
+    one conf t per switch, many switches at a time. The rows whose
+    commands were all accepted, on both of their switches, are then applied
+    to the state as update would. A switch rejecting a command only fails
+    the rows of that command and of the commands it never got.
 
-    Function takes in a csv file and writes it to a list.
+    The rows applied are saved next to the run sheet as <runsheet>.applied.csv
+    and the others as <runsheet>.failed.csv, which can be applied again.
+    Failed rows whose old port was disabled but whose new port was not
+    enabled are also saved as <runsheet>.outage.csv, as their hosts are
+    down until they are applied again. The state still has them on their
+    old port.
 
     Parameters
     ----------
-    finalcsv: string passed by docopt, relative path where csv file is located.
-                Matching on switch and port as there are multiple duplicate
-                descriptions. Current switch[1], migrate to switch[2], current
-                port [3]
-                index 0 is the host and index 2 is the final switch.
-    confdir: string passed by docopt, directory where the yaml file with
-                instances of SwitchPort will is loaded from
-    confile: string passed by docopt, file with instances of SwitchPort
+    runsheetcsv:    string, passed by docopt.
+                    Run sheet written by move, final or flatten
+    devicecsv:      string, passed by docopt.
+                    CSV of switch_id, host, port, site, transport, username
+    confdir, confile, updatedir, updatefile: strings, passed by docopt.
+                    As for update_switchports
+    concurrency:    integer, passed by docopt.
+                    Sessions open at the same time per site
+    timeout:        float, passed by docopt.
+                    Seconds to wait for a connection or a prompt
+    retries:        integer, passed by docopt.
+                    Times connecting to a switch is retried
+    dryrun:         boolean, passed by docopt.
+                    Only print the commands for each switch
+
+    Returns
+    -------
+    errors_d : dictionary of switch_id, error for the switches that failed
+
+    Calls
+    -----
+    update_switchports(appliedcsv, confdir, confile, updatedir, updatefile)
+    '''
+    import asyncio
+
+    logger = logging.getLogger()
+    with open(runsheetcsv, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        rows = list(reader)
+    commands_d = plan_apply(rows)
+    if dryrun:
+        for switch_id, commands in commands_d.items():
+            print('\n'.join([switch_id + ':', 'conf t']
+                            + [command for index, command in commands]
+                            + ['end']))
+        return {}
+    devices_d = {device_d['switch_id']: device_d
+                 for device_d in load_devices(devicecsv)}
+    errors_d, accepted_d = asyncio.run(configure_devices(
+        commands_d, devices_d, concurrency, timeout, retries))
+    failed_s, outage_s = get_failed_rows(rows, commands_d, errors_d,
+                                         accepted_d)
+    stem = os.path.splitext(runsheetcsv)[0]
+    applied_l, failed_l, outage_l = [], [], []
+    for index, row in enumerate(rows):
+        if index in failed_s:
+            failed_l.append(row)
+            if index in outage_s:
+                outage_l.append(row)
+        else:
+            applied_l.append(row)
+    for suffix, rows_l in (('.applied.csv', applied_l),
+                           ('.failed.csv', failed_l),
+                           ('.outage.csv', outage_l)):
+        with open(stem + suffix, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(header)
+            writer.writerows(rows_l)
+    logger.info('Applied %s of %s rows on %s of %s switches', len(applied_l),
+                len(rows), len(commands_d) - len(errors_d), len(commands_d))
+    if failed_l:
+        logger.error('%s rows not applied, saved to %s', len(failed_l),
+                     stem + '.failed.csv')
+    for row in outage_l:
+        logger.error('%s: old port %s:%s disabled, new port %s:%s not '
+                     'enabled', row[0], row[1], row[2], row[4], row[5])
+    if outage_l:
+        logger.error('%s rows have their old port disabled and their new '
+                     'port not enabled, saved to %s', len(outage_l),
+                     stem + '.outage.csv')
+    if applied_l:
+        update_switchports(stem + '.applied.csv', confdir, confile,
+                           updatedir, updatefile)
+    return errors_d
+
+def finalize(rundir, runsheet, confdir, confile, source, destination,
+             templatedir=None):
+
+    '''
+    Function matches PortSwitch.final of hosts being moved with
+    PortSwitch.switch_id of available port switches and returns configuration
+    to both enable the new port and disable the old port.
+
+    Parameters
+    ----------
+    rundir:         string, passed by docopt.
+                    The directory to save the run sheet to.
+    runsheet:       string, passed by docopt.
+                    The file to save the run sheet to.
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    source:         string, passed by docopt.
+                    Comma separated list of switch ids
+    destination:    string, passed by docopt.
+                    Comm separated list of switch ids
+    templatedir:    string, passed by docopt.
+                    Directory of port profile templates, see PortRenderer
 
     Returns
     -------
     None
 
-    Mutates
+    Calls
+    -----
+    load_switchports(confdir, confile)
+    match_final_state(switchports_d, free_ports, source_t, destination_t,
+                      renderer)
+    write_csv_file(run_sheet, rundir, runsheet)
+    save_render_cache()
+    '''
+
+    logger = logging.getLogger()
+    logger.debug('rundir %s, runsheet %s, confdir %s, confile %s, source %s, '
+                 'destination %s', rundir, runsheet, confdir, confile, source,
+                 destination)
+
+    # Load the switchport dictionary and the port profiles.
+    switchports_d = load_switchports(confdir, confile)
+    renderer = PortRenderer(templatedir)
+
+    # Need turn $source and $destination in to tuples
+    source_t = tuple(source.split(','))
+    destination_t = tuple(destination.split(','))
+
+    # Free ports of the destination switches, taken from the stored index.
+    # It is already sorted, so the run is repeatable.
+    switchports_d.preload(source_t + destination_t)
+    free_ports = switchports_d.reindex().subset(destination_t)
+    logger.debug('Free ports %s', lazy_summary(free_ports.ports_d))
+
+    # Match final destinations, rows stream through to the run sheet as
+    # they are decided
+    run_sheet = match_final_state(switchports_d, free_ports, source_t,
+                                  destination_t, renderer)
+    write_csv_file(run_sheet, rundir, runsheet)
+    save_render_cache()
+
+@profiled()
+def plan_flatten(switchports_d, renderer=None):
+
+    '''
+    Plan the smallest set of moves that puts every host on its .final
+    switch, as ordered waves.
+
+    A final switch can take as many hosts as it has free ports plus hosts
+    leaving it. Hosts beyond that stay where they are, and are reported,
+    before anything is planned.
+
+    A host can move as soon as its final switch has a free port. Moving it
+    frees its old port, which can be used from the next wave on, so chains
+    of moves into full switches resolve one wave at a time. Hosts whose move
+    frees a port on a switch other hosts wait for go first, so that chains
+    keep going. When every remaining final switch is full the moves form
+    cycles. A cycle, found by following hosts from switch to switch, is
+    broken by moving one of its hosts to a temporary spare port on a switch
+    that no host is waiting for. It moves on to its final switch once the
+    rest of the cycle has moved. Each host moves once, plus one extra move
+    per cycle.
+
+    Only the switches ready to receive hosts are visited in each wave, so
+    planning costs about O(hosts moved + waves).
+
+    Parameters
+    ----------
+    switchports_d : Inventory, dictionary of dictionaries, each subdictionary
+            is ('<interface>', SwitchPort()), fully loaded
+    renderer : PortRenderer passed on to configure_ports
+
+    Yields
+    ------
+    run sheet row : list, as returned by configure_ports, with 'Wave <n>' or
+            'Wave <n> Temporary' appended
+    '''
+    from collections import deque
+
+    logger = logging.getLogger()
+    # Work on a copy, the plan is only applied to the state by update
+    free_ports = FreePortIndex(switchports_d.reindex().to_dict())
+    # A host is [SwitchPort, current switch, current port]. Hosts parked on a
+    # temporary port keep their record, with the temporary location.
+    pending_d = defaultdict(list)
+    leaving_d = defaultdict(list)
+    for switch_id in sorted(switchports_d):
+        for port_id in sorted(switchports_d[switch_id], key=port_key):
+            port = switchports_d[switch_id][port_id]
+            if port.status == 'disabled' or not port.final or \
+                    port.final == switch_id:
+                continue
+            if port.final not in switchports_d:
+                logger.warning('Final switch %s of %s:%s is not in the '
+                               'inventory', port.final, switch_id, port_id)
+                continue
+            host = [port, switch_id, port_id]
+            pending_d[port.final].append(host)
+            leaving_d[switch_id].append(host)
+
+    # Hosts a final switch has no room for stay where they are, which in
+    # turn leaves less room on the switch they stay on
+    stay = 0
+    check = set(pending_d)
+    while check:
+        switch_id = check.pop()
+        hosts = pending_d.get(switch_id)
+        if not hosts:
+            continue
+        room = free_ports.count(switch_id) + len(leaving_d[switch_id])
+        if len(hosts) <= room:
+            continue
+        # Hosts leaving switches no host waits for stay first
+        hosts.sort(key=lambda host: host[1] not in pending_d)
+        logger.warning('Final switch %s has room for %s of its %s hosts, %s '
+                       'stay where they are', switch_id, room, len(hosts),
+                       len(hosts) - room)
+        for host in hosts[room:]:
+            logger.debug('%s:%s stays, final switch %s is full', host[1],
+                         host[2], switch_id)
+            leaving_d[host[1]].remove(host)
+            check.add(host[1])
+        stay += len(hosts) - room
+        del hosts[room:]
+        if not hosts:
+            del pending_d[switch_id]
+
+    # Hosts waiting for a final switch, as (hosts on a switch other hosts
+    # wait for, other hosts). Hosts whose switch stops being waited for are
+    # moved to the others lazily.
+    waiting_d = {}
+    for switch_id, hosts in pending_d.items():
+        waiting_d[switch_id] = (
+            deque(host for host in hosts if host[1] in pending_d),
+            deque(host for host in hosts if host[1] not in pending_d))
+    pending_d = waiting_d
+    leaving_d = {switch_id: deque(hosts)
+                 for switch_id, hosts in leaving_d.items() if hosts}
+
+    def next_host(switch_id):
+        blocking, others = pending_d[switch_id]
+        while blocking and blocking[0][1] not in pending_d:
+            others.append(blocking.popleft())
+        return (blocking or others).popleft()
+
+    def leaving_host(switch_id):
+        leaving = leaving_d.get(switch_id)
+        while leaving and leaving[0][1] != switch_id:
+            leaving.popleft()
+        return leaving[0] if leaving else None
+
+    def find_cycle():
+
+        '''
+        Return a host leaving a switch of a cycle for its next switch in the
+        cycle, or None. Every full final switch has hosts leaving for
+        another final switch, so following them ends in a cycle.
+        '''
+        seen = set()
+        switch_id = min(pending_d)
+        while switch_id not in seen:
+            seen.add(switch_id)
+            host = leaving_host(switch_id)
+            if host is None:
+                return None
+            switch_id = host[0].final
+        return leaving_host(switch_id)
+
+    def from_port(host):
+        port, switch_id, port_id = host
+        if switch_id == port.switch_id:
+            return port
+        return SwitchPort(switch_id, port_id, 'connected', port.vlan,
+                          port.description, port.configuration, port.final)
+
+    spare_heap = [switch_id for switch_id in switchports_d
+                  if free_ports.count(switch_id) and switch_id not in pending_d]
+    heapq.heapify(spare_heap)
+    ready = {switch_id for switch_id in pending_d if free_ports.count(switch_id)}
+    wave = moves = temporary = 0
+    parked = set()
+
+    while pending_d:
+        freed_l = []
+        if ready:
+            wave += 1
+            for switch_id in sorted(ready):
+                blocking, others = pending_d[switch_id]
+                while (blocking or others) and free_ports.count(switch_id):
+                    host = next_host(switch_id)
+                    to_port = switchports_d[switch_id][free_ports.pop(switch_id)]
+                    row = configure_ports((from_port(host), to_port), renderer)
+                    row.append('Wave ' + str(wave))
+                    yield row
+                    moves += 1
+                    freed_l.append((host[1], host[2]))
+                    parked.discard(id(host))
+                    # Moved for good, drop it from leaving_d lazily
+                    host[1] = None
+                if not (blocking or others):
+                    del pending_d[switch_id]
+                    if free_ports.count(switch_id):
+                        heapq.heappush(spare_heap, switch_id)
+        else:
+            # Every final switch left is full, break a cycle by parking one
+            # of its hosts on a spare port
+            host = find_cycle()
+            while spare_heap and (not free_ports.count(spare_heap[0])
+                                  or spare_heap[0] in pending_d):
+                heapq.heappop(spare_heap)
+            if host is None or not spare_heap:
+                if host is None:
+                    logger.warning('Final switches %s are full with hosts '
+                                   'that stay', ', '.join(sorted(pending_d)))
+                else:
+                    logger.warning('No spare port to break a cycle')
+                logger.warning('%s hosts can not reach their final switch',
+                               sum(len(blocking) + len(others) for
+                                   blocking, others in pending_d.values()))
+                if parked:
+                    logger.warning('%s hosts are left on a temporary port',
+                                   len(parked))
+                break
+            wave += 1
+            spare = spare_heap[0]
+            to_port = switchports_d[spare][free_ports.pop(spare)]
+            row = configure_ports((from_port(host), to_port), renderer)
+            row.append('Wave ' + str(wave) + ' Temporary')
+            yield row
+            temporary += 1
+            parked.add(id(host))
+            freed_l.append((host[1], host[2]))
+            host[1], host[2] = spare, to_port.port_id
+        # Ports freed in this wave can be used from the next one
+        ready = set()
+        for switch_id, port_id in freed_l:
+            free_ports.release(switch_id, port_id)
+            if switch_id in pending_d:
+                ready.add(switch_id)
+            else:
+                heapq.heappush(spare_heap, switch_id)
+    logger.info('Flatten planned %s moves and %s temporary moves in %s waves',
+                moves, temporary, wave)
+    if stay:
+        logger.warning('%s hosts stay off their full final switch', stay)
+
+def flatten_switchports(rundir, runsheet, confdir, confile, templatedir=None):
+
+    '''
+    Generate the run sheet that puts every host on its .final switch.
+
+    Parameters
+    ----------
+    rundir:         string, passed by docopt.
+                    The directory to save the run sheet to.
+    runsheet:       string, passed by docopt.
+                    The file to save the run sheet to.
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    templatedir:    string, passed by docopt.
+                    Directory of port profile templates, see PortRenderer
+
+    Returns
     -------
-    switchports_d
+    None
 
     Calls
     -----
-    dump_switchports
+    load_switchports(confdir, confile)
+    plan_flatten(switchports_d, renderer)
+    write_csv_file(run_sheet, rundir, runsheet)
+    save_render_cache()
     '''
+    switchports_d = load_switchports(confdir, confile)
+    switchports_d.load_all()
+    renderer = PortRenderer(templatedir)
+    write_csv_file(plan_flatten(switchports_d, renderer), rundir, runsheet)
+    save_render_cache()
 
-    logger=logging.getLogger()
-    logging.info('### Getting switchport dictionary ###')
-    switchports_d = load_switchports(confdir,confile)
-    logger.debug('switchports_d: %s', pp.pformat(switchports_d))
-    logger.info('Getting Final State information')
-    with open(finalcsv) as infile:
-        logging.info('Opened CSV %s', finalcsv)
-        reader = csv.reader(infile)
-        next(reader)
-        count = 0
-        for row in reader:
-            cur_switch, cur_port, final_switch =\
-                    row[1], row[3], row[2]
-            switchports_d[cur_switch][cur_port].final = final_switch
-            count += 1
-            logger.debug('Switch:%s, port:%s marked with final:%s',\
-                    cur_switch, cur_port, final_switch)
-    logging.info('%s ports marked', count)
-    dump_switchports(switchports_d, confdir, confile)
+def status_switchports(confdir, confile, switch_ids=(), output_format='text'):
+
+    '''
+    Report free ports, critical hosts per vlan and hosts not yet on their
+    .final switch, for every switch or only switch_ids.
+
+    The report is read from the Aggregates kept with the state, so no port
+    is scanned when the state file has them.
+
+    Parameters
+    ----------
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    switch_ids:     list of strings, passed by docopt.
+                    Switches to report on, all switches if empty
+    output_format:  string, passed by docopt.
+                    text for a table, json for machine readable output
+
+    Returns
+    -------
+    status_d : dictionary, the report as printed in json
+    '''
+    import json
+
+    switchports_d = load_switchports(confdir, confile)
+    aggregates = switchports_d.get_aggregates()
+    switch_ids = list(switch_ids) or sorted(aggregates.switches_d)
+    for switch_id in switch_ids:
+        if switch_id not in aggregates.switches_d:
+            raise ValueError('Unknown switch ' + switch_id)
+    status_d = {'switches': {}, 'totals': {'ports': 0, 'free': 0,
+                                          'critical': 0, 'off_final': 0},
+                'critical_vlans': {}}
+    totals = status_d['totals']
+    for switch_id in switch_ids:
+        ports, free, off_final = aggregates.switches_d[switch_id]
+        vlans_d = aggregates.critical_d.get(switch_id, {})
+        critical = sum(vlans_d.values())
+        status_d['switches'][switch_id] = {
+            'ports': ports, 'free': free, 'critical': critical,
+            'off_final': off_final, 'critical_vlans': dict(sorted(vlans_d.items()))}
+        for key, value in (('ports', ports), ('free', free),
+                           ('critical', critical), ('off_final', off_final)):
+            totals[key] += value
+        for vlan, count in vlans_d.items():
+            critical_vlans = status_d['critical_vlans']
+            critical_vlans[vlan] = critical_vlans.get(vlan, 0) + count
+    status_d['critical_vlans'] = dict(sorted(status_d['critical_vlans'].items()))
+
+    if output_format == 'json':
+        print(json.dumps(status_d, indent=2))
+    elif output_format == 'text':
+        width = max([len(switch_id) for switch_id in switch_ids] + [6])
+        print('Switch'.ljust(width), '   Ports    Free Critical Off final')
+        for switch_id, row in status_d['switches'].items():
+            print(switch_id.ljust(width), '%8d%8d%9d%10d' % (row['ports'],
+                  row['free'], row['critical'], row['off_final']))
+        print('Total'.ljust(width), '%8d%8d%9d%10d' % (totals['ports'],
+              totals['free'], totals['critical'], totals['off_final']))
+        for vlan, count in status_d['critical_vlans'].items():
+            print('Critical hosts in vlan', vlan + ':', count)
+    else:
+        raise ValueError('Unknown status format ' + output_format
+                         + ', use text or json')
+    return status_d
+
+@profiled()
+def classify_ports(switchports_d, switch_ids, rules, list_hosts=False):
+
+    '''
+    Classify the hosts of switch_ids with rules, in a single pass.
+
+    Returns
+    -------
+    (switches_d, rules_d, host_l) : hosts and critical hosts per switch,
+        critical hosts per rule, and (switch_id, port_id, vlan, rule,
+        description) of every critical host if list_hosts
+    '''
+    classify = rules.classify
+    switches_d = dict()
+    rules_d = {rule[0]: 0 for rule in rules.include_l}
+    host_l = []
+    for switch_id in switch_ids:
+        hosts = critical = 0
+        for port in switchports_d[switch_id].values():
+            if port.status == 'disabled':
+                continue
+            hosts += 1
+            name = classify(port)
+            if name is None:
+                continue
+            critical += 1
+            rules_d[name] += 1
+            if list_hosts:
+                host_l.append((switch_id, port.port_id, port.vlan, name,
+                               port.description))
+        switches_d[switch_id] = {'hosts': hosts, 'critical': critical}
+    return switches_d, rules_d, host_l
+
+
+def classify_switchports(confdir, confile, switch_ids=(), list_hosts=False,
+                         output_format='text'):
+
+    '''
+    Report the hosts the critical host rules select, per switch and per
+    rule, for every switch or only switch_ids.
+
+    Parameters
+    ----------
+    confdir:        string, passed by docopt.
+                    The directory that instances of SwitchPort are stored in.
+    confile:        string, passed by docopt.
+                    The file that instances of SwitchPort are saved to.
+    switch_ids:     list of strings, passed by docopt.
+                    Switches to classify, all switches if empty
+    list_hosts:     boolean, passed by docopt.
+                    Also list every critical host, with the rule selecting it
+    output_format:  string, passed by docopt.
+                    text for a table, json for machine readable output
+
+    Returns
+    -------
+    classify_d : dictionary, the report as printed in json
+    '''
+    import json
 
-def get_available_port_d(switchports_d, *switch_ids):
+    if output_format not in ('text', 'json'):
+        raise ValueError('Unknown classify format ' + output_format
+                         + ', use text or json')
+    rules = get_critical_rules()
+    switchports_d = load_switchports(confdir, confile)
+    if switch_ids:
+        try:
+            switchports_d.preload(switch_ids)
+        except KeyError as error:
+            raise ValueError('Unknown switch ' + error.args[0])
+    else:
+        switchports_d.load_all()
+        switch_ids = sorted(switchports_d)
+    switches_d, rules_d, host_l = classify_ports(switchports_d, switch_ids,
+                                                 rules, list_hosts)
+    classify_d = {'rules': rules_d, 'switches': switches_d,
+                  'totals': {'hosts': sum(row['hosts']
+                                          for row in switches_d.values()),
+                             'critical': sum(row['critical']
+                                             for row in switches_d.values())}}
+    if list_hosts:
+        classify_d['hosts'] = [dict(zip(('switch_id', 'port_id', 'vlan',
+                                         'rule', 'description'), host))
+                               for host in host_l]
 
-    '''
-    Get available ports so they can be allocated for moving.
+    if output_format == 'json':
+        print(json.dumps(classify_d, indent=2))
+    else:
+        for host in host_l:
+            print(*host)
+        width = max([len(switch_id) for switch_id in switch_ids] + [6])
+        print('Switch'.ljust(width), '   Hosts Critical')
+        for switch_id, row in switches_d.items():
+            print(switch_id.ljust(width), '%8d%9d' % (row['hosts'],
+                                                      row['critical']))
+        totals = classify_d['totals']
+        print('Total'.ljust(width), '%8d%9d' % (totals['hosts'],
+                                                totals['critical']))
+        for name, count in rules_d.items():
+            print('Critical hosts selected by', name + ':', count)
+    return classify_d
 
-    Parameters
-    ----------
-    switchports_d : dictionary of dictionaries, each subdictionary is
-            ('<interface>', SwitchPort())
-    switch_ids: tuple of strings
-    Examples:
-        'distsw_31'
-        'distsw_32'
+@profiled()
+def diff_ports(switch_id, old_ports_d, new_ports_d):
+
+    '''
+    Return the ports of switch_id that differ between two snapshots.
 
     Returns
     -------
-    available_ports_d : dictionary of dictionaries, each subdictionary is
-            ('<interface>', SwitchPort())
+    port_l : list of dictionaries with the switch_id, port_id, change
+             (added, removed or changed) and fields, a dictionary of field
+             to [old, new] of the DIFF_FIELDS that differ. The missing side
+             of an added or removed port is None.
     '''
-    logger=logging.getLogger()
-    logger.info('Allocating disabled ports')
-    available_ports_d = dict()
-    for each in range(len(switch_ids[0])):
-        switch_id = switch_ids[0][each]
-        available_ports_d[switch_id] = dict()
-        logging.debug('switch_id: %s', switch_id)
-        for port, values in switchports_d[switch_id].items():
-            status = values.status
-            if status == 'disabled':
-                available_ports_d[switch_id][port] = values
-    logger.debug('available_ports_d: %s', pp.pformat(available_ports_d))
-    return(available_ports_d)
-
-def match_final_state(switchports_d, sorted_available_ports_d,
-    source_t, destination_t):
+    from operator import attrgetter
+
+    get_fields = attrgetter(*DIFF_FIELDS)
+    port_l = []
+    for port_id in sorted(old_ports_d.keys() | new_ports_d.keys(),
+                          key=port_key):
+        old = old_ports_d.get(port_id)
+        new = new_ports_d.get(port_id)
+        if old is not None and new is not None and \
+                get_fields(old) == get_fields(new):
+            continue
+        fields = dict()
+        for field in DIFF_FIELDS:
+            old_value = None if old is None else getattr(old, field)
+            new_value = None if new is None else getattr(new, field)
+            if old_value != new_value:
+                fields[field] = [old_value, new_value]
+        if fields:
+            change = 'added' if old is None else \
+                'removed' if new is None else 'changed'
+            port_l.append({'switch_id': switch_id, 'port_id': port_id,
+                           'change': change, 'fields': fields})
+    return port_l
+
+
+def diff_switchports(confdir, confile, newdir, newfile, as_of=None,
+                     output_format='text'):
 
     '''
-    Matches attritbute final of instances of SwitchPort, with
-    to_switch. If matched, it pass off to configure_ports with port from
-    available_ports_d
+    Report the ports whose status, vlan, description or .final differ
+    between two state files, by default the state before and after update.
+
+    Switches are compared by the fingerprints kept with the state, so only
+    the switches that changed are loaded and compared port by port. State
+    files without fingerprints, such as YAML, are hashed as they are read.
 
     Parameters
     ----------
-    switchports_d : dictionary of dictionaries, each subdictionary is
-            ('<interface>', SwitchPort())
-    available_ports_d : dictionary of dictionaries, each subdictionary is
-            ('<interface>', SwitchPort())
-            source_t: string of comma separated switch IDs
-            destination_t: string of comma separated switch IDs
+    confdir, confile:   strings, passed by docopt.
+                        The state file to compare from
+    newdir, newfile:    strings, passed by docopt.
+                        The state file to compare to
+    as_of:              integer, passed by docopt.
+                        Compare from confile as of this move journal entry
+    output_format:      string, passed by docopt.
+                        text for one line per port, json for machine
+                        readable output
 
     Returns
     -------
-    final_run_sheet : list of elements:
-        from_port.switch_id : string
-        from_port.port_id : string
-        disable_config : string
-        to_port.switch_id : string
-        to_port.port_id : string
-        from_port.vlan : string
-        enable_config : string
-        Final : 'Final'
-
+    diff_d : dictionary, the report as printed in json
     '''
-
+    import json
 
     logger = logging.getLogger()
-    return_run_sheet = []
-    count = 0
-    for source in source_t:
-        for source_port, source_value in switchports_d[source].items():
-            # if source_value.final is in destination_t and matches its own
-            # switch_id, it's in the right place
-            if source_value.final in destination_t and\
-                    source_value.final != source_value.switch_id:
-                logger.debug('source_value.final: %s, source_vlaue.switch_id %s,\
-                        destination_t, %s', pp.pformat(source_value.final),\
-                        pp.pformat(source_value.switch_id), pp.pformat(destination_t))
-                count += 1
-                logging.debug('source_port.final %s, count %s', source_value.final, count)
-                source_value.status = 'disabled'
-                switchports_d[source][source_port] = source_value
-                logging.debug('new status %s', switchports_d[source][source_port].status)
-                if len(sorted_available_ports_d[source_value.final].keys()) > 0:
-                    to_port = sorted_available_ports_d[source_value.final].popitem()[1]
-                    ports = (source_value, to_port)
-                    configured_ports = configure_ports(ports)
-                    configured_ports.append('Final')
-                    return_run_sheet.append(configured_ports)
-    logging.info('%s ports matched to final switch', count)
-    return(return_run_sheet, sorted_available_ports_d, switchports_d)
+    if output_format not in ('text', 'json'):
+        raise ValueError('Unknown diff format ' + output_format
+                         + ', use text or json')
+    old_d = load_switchports(confdir, confile, as_of)
+    new_d = load_switchports(newdir, newfile)
+    old_ids = set(old_d.switch_ids())
+    new_ids = set(new_d.switch_ids())
+    changed_l = sorted(switch_id for switch_id in old_ids & new_ids
+                       if old_d.get_fingerprint(switch_id)
+                       != new_d.get_fingerprint(switch_id))
+    diff_d = {'switches': {'added': sorted(new_ids - old_ids),
+                           'removed': sorted(old_ids - new_ids),
+                           'changed': changed_l,
+                           'unchanged': len(old_ids & new_ids)
+                                        - len(changed_l)},
+              'ports': []}
+    logger.info('%s switches changed, %s unchanged', len(changed_l),
+                diff_d['switches']['unchanged'])
+    if 2 * len(changed_l) > len(old_ids & new_ids):
+        # Read in one pass rather than switch by switch
+        old_d.load_all()
+        new_d.load_all()
+    changed_s = set(changed_l)
+    for switch_id in sorted(old_ids | new_ids):
+        if switch_id in old_ids and switch_id in new_ids and \
+                switch_id not in changed_s:
+            continue
+        diff_d['ports'].extend(diff_ports(
+            switch_id, old_d[switch_id] if switch_id in old_ids else {},
+            new_d[switch_id] if switch_id in new_ids else {}))
 
-def get_enable_port(old_switch, old_port, new_switch, new_port, vlan, description):
+    if output_format == 'json':
+        print(json.dumps(diff_d, indent=2))
+    else:
+        for port_d in diff_d['ports']:
+            print(port_d['switch_id'], port_d['port_id'], port_d['change'],
+                  '; '.join('%s: %s -> %s' % (field, old or '-', new or '-')
+                            for field, (old, new)
+                            in port_d['fields'].items()))
+        switches_d = diff_d['switches']
+        print('%d ports differ. Switches: %d changed, %d added, %d removed, '
+              '%d unchanged' % (len(diff_d['ports']),
+                                len(switches_d['changed']),
+                                len(switches_d['added']),
+                                len(switches_d['removed']),
+                                switches_d['unchanged']))
+    return diff_d
 
+class OverlayLoader():
     '''
-    Generate enable port configuration.
+    Loads single switches of an overlay Inventory as copies of the switches
+    of a base Inventory, so the overlay can be changed, by apply_move for
+    example, without touching the base. Only the switches looked up are
+    copied.
 
-    Parameters
-    ----------
+    base:           Inventory the overlay is laid over
+    '''
 
-    old_switch : string
-    old_port: string
-    new_switch: string
-    new_port: string
-    vlan: string
-    description : string
+    def __init__(self, base):
 
-    Returns
-    -------
-    enable_port_config : string
+        self.base = base
 
-    '''
+    def switch_ids(self):
+        return self.base.switch_ids()
 
-    logger = logging.getLogger()
-    logger.debug('Getting enable config')
-    enable_port_config = \
-    '! Move ' + old_switch + ':' + old_port +  'to' +\
-        new_switch + ':' + new_port + '\n' +\
-    '!show interface ' + new_port + 'status' + '\n' +\
-    '! If status is disabled, proceed with configuration\n' +\
-    'conf t\n' +\
-    ' interface ' + new_port + '\n' +\
-    ' description ' + description + '\n' +\
-    ' switchport access vlan ' + vlan + '\n' +\
-    ' switchport trunk encapsulation dot1q\n' +\
-    ' switchport mode access\n' +\
-    ' switchport nonegotiate\n' +\
-    ' switchport port-security maximum 3\n' +\
-    ' switchport port-security\n' +\
-    ' switchport port-security aging time 2\n' +\
-    ' switchport port-security violation restrict\n' +\
-    ' switchport port-security aging type inactivity\n' +\
-    ' srr-queue bandwidth share 1 42 53 4\n' +\
-    ' srr-queue bandwidth shape 300 0 0 0\n' +\
-    ' priority-queue out\n' +\
-    ' spanning-tree portfast\n' +\
-    ' service-policy input ACCESS-CONDTRUST-PMAP\n' +\
-    ' no shut\n' +\
-    ' end\n' +\
-    '!\n'
-
-    return(enable_port_config)
+    def __call__(self, switch_id):
 
-def get_disable_port(old_switch, old_port, new_switch, new_port, vlan, description):
+        '''
+        Return (ports_d, free_port_l) of switch_id, copied from the base,
+        raise KeyError if the base has no such switch.
+        '''
+        ports_d = {port_id: SwitchPort(*(getattr(port, field)
+                                         for field in SWITCHPORT_FIELDS))
+                   for port_id, port in self.base[switch_id].items()}
+        return ports_d, list(self.base.reindex().ports(switch_id))
+
+    def items(self):
+
+        '''
+        Yield (switch_id, ports_d, free_port_l) for every switch.
+        '''
+        for switch_id in self.switch_ids():
+            yield (switch_id,) + self(switch_id)
+
+
+def get_overlay(switchports_d):
 
     '''
-    Generate disable port configuration.
+    Return a copy-on-write overlay of switchports_d: an Inventory that copies
+    a switch of switchports_d the first time it is looked up. The Aggregates
+    are copied whole, they only hold a few counters per switch.
+    '''
+    overlay = Inventory()
+    overlay.free_ports = FreePortIndex()
+    overlay.aggregates = Aggregates(switchports_d.get_aggregates().to_dict())
+    overlay.journal_seq = overlay.journal_base = switchports_d.journal_seq
+    overlay.loader = OverlayLoader(switchports_d)
+    return overlay
 
-    Parameters
-    ----------
 
-    old_switch : string
-    old_port: string
-    new_switch: string
-    new_port: string
-    vlan: string
-    description : string
+def plan_move(switchports_d, free_ports, source_t, destination_t,
+              policy='most-free'):
 
-    Returns
-    -------
-    disable_port_config : string
+    '''
+    Yield the moves planned by move_interfaces, as pairs of ports rather than
+    run sheet rows: hosts matched to their final switch first, then the
+    critical hosts left, allocated by policy.
 
+    Yields
+    ------
+    (from_port, to_port) : tuple of SwitchPort, to_port is None for a
+            critical host no destination has a free port left for
     '''
-    logger = logging.getLogger()
-    logger.debug('Getting disable config')
-    disable_port_config = \
-    '! disable configuration for ' + old_switch + ':' + old_port + '\n' +\
-    'show interface ' + old_port + 'status' + '\n' +\
-    '! If notconnect and patch has been moved, disable\n' +\
-    'conf t\n' +\
-    ' interface ' + old_port + '\n' +\
-    ' description disabled\n' +\
-    ' shutdown\n' +\
-    ' end\n' +\
-    '!\n'
+    moved = set()
+    for from_port, to_port in assign_final_state(switchports_d, free_ports,
+                                                 source_t, destination_t):
+        if to_port is not None:
+            moved.add(from_port)
+            yield (from_port, to_port)
+    yield from allocate_critical_hosts(switchports_d, free_ports, source_t,
+                                       destination_t, policy, moved)
 
-    return(disable_port_config)
 
-def configure_ports(ports):
+def load_scenarios(scenariocsv, switch_ids, policy='most-free'):
 
     '''
-    Configure ports, return list of configuruations.
+    Read the scenarios of a CSV with the headers name, source, destination
+    and policy. Source and destination are comma separated switch ids, as
+    for move, so they have to be quoted. Policy is optional, it may list
+    several policies or be 'all', each is a scenario of its own.
 
     Parameters
     ----------
-    ports: tuple
-        (from_port, to_port)
-        from_port: instance of SwitchPorts
-        to_port: instance of SwitchPorts
+    scenariocsv:    string, path of the CSV
+    switch_ids:     set of the switch ids of the state
+    policy:         string, the policy of rows without one
 
     Returns
     -------
-    run_sheet_list: list of elements:
+    scenario_l : list of dictionaries with the name, source, destination and
+                 policy of each scenario
+    '''
+    scenario_l = []
+    with open(scenariocsv, newline='') as csv_file:
+        for number, row in enumerate(csv.DictReader(csv_file), 1):
+            name = (row.get('name') or '').strip() or str(number)
+            source_t, destination_t = (
+                tuple(switch_id.strip()
+                      for switch_id in (row.get(column) or '').split(',')
+                      if switch_id.strip())
+                for column in ('source', 'destination'))
+            if not source_t or not destination_t:
+                raise ValueError('Scenario ' + name + ' of ' + scenariocsv
+                                 + ' needs a source and a destination')
+            for switch_id in source_t + destination_t:
+                if switch_id not in switch_ids:
+                    raise ValueError('Unknown switch ' + switch_id
+                                     + ' in scenario ' + name)
+            policies = (row.get('policy') or '').strip() or policy
+            if policies == 'all':
+                policy_l = sorted(ALLOCATION_POLICIES)
+            else:
+                policy_l = [value.strip() for value in policies.split(',')]
+            for value in policy_l:
+                if value not in ALLOCATION_POLICIES:
+                    raise ValueError('Unknown allocation policy ' + value
+                                     + ' in scenario ' + name + ', use one of '
+                                     + ', '.join(sorted(ALLOCATION_POLICIES)))
+                scenario_l.append({
+                    'name': name + '/' + value if len(policy_l) > 1 else name,
+                    'source': source_t, 'destination': destination_t,
+                    'policy': value})
+    return scenario_l
 
-        from_port.switch_id : string
-        from_port.port_id : string
-        disable_config : string
-        to_port.switch_id : string
-        to_port.port_id : string
-        from_port.vlan : string
-        enable_config : string
 
-    Mutates
+@profiled()
+def simulate_scenario(switchports_d, scenario_d):
+
+    '''
+    Apply the moves move would plan for a scenario to an overlay of
+    switchports_d, and report on the result. switchports_d is not changed.
+
+    Returns
     -------
-    Instances of SwitchPort
+    result_d : dictionary of
+        name, source, destination, policy:  the scenario
+        moves:          hosts moved
+        unplaced:       critical hosts left on the source switches for lack
+                        of a free port
+        free:           free ports left on the destination switches
+        min_free:       free ports left on the fullest destination switch
+        off_final:      hosts of the estate not on their .final switch, and
+                        off_final_change, the change from the state
+        spread:         percentage points between the most and least used
+                        destination switches
+        switches:       dictionary of switch_id to the ports, free,
+                        critical and off_final of each source and
+                        destination switch
     '''
-    logger = logging.getLogger()
-    logger.debug('Generating port configurations')
-    from_port, to_port = ports[0], ports[1]
-    run_sheet = []
-    # Generate the run sheet
-    disable_config = get_disable_port(from_port.switch_id,
-            from_port.port_id, to_port.switch_id, to_port.port_id,
-            from_port.vlan, from_port.description)
-    enable_config = get_enable_port(from_port.switch_id,from_port.port_id,
-            to_port.switch_id, to_port.port_id, from_port.vlan,
-            from_port.description)
-    run_sheet_list = ([from_port.description,from_port.switch_id, from_port.port_id,
-        disable_config, to_port.switch_id, to_port.port_id, from_port.vlan,
-        enable_config])
-    return(run_sheet_list)
+    source_t = scenario_d['source']
+    destination_t = scenario_d['destination']
+    overlay = get_overlay(switchports_d)
+    overlay.preload(source_t + destination_t)
+    free_ports = overlay.reindex().subset(destination_t)
+    # Plan against the overlay as it is, as move does, then apply
+    plan_l = list(plan_move(overlay, free_ports, source_t, destination_t,
+                            scenario_d['policy']))
+    moves = unplaced = 0
+    for from_port, to_port in plan_l:
+        if to_port is None:
+            unplaced += 1
+            continue
+        apply_move(overlay, from_port.switch_id, from_port.port_id,
+                   to_port.switch_id, to_port.port_id, from_port.vlan,
+                   from_port.description)
+        moves += 1
+    aggregates = overlay.aggregates
+    switches_d = dict()
+    for switch_id in dict.fromkeys(source_t + destination_t):
+        ports, free, off_final = aggregates.switches_d.get(switch_id,
+                                                           (0, 0, 0))
+        switches_d[switch_id] = {
+            'ports': ports, 'free': free,
+            'critical': sum(aggregates.critical_d.get(switch_id, {}).values()),
+            'off_final': off_final}
+    used_l = [1 - switches_d[switch_id]['free'] / switches_d[switch_id]['ports']
+              for switch_id in destination_t
+              if switches_d[switch_id]['ports']]
+    off_final = sum(counts[2] for counts in aggregates.switches_d.values())
+    return dict(scenario_d, moves=moves, unplaced=unplaced,
+                free=sum(switches_d[switch_id]['free']
+                         for switch_id in set(destination_t)),
+                min_free=min(switches_d[switch_id]['free']
+                             for switch_id in destination_t),
+                off_final=off_final,
+                off_final_change=off_final - sum(
+                    counts[2] for counts in
+                    switchports_d.get_aggregates().switches_d.values()),
+                spread=round(100 * (max(used_l) - min(used_l)), 1)
+                       if used_l else 0.0,
+                switches=switches_d)
+
 
+# The state a simulate worker process loaded, see init_simulate_worker
+SIMULATE_STATE = None
 
-def move_interfaces(rundir, runsheet, confdir, confile, source, destination):
+
+def init_simulate_worker(confdir, confile):
 
     '''
-    Function generates enable and disable configuation for moving interfaces from one or more switches to one ore more
-    switches.
+    Load the state once in a simulate worker process.
+    '''
+    global SIMULATE_STATE
+    SIMULATE_STATE = load_switchports(confdir, confile)
 
-    First, SwitchPorts.final is checked. If destination switch matches, an interface from that switch is allocated. All
-    other interfaces are distributed evenly over the destination switches.
+
+def run_simulate_worker(scenario_d):
+    return simulate_scenario(SIMULATE_STATE, scenario_d)
+
+
+def simulate_switchports(scenariocsv, confdir, confile, policy='most-free',
+                         workers=None, output_format='text'):
+
+    '''
+    Compare candidate moves without writing run sheets. The state is loaded
+    once, and every scenario of scenariocsv is applied to a copy-on-write
+    overlay of it by simulate_scenario, so a scenario only copies the
+    switches it moves hosts between.
+
+    With workers, scenarios are spread over worker processes, each loading
+    the state once. This only pays off for scenarios moving hosts between
+    thousands of switches, the overlays of smaller ones cost less than
+    starting a process. Under serve they run in the serve process, against
+    the state it keeps.
 
     Parameters
     ----------
-    rundir:         string, passed by docopt.
-                    The directory to save the run sheet to.
-    runsheet:       string, passed by docopt.
-                    The file to save the run sheet to.
+    scenariocsv:    string, passed by docopt.
+                    CSV of scenarios, see load_scenarios
     confdir:        string, passed by docopt.
                     The directory that instances of SwitchPort are stored in.
     confile:        string, passed by docopt.
                     The file that instances of SwitchPort are saved to.
-    source:         string, passed by docopt.
-                    Comma separated list of switch ids
-    destination:    string, passed by docopt.
-                    Comm separated list of switch ids
+    policy:         string, passed by docopt.
+                    Allocation policy of scenarios without one
+    workers:        integer, passed by docopt.
+                    Number of processes, scenarios run in this process if
+                    None
+    output_format:  string, passed by docopt.
+                    text for a table, json for every figure
 
     Returns
     -------
-    None
-
-    Calls
-    -----
-    load_switchports(confdir, confile)
-    get_available_port_d(switchports_d, destination_t)
+    result_l : list of dictionaries, as returned by simulate_scenario
     '''
+    import json
 
     logger = logging.getLogger()
-    logger.debug(print(rundir, runsheet, confdir,confile, source, destination))
-
-    # Load the switchport dictionary.
+    if output_format not in ('text', 'json'):
+        raise ValueError('Unknown simulate format ' + output_format
+                         + ', use text or json')
     switchports_d = load_switchports(confdir, confile)
+    scenario_l = load_scenarios(scenariocsv, set(switchports_d.switch_ids()),
+                                policy)
+    workers = min(workers or 1, len(scenario_l))
+    if workers > 1 and STATE_CACHE is None:
+        from concurrent.futures import ProcessPoolExecutor
+        logger.info('Simulating %s scenarios in %s processes',
+                    len(scenario_l), workers)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_simulate_worker,
+                                 initargs=(confdir, confile)) as executor:
+            result_l = list(executor.map(run_simulate_worker, scenario_l))
+    else:
+        result_l = [simulate_scenario(switchports_d, scenario_d)
+                    for scenario_d in scenario_l]
 
-    # Need turn $source and $destination in to tuples
-    source_t = tuple(source.split(','))
-    destination_t = tuple(destination.split(','))
+    if output_format == 'json':
+        print(json.dumps(result_l, indent=2))
+    else:
+        width = max([len(result_d['name']) for result_d in result_l] + [8])
+        print('Scenario'.ljust(width), 'Policy       Moves Unplaced    Free '
+              'Min free Off final  Spread')
+        for result_d in result_l:
+            print(result_d['name'].ljust(width),
+                  result_d['policy'].ljust(11), '%7d%9d%8d%9d%10d%7.1f%%' % (
+                      result_d['moves'], result_d['unplaced'],
+                      result_d['free'], result_d['min_free'],
+                      result_d['off_final'], result_d['spread']))
+    return result_l
 
-    # Need a dict of swtichports that are available for hosts to move to
-    available_ports_d = get_available_port_d(switchports_d, destination_t)
-    logger.info('Recieved dictionary available_ports_d')
-
-    # Sort the dictionary so that the run is repeatable, as dictonaries are random
-    sorted_available_ports_d = dict()
-    for destination_id in destination_t:
-        logging.debug('Sorting dictionary key %s ', destination_id)
-        sorted_available_ports_d[destination_id] = OrderedDict(
-                sorted(available_ports_d[destination_id].items(),
-                key=lambda t: t[0]))
-    logger.debug('Sorted Dictionary %s', pp.pformat(sorted_available_ports_d))
-
-    # Match final destinations before allocating randomly
-    run_sheet_l, sorted_available_ports_d, switchports_d = \
-    match_final_state(switchports_d, sorted_available_ports_d,
-    source_t, destination_t)
-    # Match rest of the ports
-
-    # Get number of available ports on each swtich so that hosts not allocated
-    # to a specific port can be distributed evenly
-    count = 0
-    dst_max_l = []
-    for dst in destination_t:
-        dst_max_l.append((len(sorted_available_ports_d[dst].values())))
-        logger.debug('dst_max_l: %s', pp.pformat(dst_max_l))
-    for source in source_t:
-        for source_port in switchports_d[source].values():
-            logger.debug('source_port.vlan: %s source_port.status %s',source_port.vlan, source_port.status)
-            if (source_port.vlan == '1296' or source_port.vlan == '1297') \
-                    and source_port.status != 'disabled':
-                count += 1
-                logger.debug('Matched %s with %s, count: %s', source_port.vlan,
-                        source_port.status, count)
-
-               # Index returned by below matches the switch string in
-               # desination_t and its place in dst_max_l
-                max_dst_idx = dst_max_l.index(max(dst_max_l))
-                dst_max_l[max_dst_idx] -= 1
-                logging.debug('max_dst_idx: %s, dst_max_l %s',max_dst_idx,
-                        dst_max_l)
-                to_port =\
-                  sorted_available_ports_d[destination_t[max_dst_idx]].popitem()[1]
-                logger.debug('source_port %s, to_port: %s',
-                        pp.pformat(to_port), pp.pformat(to_port))
-                ports = (source_port, to_port)
-                run_sheet_l.append(configure_ports(ports))
-    logging.info('%s not mached to final swtich', count)
-    write_csv_file(run_sheet_l, rundir, runsheet)
+# The StateCache of a running serve, None when a command runs on its own
+STATE_CACHE = None
 
-def write_csv_file(runsheet, outdir, outname):
+# Commands that change a state file. serve saves the pending state before
+# running one, so the state on disk can be reloaded if it fails half way.
+MUTATING_COMMANDS = ('init', 'ingest', 'collect', 'mark', 'update',
+                     'apply', 'compact', 'convert')
+
+# serve saves changed state this many seconds after a command changed it,
+# so a burst of commands is saved once
+SAVE_DELAY = 1.0
+
+
+class StateCache():
     '''
-    Writes a list to csv_file.
+    Inventories kept in memory by serve, keyed by the absolute path of their
+    state file.
 
-    Parametes
-    ---------
-    filename :  string, name of the csv file
-    outdir:     string, name of output directory
-    outname:    string, name of output file
+    load_switchports returns the cached Inventory as long as its state file
+    and move journal are unchanged on disk. dump_switchports only records
+    the Inventory as pending, and the writer thread saves it SAVE_DELAY
+    seconds later. Commands and saves are serialized by lock.
 
-    Returns
-    -------
-    None
+    entries_d:      Dictionary of path, [switchports_d, confdir, confile,
+                    signature, dirty]. confdir is absolute, signature the
+                    size and modification time of the files on disk, and
+                    dirty is True while the Inventory is not saved.
+    touched:        Paths used by the command running
+    lock:           threading.Lock, held while a command runs or state is
+                    saved
+    pending:        threading.Event, set when there is state to save
+    saving:         True while save writes, so dump_switchports writes
     '''
 
-    logger = logging.getLogger()
-    # Create directory if required.
-    path_filename = os.getcwd() + '/' + outdir + '/' + outname
-    logging.debug('path_filename: %s', path_filename)
-    os.makedirs(os.path.dirname(path_filename), exist_ok=True)
-    # Write csv file
-    logging.info('Writing %s to dir %s', outname, outdir)
-    with open(path_filename, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(['Description','From Switch','From Interface',
-                         'Disable Configuration', 'To Switch',
-                         'To Interface', 'vlan', 'Enable Configuration'])
-        for row in runsheet:
-            writer.writerow(row)
+    def __init__(self):
+        import threading
 
-def update_switchports(updatecsv, confdir, confile, updatedir, updatefile):
+        self.entries_d = dict()
+        self.touched = set()
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.saving = False
+        self.stopped = False
+
+    def get_path(self, confdir, confile):
+        return os.path.abspath(os.path.join(confdir, confile))
+
+    def get_signature(self, confdir, confile):
+        signature = []
+        for path in (os.path.join(confdir, confile),
+                     get_journal_file(confdir, confile)):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def get(self, confdir, confile):
+        '''
+        Return the cached Inventory of the state file, or None if it is not
+        cached or was changed on disk since.
+        '''
+        path = self.get_path(confdir, confile)
+        entry = self.entries_d.get(path)
+        if entry is None:
+            return None
+        if not entry[4] and entry[3] != self.get_signature(confdir, confile):
+            del self.entries_d[path]
+            return None
+        self.touched.add(path)
+        return entry[0]
+
+    def put(self, switchports_d, confdir, confile):
+        '''
+        Cache switchports_d, as just loaded from the state file.
+        '''
+        path = self.get_path(confdir, confile)
+        self.entries_d[path] = [switchports_d, os.path.abspath(confdir),
+                                confile, self.get_signature(confdir, confile),
+                                False]
+        self.touched.add(path)
+
+    def defer(self, switchports_d, confdir, confile):
+        '''
+        Record switchports_d as the pending state of the state file, and
+        return True, or return False if it has to be written now.
+
+        The Inventory no longer stands for any other state file it was
+        loaded from, so those are dropped and reloaded when next used.
+        '''
+        if self.saving or self.stopped:
+            return False
+        if isinstance(switchports_d, Inventory):
+            # As if it was loaded back from the state file
+            switchports_d.sort()
+        path = self.get_path(confdir, confile)
+        for other in [other for other, entry in self.entries_d.items()
+                      if entry[0] is switchports_d and other != path]:
+            del self.entries_d[other]
+        self.entries_d[path] = [switchports_d, os.path.abspath(confdir),
+                                confile, None, True]
+        self.touched.add(path)
+        self.pending.set()
+        return True
+
+    def save(self):
+        '''
+        Write every pending Inventory to its state file, lock must be held.
+        '''
+        self.pending.clear()
+        for entry in self.entries_d.values():
+            if not entry[4]:
+                continue
+            switchports_d, confdir, confile = entry[:3]
+            self.saving = True
+            try:
+                dump_switchports(switchports_d, confdir, confile)
+            finally:
+                self.saving = False
+            entry[3] = self.get_signature(confdir, confile)
+            entry[4] = False
+
+    def finish(self):
+        '''
+        End a command that succeeded. The state files it changed itself,
+        such as by appending to a journal, are taken as current.
+        '''
+        for path in self.touched:
+            entry = self.entries_d.get(path)
+            if entry is not None and not entry[4]:
+                entry[3] = self.get_signature(entry[1], entry[2])
+        self.touched.clear()
+
+    def discard(self):
+        '''
+        End a command that failed, dropping the saved Inventories it used as
+        it may have changed them half way. They are reloaded when next used.
+        '''
+        for path in self.touched:
+            entry = self.entries_d.get(path)
+            if entry is not None and not entry[4]:
+                del self.entries_d[path]
+        self.touched.clear()
+
+    def run_writer(self):
+        '''
+        Body of the writer thread, saving pending state until stopped.
+        '''
+        logger = logging.getLogger()
+        while not self.stopped:
+            self.pending.wait()
+            time.sleep(SAVE_DELAY)
+            with self.lock:
+                if self.stopped:
+                    break
+                try:
+                    self.save()
+                except Exception:
+                    logger.exception('Saving state failed')
+
+    def run(self, request_d):
+        '''
+        Run the command of a client request, as migrate.py would with the
+        same arguments in the same directory.
+
+        Parameters
+        ----------
+        request_d : dictionary with keys
+            argv:   list of command line arguments, without migrate.py
+            cwd:    string, directory of the client
+
+        Returns
+        -------
+        reply_d : dictionary with keys
+            stdout: string, what the command printed
+            stderr: string, its log and errors
+            status: integer, exit status
+        '''
+        import contextlib
+        import io
+        import traceback
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        handler = logging.StreamHandler(stderr)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        root_logger = logging.getLogger()
+        status = 0
+        with self.lock:
+            root_logger.addHandler(handler)
+            try:
+                with contextlib.redirect_stdout(stdout), \
+                        contextlib.redirect_stderr(stderr):
+                    try:
+                        os.chdir(request_d['cwd'])
+                        docopt_args = parse_args(request_d['argv'])
+                        if docopt_args['serve']:
+                            raise ValueError('serve is already running')
+                        if any(docopt_args[command]
+                               for command in MUTATING_COMMANDS):
+                            self.save()
+                        main(docopt_args)
+                        self.finish()
+                    except SystemExit as exit:
+                        # docopt exits on --help and usage errors
+                        self.discard()
+                        if isinstance(exit.code, str):
+                            print(exit.code, file=sys.stderr)
+                            status = 1
+                        else:
+                            status = exit.code or 0
+                    except Exception:
+                        self.discard()
+                        traceback.print_exc()
+                        status = 1
+            finally:
+                root_logger.removeHandler(handler)
+        return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+                'status': status}
+
+
+def serve_switchports(socket_file):
 
     '''
-    Load switchport state. Update switchport state from CSV Save switchport
-    state.
+    Run commands sent by migrate.py clients over the Unix socket socket_file,
+    keeping the state in memory between them, until stopped with SIGTERM
+    or SIGINT.
+
+    Every state file is loaded once, when first used, and reloaded only if
+    it is changed on disk by something else. The RenderCache of rendered
+    port configurations stays loaded. Commands run one at a time.
+    Changed state is saved in the background by a writer thread, and
+    before a command that changes state runs, and when serve stops.
+
+    Clients send one JSON line, {"argv": [...], "cwd": "..."}, and get one
+    JSON line back, see StateCache.run and run_client.
 
     Parameters
     ----------
-    condir:      string, the dirctory where existing switchport state information is
-                 stored
-    confile:     string, the name of the file storing swtichport state
-    updatedir:   string, name of the directory where updated switchport state is
-                 written.
-    updatefile:  string, name of the file storing switchport state
+    socket_file:    string, passed by docopt.
+                    The Unix socket to listen on.
 
     Returns
     -------
     None
     '''
+    global STATE_CACHE
+    import json
+    import signal
+    import socketserver
+    import threading
+
     logger = logging.getLogger()
-    logger.info('Loading switchport state from dir: %s, file %s',confdir,
-            confile)
-    switchports_d = load_switchports(confdir, confile)
-    logger.debug('switchports_d: ', pp.pformat(switchports_d))
-    path_filename = os.getcwd() + '/' + updatedir + '/' + updatefile
-    logging.debug('path_filename: %s', path_filename)
-    os.makedirs(os.path.dirname(path_filename), exist_ok=True)
-    # Read csv file
-    logging.info('Reading %s from dir %s', updatedir, updatefile)
-    with open(updatecsv, 'r', newline='') as csv_file:
-        reader = csv.reader(csv_file)
-        # skip headers
-        next(reader)
-        for row in reader:
-            description, from_switch, from_port, to_switch, to_port, vlan = \
-                    row[0], row[1], row[2], row[4], row[5], row[6]
-            
-            old = switchports_d[from_switch][from_port]
-            new = switchports_d[to_switch][to_port]
-
-            logger.debug('old port: %s, new port = %s', old, new)
-           
-            logger.debug( 'Original NEW: new.vlan %s, new.description, %s, new.status, %s, new.final, %s',new.vlan, new.description, new.status, new.final)
-            
-            # Need to move the final attribute with the rest of the config
-            # Do this first as .final on the old interface is getting blanked
-            new.vlan, new.description, new.status, new.final =\
-                    vlan, description, 'connected', old.final
-            logger.debug('Updated NEW: new.vlan %s, new.description, %s, new.status, %s, new.final %s',new.vlan, new.description, new.status, new.final)
-
-            logger.debug('Original OLD: old.vlan %s, old.description, %s, old.status, %s, old.final %s',old.vlan, old.description, old.status, old.final)
-            #Blank everything, it's a free port now
-            old.vlan, old.description, old.status, old.final =\
-            '','', 'disabled',''
-            logger.debug('Updated OLD: old.vlan %s, old.description, %s,old.status, %s, old.final %s', old.vlan, old.description, old.status, old.final)
-    dump_switchports(switchports_d, updatedir, updatefile)
-
-
-def finalize(rundir, runsheet, confdir, confile, source, destination):
+    socket_file = os.path.abspath(socket_file)
+    if os.path.exists(socket_file):
+        os.remove(socket_file)
+    STATE_CACHE = cache = StateCache()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            request_d = json.loads(self.rfile.readline())
+            logger.info('serve: %s', ' '.join(request_d['argv']))
+            reply_d = cache.run(request_d)
+            self.wfile.write(json.dumps(reply_d).encode() + b'\n')
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    writer = threading.Thread(target=cache.run_writer, name='writer',
+                              daemon=True)
+    writer.start()
+    signal.signal(signal.SIGTERM, stop)
+    server = socketserver.UnixStreamServer(socket_file, RequestHandler)
+    print('Serving on', socket_file)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_file)
+        with cache.lock:
+            cache.stopped = True
+            cache.save()
+        cache.pending.set()
+        STATE_CACHE = None
+        logger.info('serve stopped')
+
+def run_client(socket_file, argv):
 
     '''
-    Function matches PortSwitch.final of hosts being moved with
-    PortSwitch.switch_id of available port switches and returns configuration
-    to both enable the new port and disable the old port.
+    Send the command line argv to the serve listening on socket_file, print
+    its output and return its exit status.
+
+    Returns
+    -------
+    status : integer, or None if no serve is listening on socket_file
+    '''
+    import json
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_file)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        client.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode()
+                       + b'\n')
+        reply_d = json.loads(client.makefile('rb').readline())
+    sys.stdout.write(reply_d['stdout'])
+    sys.stderr.write(reply_d['stderr'])
+    return reply_d['status']
+
+def profile_command(docopt_args):
+
+    '''
+    Run the command of docopt_args with a Profiler, print its summary to
+    stderr and save the report given by --REPORT.
+
+    A report ending in .prof is a cProfile dump for pstats. cProfile and
+    tracemalloc would distort each other, so peak memory is not traced for
+    it. Any other report is saved as JSON.
 
     Parameters
     ----------
-    rundir:         string, passed by docopt.
-                    The directory to save the run sheet to.
-    runsheet:       string, passed by docopt.
-                    The file to save the run sheet to.
-    confdir:        string, passed by docopt.
-                    The directory that instances of SwitchPort are stored in.
-    confile:        string, passed by docopt.
-                    The file that instances of SwitchPort are saved to.
-    source:         string, passed by docopt.
-                    Comma separated list of switch ids
-    destination:    string, passed by docopt.
-                    Comm separated list of switch ids
+    docopt_args : dictionary of arguments from docopt()
 
     Returns
     -------
-    None
+    profiler : Profiler of the command
+    '''
+    global PROFILER
+    logger = logging.getLogger()
+    report = docopt_args.get('--REPORT')
+    cprofile = report is not None and report.endswith('.prof')
+    PROFILER = profiler = Profiler(trace_memory=not cprofile)
+    if cprofile:
+        import cProfile
+        python_profiler = cProfile.Profile()
+    profiler.start()
+    # Commands exiting with a status, such as diff, are still reported
+    exit_status = None
+    try:
+        if cprofile:
+            python_profiler.runcall(run_command, docopt_args)
+        else:
+            run_command(docopt_args)
+    except SystemExit as error:
+        exit_status = error
+    finally:
+        profiler.stop()
+        PROFILER = None
+    print(profiler.summary(), file=sys.stderr)
+    if cprofile:
+        python_profiler.dump_stats(report)
+    elif report is not None:
+        import json
+        with open(report, 'w') as outfile:
+            json.dump(profiler.report(), outfile, indent=2)
+    if report is not None:
+        logger.info('Profile saved to %s', report)
+    if exit_status is not None:
+        raise exit_status
+    return profiler
+
+@functools.lru_cache(maxsize=None)
+def get_command_usage():
 
-    Calls
-    -----
-    load_switchports(confdir, confile)
-    get_available_port_d(switchports_d, destination_t)
     '''
+    Split the usage of __doc__ by command.
 
-    logger = logging.getLogger()
-    logger.debug(print(rundir, runsheet, confdir,confile, source, destination))
+    Returns
+    -------
+    usage_d : dictionary of command, the usage docopt needs to parse that
+              command alone: its patterns and the Options section
+    '''
+    usage, options = __doc__.split('\nOptions:', 1)
+    patterns_d = defaultdict(list)
+    command = None
+    for line in usage.splitlines()[2:]:
+        if line.startswith('    migrate.py '):
+            command = line.split()[1]
+        if command is not None and line.strip():
+            patterns_d[command].append(line)
+    return {command: 'Usage:\n' + '\n'.join(patterns) + '\n\nOptions:'
+            + options for command, patterns in patterns_d.items()}
 
-    # Load the switchport dictionary.
-    switchports_d = load_switchports(confdir, confile)
 
-    # Need turn $source and $destination in to tuples
-    source_t = tuple(source.split(','))
-    destination_t = tuple(destination.split(','))
+def parse_args(argv):
 
-    # Need a dict of swtichports that are available for hosts to move to
-    available_ports_d = get_available_port_d(switchports_d, destination_t)
-    logger.info('Recieved dictionary available_ports_d')
+    '''
+    Parse argv with docopt, against the usage of its command only.
 
-    # List for the run sheet
-    run_sheet_l = list()
+    docopt matches every pattern of the usage against every other one, so
+    with a pattern per command parsing the full usage is most of the
+    startup time of a command. The other commands are set to False, so
+    dispatching on them works as with the full usage. --help on its own is
+    printed as docopt prints it, without parsing the usage, and anything
+    else is parsed against the full usage.
+    '''
+    if argv in (['-h'], ['--help']):
+        print(__doc__.strip('\n'))
+        sys.exit()
+    from docopt import docopt
 
-    # Sort the dictionary so that the run is repeatable, as dictonaries are random
-    sorted_available_ports_d = dict()
-    for destination_id in destination_t:
-        logging.debug('Sorting dictionary key %s ', destination_id)
-        sorted_available_ports_d[destination_id] = OrderedDict(
-            sorted(available_ports_d[destination_id].items(),
-                   key=lambda t: t[0]))
-    logger.debug('Sorted Dictionary %s', pp.pformat(sorted_available_ports_d))
+    usage_d = get_command_usage()
+    if not argv or argv[0] not in usage_d:
+        return docopt(__doc__, argv)
+    docopt_args = docopt(usage_d[argv[0]], argv)
+    for command in usage_d:
+        docopt_args.setdefault(command, False)
+    return docopt_args
 
-    # Match final destinations before allocating randomly
-    run_sheet_l, sorted_available_ports_d, switchports_d = \
-        match_final_state(switchports_d, sorted_available_ports_d,
-                          source_t, destination_t)
-    write_csv_file(run_sheet_l, rundir, runsheet)
 
 def main(docopt_args):
     """ main-entry point for program, expects dict with arguments from docopt() """
 
     # Notice, no checking for -h, or --help is written here.
     logger = logging.getLogger()
-    logger.debug('Docopt Dictionary: %s', pp.pformat(args))
+    logger.debug('Docopt Dictionary: %s', LazyFormat(pformat, docopt_args))
     # docopt will automagically check for it and use your usage string.
 
+    if docopt_args.get('--PROFILE') or docopt_args.get('--REPORT'):
+        profile_command(docopt_args)
+    else:
+        run_command(docopt_args)
+
+def run_command(docopt_args):
+    """ Run the command selected in docopt_args """
+
+    set_critical_rules(docopt_args.get('--RULES'))
     if docopt_args['init']:
         get_switchports_d(docopt_args['<initcsv>'],
                           docopt_args['--CONFDIR'],
                           docopt_args['--CONFILE']
                           )
+    elif docopt_args['ingest']:
+        workers = docopt_args['--WORKERS']
+        ingest_switchports(docopt_args['<capture>'],
+                           docopt_args['--CONFDIR'],
+                           docopt_args['--CONFILE'],
+                           int(workers) if workers is not None else None)
+    elif docopt_args['collect']:
+        failed_l = collect_switchports(docopt_args['<devicecsv>'],
+                                       docopt_args['--CONFDIR'],
+                                       docopt_args['--CONFILE'],
+                                       int(docopt_args['--CONCURRENCY']),
+                                       float(docopt_args['--TIMEOUT']),
+                                       int(docopt_args['--RETRIES']),
+                                       docopt_args['--CAPTUREDIR'])
+        if failed_l:
+            sys.exit(1)
     elif docopt_args['mark']:
        mark_switchports_final(docopt_args['<finalcsv>'],
                               docopt_args['--CONFDIR'],
@@ -736,34 +5726,100 @@ def main(docopt_args):
                             docopt_args['--CONFDIR'],
                             docopt_args['--CONFILE'],
                             docopt_args['<source>'],
-                            docopt_args['<destination>'])
+                            docopt_args['<destination>'],
+                            docopt_args['--POLICY'],
+                            docopt_args['--TEMPLATES'])
     elif docopt_args['update']:
         update_switchports( docopt_args['<updatecsv>'],
                             docopt_args['--CONFDIR'],
                             docopt_args['--CONFILE'],
                             docopt_args['--UPDATEDIR'],
                             docopt_args['--UPDATEFILE'])
+    elif docopt_args['apply']:
+        errors_d = apply_runsheet(docopt_args['<runsheetcsv>'],
+                                  docopt_args['<devicecsv>'],
+                                  docopt_args['--CONFDIR'],
+                                  docopt_args['--CONFILE'],
+                                  docopt_args['--UPDATEDIR'],
+                                  docopt_args['--UPDATEFILE'],
+                                  int(docopt_args['--CONCURRENCY']),
+                                  float(docopt_args['--TIMEOUT']),
+                                  int(docopt_args['--RETRIES']),
+                                  docopt_args['--DRYRUN'])
+        if errors_d:
+            sys.exit(1)
+    elif docopt_args['classify']:
+        classify_switchports(docopt_args['--CONFDIR'],
+                             docopt_args['--CONFILE'],
+                             docopt_args['<switch>'],
+                             docopt_args['--LIST'],
+                             docopt_args['--FORMAT'])
+    elif docopt_args['diff']:
+        as_of = docopt_args['--ASOF']
+        diff_d = diff_switchports(docopt_args['--CONFDIR'],
+                                  docopt_args['--CONFILE'],
+                                  docopt_args['--UPDATEDIR'],
+                                  docopt_args['--UPDATEFILE'],
+                                  int(as_of) if as_of is not None else None,
+                                  docopt_args['--FORMAT'])
+        if diff_d['ports']:
+            sys.exit(1)
+    elif docopt_args['simulate']:
+        workers = docopt_args['--WORKERS']
+        simulate_switchports(docopt_args['<scenariocsv>'],
+                             docopt_args['--CONFDIR'],
+                             docopt_args['--CONFILE'],
+                             docopt_args['--POLICY'],
+                             int(workers) if workers is not None else None,
+                             docopt_args['--FORMAT'])
     elif docopt_args['final']:
         finalize( docopt_args['--RUNDIR'],
                             docopt_args['--RUNSHEET'],
                             docopt_args['--CONFDIR'],
                             docopt_args['--CONFILE'],
                             docopt_args['<source>'],
-                            docopt_args['<destination>'])
+                            docopt_args['<destination>'],
+                            docopt_args['--TEMPLATES'])
+    elif docopt_args['convert']:
+        as_of = docopt_args['--ASOF']
+        convert_switchports(docopt_args['<newconfile>'],
+                            docopt_args['--CONFDIR'],
+                            docopt_args['--CONFILE'],
+                            int(as_of) if as_of is not None else None)
+    elif docopt_args['flatten']:
+        flatten_switchports(docopt_args['--RUNDIR'],
+                            docopt_args['--RUNSHEET'],
+                            docopt_args['--CONFDIR'],
+                            docopt_args['--CONFILE'],
+                            docopt_args['--TEMPLATES'])
+    elif docopt_args['status']:
+        status_switchports(docopt_args['--CONFDIR'],
+                           docopt_args['--CONFILE'],
+                           docopt_args['<switch>'],
+                           docopt_args['--FORMAT'])
+    elif docopt_args['compact']:
+        compact_switchports(docopt_args['--CONFDIR'],
+                            docopt_args['--CONFILE'])
+    elif docopt_args['serve']:
+        serve_switchports(docopt_args['--SOCKET'])
 
     #     load_switchports()
 
 if __name__ == '__main__':
 
+    # With MIGRATE_SOCKET set, commands are run by the serve listening on it
+    socket_file = os.getenv('MIGRATE_SOCKET')
+    if socket_file and sys.argv[1:2] != ['serve']:
+        status = run_client(socket_file, sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
     setup_logging()
 
     # Docopt will check all arguments, and exit with the Usage string if they
-    # don't pass.  If you simply want to pass your own modules documentation
-    # then use __doc__, otherwise, you would pass another docopt-friendly usage
-    # string here.  You could also pass your own arguments instead of sys.argv
-    # with: docopt(__doc__, argv=[your, args])
-
-    args = docopt(__doc__)
+    # don't pass. parse_args only gives it the usage of the command run, see
+    # get_command_usage.
+    args = parse_args(sys.argv[1:])
 
     # We have valid args, so run the program.
     main(args)
@@ -0,0 +1,170 @@
+'''
+Fixtures shared by the tests: a small estate of four switches, and
+fakedevice.py serving them over TCP on free local ports.
+
+'''
+import csv
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import migrate
+
+FAKEDEVICE = os.path.join(REPO_DIR, 'fakedevice.py')
+
+SWITCH_IDS = ('sw1', 'sw2', 'sw3', 'sw4')
+PORTS_PER_SWITCH = 12
+
+
+def get_port_id(index):
+    return 'Gi1/0/' + str(index)
+
+
+def get_estate_rows():
+
+    '''
+    Return the rows of the init CSV: sw1 and sw2 have a host in a critical
+    vlan on every even port, sw3 and sw4 have every port free.
+    '''
+    rows = []
+    for switch_id in SWITCH_IDS:
+        for index in range(1, PORTS_PER_SWITCH + 1):
+            if switch_id in ('sw1', 'sw2') and index % 2 == 0:
+                vlan = '1296' if index % 4 == 0 else '1297'
+                rows.append([switch_id, get_port_id(index), 'connected',
+                             vlan, 'host-%s-%s' % (switch_id, index)])
+            else:
+                rows.append([switch_id, get_port_id(index), 'disabled', '',
+                             'disabled'])
+    return rows
+
+
+def write_capture(capture_file, switch_id, ports):
+
+    '''
+    Write a capture of show interface status and show interface description
+    of switch_id, ports being (port_id, status, vlan, description), in the
+    format fakedevice.py answers from and ingest reads.
+    '''
+    lines = [switch_id + '#show interface status', '',
+             'Port      Name               Status       Vlan       Duplex  '
+             'Speed Type']
+    for port_id, status, vlan, description in ports:
+        lines.append('%-9s %-18s %-12s %-10s a-full a-1000 10/100/1000BaseTX'
+                     % (port_id, description, status, vlan or '1'))
+    lines += ['', switch_id + '#show interface description',
+              'Interface                      Status         Protocol '
+              'Description']
+    for port_id, status, vlan, description in ports:
+        state = ('up             up      ' if status == 'connected'
+                 else 'admin down     down    ')
+        lines.append('%-30s %s %s' % (port_id, state, description))
+    lines += ['', switch_id + '#']
+    with open(capture_file, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+
+    '''
+    Keep the caches of migrate.py, such as the RenderCache, in
+    tmp_path/cache, and start every test without a RenderCache loaded.
+    '''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(migrate, 'RENDER_CACHE', None)
+    return tmp_path / 'cache' / 'migrate'
+
+
+@pytest.fixture
+def estate(tmp_path):
+
+    '''
+    Initialise the state of the estate in tmp_path/switchports, and return
+    the confdir and confile of it.
+    '''
+    initcsv = tmp_path / 'init.csv'
+    with open(initcsv, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['switch_id', 'port', 'status', 'vlan',
+                         'description'])
+        writer.writerows(get_estate_rows())
+    confdir = str(tmp_path / 'switchports')
+    migrate.get_switchports_d(str(initcsv), confdir, 'switchports.yaml')
+    return confdir, 'switchports.yaml'
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def fakedevices(tmp_path):
+
+    '''
+    Return a function starting fakedevice.py for switch_ids, answering from
+    tmp_path/captures and recording to tmp_path/records, that returns the
+    devices CSV. The devices are stopped at the end of the test.
+    '''
+    processes = []
+
+    def start(switch_ids=SWITCH_IDS, delay=0, fail=0, transports=None):
+        devicecsv = str(tmp_path / 'devices.csv')
+        with open(devicecsv, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['switch_id', 'host', 'port', 'site',
+                             'transport'])
+            for switch_id in switch_ids:
+                writer.writerow([switch_id, '127.0.0.1', get_free_port(),
+                                 's1', (transports or {}).get(switch_id,
+                                                              'tcp')])
+        os.makedirs(tmp_path / 'captures', exist_ok=True)
+        log_file = str(tmp_path / 'fakedevice.log')
+        with open(log_file, 'w') as outfile:
+            processes.append(subprocess.Popen(
+                [sys.executable, FAKEDEVICE, devicecsv,
+                 str(tmp_path / 'captures'),
+                 '--RECORD=' + str(tmp_path / 'records'),
+                 '--DELAY=' + str(delay), '--FAIL=' + str(fail)],
+                stderr=outfile))
+        # Connecting to check would use up the connections of --FAIL
+        deadline = time.time() + 10
+        while 'Serving' not in open(log_file).read():
+            assert processes[-1].poll() is None, open(log_file).read()
+            assert time.time() < deadline, 'fakedevice.py did not start'
+            time.sleep(0.05)
+        return devicecsv
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def read_records(tmp_path, switch_id):
+
+    '''
+    Return the commands fakedevice.py recorded for switch_id, as
+    (session, time, command).
+    '''
+    record_file = tmp_path / 'records' / (switch_id + '.log')
+    if not record_file.exists():
+        return []
+    with open(record_file) as infile:
+        return [(int(session), float(seconds), command)
+                for session, seconds, command
+                in (line.rstrip('\n').split(' ', 2) for line in infile)]
+
+
+def read_csv(csvfile):
+    with open(csvfile, newline='') as csv_file:
+        return list(csv.reader(csv_file))
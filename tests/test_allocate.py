@@ -0,0 +1,124 @@
+'''
+move allocates the free ports of the destination switches by --POLICY.
+
+'''
+import pytest
+
+import migrate
+
+
+def get_inventory(sizes_d):
+
+    '''
+    Return an Inventory of switches of sizes_d, (ports, free ports), with
+    the last ports of each switch free.
+    '''
+    switchports_d = migrate.Inventory()
+    for switch_id, (size, free) in sizes_d.items():
+        switchports_d[switch_id] = {}
+        for index in range(1, size + 1):
+            port_id = 'Gi1/0/' + str(index)
+            if index > size - free:
+                port = migrate.SwitchPort(switch_id, port_id, 'disabled', '',
+                                          'disabled')
+            else:
+                port = migrate.SwitchPort(switch_id, port_id, 'connected',
+                                          '10', 'stays')
+            switchports_d[switch_id][port_id] = port
+    return switchports_d
+
+
+def allocate(policy, sizes_d, vlans):
+
+    '''
+    Allocate a host per vlan of vlans to the switches of sizes_d, in order,
+    and return the (switch, port) each host got.
+    '''
+    switchports_d = get_inventory(sizes_d)
+    free_ports = switchports_d.reindex().subset(tuple(sizes_d))
+    allocator = migrate.get_allocator(policy, tuple(sizes_d), free_ports,
+                                      switchports_d)
+    allocated = []
+    for index, vlan in enumerate(vlans):
+        host = migrate.SwitchPort('old', 'Gi1/0/' + str(index), 'connected',
+                                  vlan, 'host-' + str(index))
+        to_port = allocator.allocate(host)
+        allocated.append(to_port and (to_port.switch_id, to_port.port_id))
+    return allocated
+
+
+def test_most_free_takes_the_switch_with_most_free_ports():
+    assert allocate('most-free', {'a': (4, 3), 'b': (4, 1)},
+                    ['10'] * 5) == [
+        ('a', 'Gi1/0/4'), ('a', 'Gi1/0/3'),
+        # a and b have one free port each, the first listed goes first
+        ('a', 'Gi1/0/2'), ('b', 'Gi1/0/4'),
+        None]
+
+
+def test_round_robin_takes_each_switch_in_turn():
+    assert allocate('round-robin', {'a': (4, 3), 'b': (4, 1)},
+                    ['10'] * 4) == [
+        ('a', 'Gi1/0/4'), ('b', 'Gi1/0/4'), ('a', 'Gi1/0/3'),
+        ('a', 'Gi1/0/2')]
+
+
+def test_weighted_takes_in_proportion_to_switch_size():
+    # a has twice the ports of b, so it takes two hosts for each of b
+    assert [switch_id for switch_id, port_id in allocate(
+        'weighted', {'a': (4, 4), 'b': (2, 2)}, ['10'] * 6)] == \
+        ['a', 'a', 'b', 'a', 'a', 'b']
+
+
+def test_vlan_keeps_the_hosts_of_a_vlan_together():
+    assert allocate('vlan', {'a': (4, 4), 'b': (3, 3)},
+                    ['10', '10', '20', '20', '10']) == [
+        ('a', 'Gi1/0/4'), ('a', 'Gi1/0/3'), ('b', 'Gi1/0/3'),
+        ('b', 'Gi1/0/2'), ('a', 'Gi1/0/2')]
+    # most-free spreads the same hosts
+    assert [switch_id for switch_id, port_id in allocate(
+        'most-free', {'a': (4, 4), 'b': (3, 3)},
+        ['10', '10', '20', '20', '10'])] == ['a', 'a', 'b', 'a', 'b']
+
+
+def test_vlan_moves_on_once_its_switch_is_full():
+    assert [switch_id for switch_id, port_id in allocate(
+        'vlan', {'a': (2, 2), 'b': (2, 1)}, ['10', '10', '10'])] == \
+        ['a', 'a', 'b']
+
+
+def test_unknown_policy_is_refused():
+    with pytest.raises(ValueError, match='Unknown allocation policy fair'):
+        allocate('fair', {'a': (1, 1)}, [])
+
+
+def test_hosts_without_room_on_their_final_switch_are_reported(monkeypatch,
+                                                               caplog):
+    switchports_d = get_inventory({'a': (3, 0), 'b': (2, 1), 'c': (4, 4)})
+    for port in switchports_d['a'].values():
+        port.vlan, port.final = '1296', 'b'
+    free_ports = switchports_d.reindex().subset(('b', 'c'))
+    assigned = list(migrate.assign_final_state(
+        switchports_d, free_ports, ('a',), ('b', 'c')))
+    assert [(port.port_id, to_port and to_port.port_id)
+            for port, to_port in assigned] == \
+        [('Gi1/0/1', 'Gi1/0/2'), ('Gi1/0/2', None), ('Gi1/0/3', None)]
+
+    # move logs them, and allocates them as any other critical host
+    monkeypatch.setattr(migrate, 'CRITICAL_RULES',
+                        migrate.get_default_rules())
+    free_ports = switchports_d.reindex().subset(('b', 'c'))
+    moved = set()
+    rows = list(migrate.match_final_state(
+        switchports_d, free_ports, ('a',), ('b', 'c'), moved=moved))
+    rows += list(migrate.move_critical_hosts(
+        switchports_d, free_ports, ('a',), ('b', 'c'), moved=moved))
+    assert [(row[2], row[4]) for row in rows] == \
+        [('Gi1/0/1', 'b'), ('Gi1/0/2', 'c'), ('Gi1/0/3', 'c')]
+    assert 'No free port on final switch b for a:Gi1/0/2' in caplog.text
+    assert 'No free port on final switch b for a:Gi1/0/3' in caplog.text
+
+
+def test_allocator_needs_a_priority():
+    with pytest.raises(TypeError, match='priority'):
+        migrate.Allocator(('a',), migrate.FreePortIndex(), {})
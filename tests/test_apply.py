@@ -0,0 +1,256 @@
+'''
+apply against fakedevice.py.
+
+'''
+import csv
+import subprocess
+import sys
+
+import pytest
+
+import migrate
+from conftest import read_csv, read_records
+
+UPDATEDIR, UPDATEFILE = 'updated_switchports', 'updated_switchport.yaml'
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch, tmp_path):
+    monkeypatch.setattr(migrate, 'RETRY_DELAY', 0.01)
+    # update writes the updated state under the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def runsheet(tmp_path, estate):
+
+    '''
+    Move the hosts of sw1 and sw2 to sw3 and sw4, and return the run sheet.
+    '''
+    confdir, confile = estate
+    # move writes the run sheet under the working directory too
+    migrate.move_interfaces('rundir', 'runsheet.csv', confdir, confile,
+                            'sw1,sw2', 'sw3,sw4')
+    return str(tmp_path / 'rundir' / 'runsheet.csv')
+
+
+def apply(runsheetcsv, devicecsv, estate, **options):
+    confdir, confile = estate
+    return migrate.apply_runsheet(runsheetcsv, devicecsv, confdir, confile,
+                                  UPDATEDIR, UPDATEFILE, timeout=5, **options)
+
+
+def read_results(runsheetcsv):
+
+    '''
+    Return the rows, without header, of the run sheet and of its
+    .applied.csv and .failed.csv.
+    '''
+    stem = runsheetcsv[:-len('.csv')]
+    return [read_csv(csvfile)[1:] for csvfile
+            in (runsheetcsv, stem + '.applied.csv', stem + '.failed.csv')]
+
+
+def get_commands(tmp_path, switch_id):
+    return [command for session, seconds, command
+            in read_records(tmp_path, switch_id)]
+
+
+def assert_moved(rows, moved=True):
+
+    '''
+    Check that the hosts of rows are, or are not, on their new port in the
+    updated state.
+    '''
+    switchports_d = migrate.load_switchports(UPDATEDIR, UPDATEFILE)
+    for row in rows:
+        description, from_switch, from_port, to_switch, to_port = \
+            row[0], row[1], row[2], row[4], row[5]
+        new = switchports_d[to_switch][to_port]
+        old = switchports_d[from_switch][from_port]
+        if moved:
+            assert (new.status, new.description) == \
+                ('connected', description)
+            assert old.status == 'disabled'
+        else:
+            assert old.description == description
+            assert new.description != description
+
+
+def test_apply_pushes_every_row_and_updates_the_state(tmp_path, estate,
+                                                      runsheet, fakedevices):
+    devicecsv = fakedevices()
+    assert apply(runsheet, devicecsv, estate) == {}
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert len(rows) == 12
+    assert applied_l == rows
+    assert failed_l == []
+    assert_moved(rows)
+    # One session and one conf t per switch, with the commands of the rows
+    # in run sheet order
+    commands_d = migrate.plan_apply(rows)
+    for switch_id in ('sw1', 'sw2', 'sw3', 'sw4'):
+        records = read_records(tmp_path, switch_id)
+        assert {session for session, seconds, command in records} == {1}
+        assert [command for session, seconds, command in records] == \
+            ['conf t'] + [command for index, command
+                          in commands_d[switch_id]] + ['end']
+
+
+def test_apply_fails_only_the_rows_a_switch_did_not_take(tmp_path, estate,
+                                                         runsheet,
+                                                         fakedevices):
+    rows = read_csv(runsheet)[1:]
+    sw3_rows = [index for index, row in enumerate(rows) if row[4] == 'sw3']
+    rejected = 'interface ' + rows[sw3_rows[1]][5]
+    (tmp_path / 'captures').mkdir()
+    (tmp_path / 'captures' / 'sw3.txt').write_text(
+        'sw3#' + rejected + "\n% Invalid input detected at '^' "
+        'marker.\n')
+    devicecsv = fakedevices()
+    errors_d = apply(runsheet, devicecsv, estate)
+    assert list(errors_d) == ['sw3']
+    assert errors_d['sw3'].startswith(rejected + ': % Invalid input')
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert failed_l == [rows[index] for index in sw3_rows[1:]]
+    assert applied_l == [row for index, row in enumerate(rows)
+                         if index not in sw3_rows[1:]]
+    assert_moved(applied_l)
+    assert_moved(failed_l, moved=False)
+    # Nothing is sent after the rejected command but end
+    commands = get_commands(tmp_path, 'sw3')
+    assert commands[commands.index(rejected):] == [rejected, 'end']
+
+
+def test_apply_reports_rows_left_without_a_port(tmp_path, estate, runsheet,
+                                                fakedevices, caplog):
+    rows = read_csv(runsheet)[1:]
+    sw3_rows = [index for index, row in enumerate(rows) if row[4] == 'sw3']
+    rejected = 'interface ' + rows[sw3_rows[0]][5]
+    (tmp_path / 'captures').mkdir()
+    (tmp_path / 'captures' / 'sw3.txt').write_text(
+        'sw3#' + rejected + "\n% Invalid input detected at '^' "
+        'marker.\n')
+    devicecsv = fakedevices()
+    apply(runsheet, devicecsv, estate)
+    rows, applied_l, failed_l = read_results(runsheet)
+    # The source switches took the disables of the rows sw3 did not take
+    outage_l = read_csv(runsheet[:-len('.csv')] + '.outage.csv')[1:]
+    assert outage_l == failed_l == [rows[index] for index in sw3_rows]
+    row = outage_l[0]
+    assert 'interface ' + row[2] in get_commands(tmp_path, row[1])
+    assert '%s: old port %s:%s disabled, new port sw3:%s not enabled' % (
+        row[0], row[1], row[2], row[5]) in caplog.text
+    assert_moved(failed_l, moved=False)
+
+
+def test_apply_reports_no_outage_when_the_source_fails(tmp_path, estate,
+                                                       runsheet, fakedevices):
+    devicecsv = fakedevices(transports={'sw1': 'telnet'})
+    apply(runsheet, devicecsv, estate)
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert failed_l == [row for row in rows if row[1] == 'sw1']
+    assert read_csv(runsheet[:-len('.csv')] + '.outage.csv')[1:] == []
+
+
+def test_failed_rows_on_one_switch_split_at_the_rejected_command():
+    block = 'conf t\ninterface {}\n{}\nend'
+    rows = [['host-%s' % index, 'sw1', 'Gi1/0/%s' % index,
+             block.format('Gi1/0/%s' % index, 'shutdown'), 'sw1',
+             'Gi1/0/%s' % (index + 10),
+             '10', block.format('Gi1/0/%s' % (index + 10), 'no shutdown')]
+            for index in (1, 2, 3)]
+    commands_d = migrate.plan_apply(rows)
+    # Each row has 4 commands, 6 accepted is the disable of row 1 taken
+    for accepted, outage_s in ((6, {1}), (4, set()), (5, set())):
+        failed_s, outage = migrate.get_failed_rows(
+            rows, commands_d, {'sw1': 'rejected'}, {'sw1': accepted})
+        assert failed_s == {1, 2}
+        assert outage == outage_s
+    for accepted, outage_s in ((8, set()), (10, {2})):
+        assert migrate.get_failed_rows(
+            rows, commands_d, {'sw1': 'rejected'}, {'sw1': accepted}) == \
+            ({2}, outage_s)
+
+
+def test_apply_fails_a_switch_with_an_unknown_transport(tmp_path, estate,
+                                                        runsheet,
+                                                        fakedevices):
+    devicecsv = fakedevices(transports={'sw4': 'telnet'})
+    errors_d = apply(runsheet, devicecsv, estate)
+    assert list(errors_d) == ['sw4']
+    assert 'Unknown transport telnet' in errors_d['sw4']
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert failed_l == [row for row in rows if row[4] == 'sw4']
+    assert applied_l == [row for row in rows if row[4] != 'sw4']
+    assert_moved(applied_l)
+    assert get_commands(tmp_path, 'sw4') == []
+
+
+def test_apply_fails_a_switch_missing_from_the_devices(tmp_path, estate,
+                                                       runsheet,
+                                                       fakedevices):
+    devicecsv = fakedevices(('sw1', 'sw2', 'sw3'))
+    errors_d = apply(runsheet, devicecsv, estate)
+    assert errors_d == {'sw4': 'not in the devices CSV'}
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert failed_l == [row for row in rows if row[4] == 'sw4']
+
+
+def test_apply_retries_connecting_without_sending_twice(tmp_path, estate,
+                                                        runsheet,
+                                                        fakedevices):
+    devicecsv = fakedevices(fail=1)
+    assert apply(runsheet, devicecsv, estate, retries=1) == {}
+    for switch_id in ('sw1', 'sw2', 'sw3', 'sw4'):
+        assert get_commands(tmp_path, switch_id).count('conf t') == 1
+
+
+def test_apply_fails_switches_it_cannot_connect_to(tmp_path, estate,
+                                                   runsheet, fakedevices):
+    devicecsv = fakedevices(fail=1)
+    errors_d = apply(runsheet, devicecsv, estate, retries=0)
+    assert sorted(errors_d) == ['sw1', 'sw2', 'sw3', 'sw4']
+    assert all(error.startswith('connect failed')
+               for error in errors_d.values())
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert (applied_l, failed_l) == ([], rows)
+
+
+def test_apply_refuses_a_block_without_conf_t(tmp_path, estate, runsheet,
+                                              fakedevices):
+    header, *rows = read_csv(runsheet)
+    rows[2][7] = rows[2][7].replace('conf t', '')
+    with open(runsheet, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows([header] + rows)
+    devicecsv = fakedevices()
+    with pytest.raises(ValueError, match='rows 4 have a block without'):
+        apply(runsheet, devicecsv, estate)
+    for switch_id in ('sw1', 'sw2', 'sw3', 'sw4'):
+        assert get_commands(tmp_path, switch_id) == []
+    assert not (tmp_path / 'rundir' / 'runsheet.applied.csv').exists()
+
+
+def test_apply_dry_run_only_prints(tmp_path, estate, runsheet, fakedevices,
+                                   capsys):
+    devicecsv = fakedevices()
+    assert apply(runsheet, devicecsv, estate, dryrun=True) == {}
+    output = capsys.readouterr().out
+    assert 'sw3:\nconf t\n' in output
+    for switch_id in ('sw1', 'sw2', 'sw3', 'sw4'):
+        assert get_commands(tmp_path, switch_id) == []
+    assert not (tmp_path / UPDATEDIR).exists()
+
+
+def test_apply_exits_with_an_error_when_a_switch_fails(tmp_path, estate,
+                                                       runsheet, fakedevices):
+    confdir, confile = estate
+    devicecsv = fakedevices(transports={'sw4': 'telnet'})
+    process = subprocess.run(
+        [sys.executable, migrate.__file__, 'apply', runsheet, devicecsv,
+         '--CONFDIR=' + confdir, '--CONFILE=' + confile, '--TIMEOUT=5'],
+        cwd=tmp_path, capture_output=True, text=True)
+    assert process.returncode == 1
+    assert 'sw4: apply failed' in process.stderr
+    rows, applied_l, failed_l = read_results(runsheet)
+    assert failed_l == [row for row in rows if row[4] == 'sw4']
@@ -0,0 +1,80 @@
+'''
+benchmark.py generates estates migrate.py loads, and compares the results
+of two versions.
+
+'''
+import pytest
+
+import benchmark
+import migrate
+
+
+def test_generated_estate_loads_and_marks(tmp_path):
+    estate_d = benchmark.generate_estate(1000, seed=3)
+    assert estate_d == benchmark.generate_estate(1000, seed=3)
+    assert estate_d['init_rows'] != \
+        benchmark.generate_estate(1000, seed=4)['init_rows']
+    benchmark.write_estate(estate_d, str(tmp_path))
+    confdir = str(tmp_path / 'switchports')
+    migrate.get_switchports_d(str(tmp_path / 'init.csv'), confdir,
+                              'switchports.db')
+    migrate.mark_switchports_final(str(tmp_path / 'final.csv'), confdir,
+                                   'switchports.db')
+    switchports_d = migrate.load_switchports(confdir, 'switchports.db')
+    switchports_d.load_all()
+    # 1000 ports round up to 21 switches of 48
+    assert (len(estate_d['source']), len(estate_d['destination'])) == (10, 11)
+    assert sum(len(ports_d) for ports_d in switchports_d.values()) == \
+        len(estate_d['init_rows']) - 1 == 21 * 48
+    free_ports = switchports_d.reindex()
+    for switch_id in estate_d['destination']:
+        assert free_ports.count(switch_id) == 48
+    finals = [port.final for ports_d in switchports_d.values()
+              for port in ports_d.values() if port.final]
+    assert len(finals) == len(estate_d['final_rows']) - 1 > 0
+    assert set(finals) <= set(estate_d['destination'])
+    critical = migrate.get_critical_rules()
+    assert any(critical(port) for port in switchports_d['old0000'].values())
+
+
+def get_result(label, step, seconds, size=1000):
+    return {'label': label, 'confile': 'switchports.db', 'size': size,
+            'step': step, 'seconds': seconds, 'max_rss_kb': 2048}
+
+
+def test_compare_reports_the_change_of_the_fastest_runs(capsys):
+    results_l = [
+        get_result('base', 'move_interfaces', 2.5),
+        get_result('base', 'move_interfaces', 2.0),
+        get_result('base', 'update_switchports', 4.0),
+        get_result('head', 'move_interfaces', 3.0),
+        get_result('head', 'move_interfaces', 3.5),
+        get_result('head', 'update_switchports', 3.0),
+        # Only benchmarked for base, so not compared
+        get_result('base', 'finalize', 1.0)]
+    assert benchmark.compare_results(results_l) == [
+        ('switchports.db', 1000, 'move_interfaces', 2.0, 3.0),
+        ('switchports.db', 1000, 'update_switchports', 4.0, 3.0)]
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    # A regression shows as a positive change, an improvement as negative
+    assert 'move_interfaces' in lines[1] and '+50.0%' in lines[1]
+    assert 'update_switchports' in lines[2] and '-25.0%' in lines[2]
+
+
+def test_compare_takes_the_versions_named(capsys):
+    results_l = [get_result('old', 'move_interfaces', 1.0),
+                 get_result('base', 'move_interfaces', 2.0),
+                 get_result('head', 'move_interfaces', 4.0)]
+    assert benchmark.compare_results(results_l, 'old', 'head') == [
+        ('switchports.db', 1000, 'move_interfaces', 1.0, 4.0)]
+    assert '+300.0%' in capsys.readouterr().out
+
+
+def test_compare_needs_two_versions_with_common_results():
+    with pytest.raises(ValueError, match='Results of two versions'):
+        benchmark.compare_results([get_result('base', 'move_interfaces', 1)])
+    with pytest.raises(ValueError, match='No results common to base and head'):
+        benchmark.compare_results([
+            get_result('base', 'move_interfaces', 1.0),
+            get_result('head', 'move_interfaces', 1.0, size=10000)])
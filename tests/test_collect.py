@@ -0,0 +1,140 @@
+'''
+collect against fakedevice.py.
+
+'''
+import logging
+
+import pytest
+
+import migrate
+from conftest import get_estate_rows, read_records, write_capture
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(migrate, 'RETRY_DELAY', 0.01)
+
+
+def write_captures(tmp_path, switch_ids):
+
+    '''
+    Write captures of switch_ids as in the estate, but with the first port
+    of each switch now connected to a new host.
+    '''
+    (tmp_path / 'captures').mkdir(exist_ok=True)
+    for switch_id in switch_ids:
+        ports = [(port_id, status, vlan, description)
+                 for row_switch, port_id, status, vlan, description
+                 in get_estate_rows() if row_switch == switch_id]
+        ports[0] = (ports[0][0], 'connected', '30', 'new-' + switch_id)
+        write_capture(tmp_path / 'captures' / (switch_id + '.txt'),
+                      switch_id, ports)
+
+
+def test_collect_refreshes_the_state(tmp_path, estate, fakedevices):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1', 'sw2', 'sw3', 'sw4'))
+    devicecsv = fakedevices()
+    failed_l = migrate.collect_switchports(
+        devicecsv, confdir, confile, timeout=5, retries=0,
+        capturedir=str(tmp_path / 'collected'))
+    assert failed_l == []
+    switchports_d = migrate.load_switchports(confdir, confile)
+    for switch_id in ('sw1', 'sw2', 'sw3', 'sw4'):
+        port = switchports_d[switch_id]['Gi1/0/1']
+        assert (port.status, port.vlan, port.description) == \
+            ('connected', '30', 'new-' + switch_id)
+        assert len(switchports_d[switch_id]) == 12
+        assert [command for session, seconds, command
+                in read_records(tmp_path, switch_id)] == \
+            list(migrate.COLLECT_COMMANDS)
+        collected = (tmp_path / 'collected' / (switch_id + '.txt')).read_text()
+        assert 'new-' + switch_id in collected
+    assert switchports_d['sw2']['Gi1/0/2'].description == 'host-sw2-2'
+
+
+def test_collect_retries_closed_connections(tmp_path, estate, fakedevices):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1', 'sw2'))
+    devicecsv = fakedevices(('sw1', 'sw2'), fail=2)
+    failed_l = migrate.collect_switchports(devicecsv, confdir, confile,
+                                           timeout=5, retries=2)
+    assert failed_l == []
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert switchports_d['sw1']['Gi1/0/1'].description == 'new-sw1'
+    assert switchports_d['sw2']['Gi1/0/1'].description == 'new-sw2'
+
+
+def test_collect_keeps_the_state_of_failed_switches(tmp_path, estate,
+                                                    fakedevices):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1', 'sw2'))
+    devicecsv = fakedevices(('sw1', 'sw2'), fail=1)
+    failed_l = migrate.collect_switchports(devicecsv, confdir, confile,
+                                           timeout=5, retries=0)
+    assert sorted(failed_l) == ['sw1', 'sw2']
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert switchports_d['sw1']['Gi1/0/1'].status == 'disabled'
+
+
+def test_collect_fails_a_switch_without_status_output(tmp_path, estate,
+                                                      fakedevices):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1',))
+    devicecsv = fakedevices(('sw1', 'sw2'))
+    failed_l = migrate.collect_switchports(devicecsv, confdir, confile,
+                                           timeout=5, retries=0)
+    assert failed_l == ['sw2']
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert switchports_d['sw1']['Gi1/0/1'].description == 'new-sw1'
+    assert switchports_d['sw2']['Gi1/0/2'].description == 'host-sw2-2'
+
+
+def test_collect_times_out_a_slow_switch(tmp_path, estate, fakedevices):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1',))
+    devicecsv = fakedevices(('sw1',), delay=1)
+    failed_l = migrate.collect_switchports(devicecsv, confdir, confile,
+                                           timeout=0.2, retries=0)
+    assert failed_l == ['sw1']
+
+
+def test_collect_limits_sessions_per_site(tmp_path, estate, fakedevices):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1', 'sw2', 'sw3'))
+    devicecsv = fakedevices(('sw1', 'sw2', 'sw3'), delay=0.05)
+    failed_l = migrate.collect_switchports(devicecsv, confdir, confile,
+                                           concurrency=1, timeout=5,
+                                           retries=0)
+    assert failed_l == []
+    # Every device is of site s1, so their sessions must not overlap
+    spans = sorted((records[0][1], records[-1][1])
+                   for records in (read_records(tmp_path, switch_id)
+                                   for switch_id in ('sw1', 'sw2', 'sw3')))
+    for (first_start, first_end), (next_start, next_end) in \
+            zip(spans, spans[1:]):
+        assert first_end <= next_start
+
+
+def test_collect_reports_status_lines_it_cannot_parse(tmp_path, estate,
+                                                      fakedevices, caplog):
+    confdir, confile = estate
+    write_captures(tmp_path, ('sw1',))
+    capture_file = tmp_path / 'captures' / 'sw1.txt'
+    capture_file.write_text(capture_file.read_text().replace(
+        '\n\nsw1#show interface description',
+        '\nGi1/0/13  garbled line\n\nsw1#show interface description'))
+    devicecsv = fakedevices(('sw1',))
+    with caplog.at_level(logging.INFO):
+        failed_l = migrate.collect_switchports(devicecsv, confdir, confile,
+                                               timeout=5, retries=0)
+    assert failed_l == []
+    assert "sw1: skipped show interface status line: 'Gi1/0/13  garbled " \
+        "line'" in caplog.text
+    assert 'Collected 1 of 1 switches, 1 status lines skipped' in caplog.text
+
+
+def test_cli_session_needs_a_transport():
+    with pytest.raises(TypeError, match='open'):
+        migrate.CliSession({'switch_id': 'sw1', 'host': '127.0.0.1'})
+    assert set(migrate.CLI_TRANSPORTS) == {'tcp', 'ssh'}
@@ -0,0 +1,69 @@
+'''
+mark and update find their columns by header, or by position in CSVs
+without any of the headers.
+
+'''
+import csv
+
+import pytest
+
+import migrate
+
+
+def write_csv(csvfile, rows):
+    with open(csvfile, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(rows)
+    return str(csvfile)
+
+
+@pytest.mark.parametrize('rows', [
+    [['final', 'port', 'notes', 'switch'],
+     ['sw3', 'Gi1/0/2', '', 'sw1'], ['sw4', 'gi1/0/4', '', 'sw2']],
+    # Without any of the headers, as mark always read it
+    [['Host', 'Current', 'Target', 'Access Port'],
+     ['host-sw1-2', 'sw1', 'sw3', 'Gi1/0/2'],
+     ['host-sw2-4', 'sw2', 'sw4', 'gi1/0/4']],
+    ])
+def test_mark_reads_columns_by_header_or_position(tmp_path, estate, rows):
+    confdir, confile = estate
+    migrate.mark_switchports_final(write_csv(tmp_path / 'final.csv', rows),
+                                   confdir, confile)
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert switchports_d['sw1']['Gi1/0/2'].final == 'sw3'
+    assert switchports_d['sw2']['Gi1/0/4'].final == 'sw4'
+
+
+def test_mark_refuses_a_header_missing_some_columns(tmp_path, estate):
+    confdir, confile = estate
+    finalcsv = write_csv(tmp_path / 'final.csv', [
+        ['host', 'switch', 'target', 'port'],
+        ['host-sw1-2', 'sw1', 'sw3', 'Gi1/0/2']])
+    with pytest.raises(ValueError, match='has no final column'):
+        migrate.mark_switchports_final(finalcsv, confdir, confile)
+
+
+@pytest.mark.parametrize('header', [
+    ['Vlan', 'To Interface', 'From Switch', 'Description', 'From Interface',
+     'To Switch'],
+    # Without any of the headers, as update always read run sheets
+    ['A', 'B', 'C', 'D', 'E', 'F', 'G'],
+    ])
+def test_update_reads_columns_by_header_or_position(tmp_path, monkeypatch,
+                                                    estate, header):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    values_d = {'Description': 'host-sw1-2', 'From Switch': 'sw1',
+                'From Interface': 'Gi1/0/2', 'To Switch': 'sw3',
+                'To Interface': 'Gi1/0/1', 'Vlan': '1297'}
+    if header[0] == 'A':
+        row = ['host-sw1-2', 'sw1', 'Gi1/0/2', '', 'sw3', 'Gi1/0/1', '1297']
+    else:
+        row = [values_d[name] for name in header]
+    updatecsv = write_csv(tmp_path / 'update.csv', [header, row])
+    migrate.update_switchports(updatecsv, confdir, confile, 'updated',
+                               'updated.yaml')
+    switchports_d = migrate.load_switchports('updated', 'updated.yaml')
+    new = switchports_d['sw3']['Gi1/0/1']
+    assert (new.status, new.vlan, new.description) == \
+        ('connected', '1297', 'host-sw1-2')
+    assert switchports_d['sw1']['Gi1/0/2'].status == 'disabled'
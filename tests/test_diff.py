@@ -0,0 +1,80 @@
+'''
+diff compares state files switch by switch, by their fingerprints.
+
+'''
+import csv
+import os
+
+import migrate
+
+UPDATE_HEADER = ['Description', 'From Switch', 'From Interface', 'To Switch',
+                 'To Interface', 'Vlan']
+
+
+def write_update(tmp_path, rows):
+    updatecsv = tmp_path / 'update.csv'
+    with open(updatecsv, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows([UPDATE_HEADER] + rows)
+    return str(updatecsv)
+
+
+def test_diff_only_loads_the_switches_that_changed(tmp_path, monkeypatch,
+                                                   estate, capsys):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.convert_switchports('switchports.shards', confdir, confile)
+    confdir = os.path.relpath(confdir, tmp_path)
+    migrate.update_switchports(write_update(tmp_path, [
+        ['host-sw1-2', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1', '1297']]),
+        confdir, 'switchports.shards', 'updated', 'updated.shards')
+    loaded = []
+    load = migrate.ShardLoader.__call__
+
+    def record(loader, switch_id):
+        loaded.append((os.path.basename(loader.path), switch_id))
+        return load(loader, switch_id)
+
+    monkeypatch.setattr(migrate.ShardLoader, '__call__', record)
+    capsys.readouterr()
+    diff_d = migrate.diff_switchports(confdir, 'switchports.shards',
+                                      'updated', 'updated.shards')
+    assert diff_d['switches'] == {'added': [], 'removed': [],
+                                  'changed': ['sw1', 'sw3'], 'unchanged': 2}
+    assert sorted(loaded) == [('switchports.shards', 'sw1'),
+                              ('switchports.shards', 'sw3'),
+                              ('updated.shards', 'sw1'),
+                              ('updated.shards', 'sw3')]
+    assert diff_d['ports'] == [
+        {'switch_id': 'sw1', 'port_id': 'Gi1/0/2', 'change': 'changed',
+         'fields': {'status': ['connected', 'disabled'],
+                    'vlan': ['1297', ''],
+                    'description': ['host-sw1-2', '']}},
+        {'switch_id': 'sw3', 'port_id': 'Gi1/0/1', 'change': 'changed',
+         'fields': {'status': ['disabled', 'connected'],
+                    'vlan': ['', '1297'],
+                    'description': ['disabled', 'host-sw1-2']}}]
+    output = capsys.readouterr().out
+    assert 'sw1 Gi1/0/2 changed status: connected -> disabled' in output
+    assert '2 ports differ. Switches: 2 changed, 0 added, 0 removed, ' \
+        '2 unchanged' in output
+
+
+def test_diff_as_of_a_journal_entry(tmp_path, monkeypatch, estate, capsys):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.convert_switchports('switchports.db', confdir, confile)
+    confdir = os.path.relpath(confdir, tmp_path)
+    migrate.update_switchports(write_update(tmp_path, [
+        ['host-sw2-4', 'sw2', 'Gi1/0/4', 'sw4', 'Gi1/0/1', '1296']]),
+        confdir, 'switchports.db', confdir, 'switchports.db')
+    # Against itself, nothing differs
+    diff_d = migrate.diff_switchports(confdir, 'switchports.db', confdir,
+                                      'switchports.db')
+    assert diff_d['ports'] == []
+    assert diff_d['switches']['unchanged'] == 4
+    diff_d = migrate.diff_switchports(confdir, 'switchports.db', confdir,
+                                      'switchports.db', as_of=0)
+    assert diff_d['switches']['changed'] == ['sw2', 'sw4']
+    assert [(port_d['switch_id'], port_d['port_id'])
+            for port_d in diff_d['ports']] == [('sw2', 'Gi1/0/4'),
+                                               ('sw4', 'Gi1/0/1')]
@@ -0,0 +1,121 @@
+'''
+flatten plans the fewest moves, in waves, putting hosts on their final
+switch.
+
+'''
+import logging
+
+import migrate
+
+
+def get_inventory(finals_d):
+
+    '''
+    Return an Inventory with a port per entry of finals_d: '' for a free
+    port, the final switch of the host on it, or None for a host that stays.
+    '''
+    switchports_d = migrate.Inventory()
+    for switch_id, finals in finals_d.items():
+        switchports_d[switch_id] = {}
+        for index, final in enumerate(finals, 1):
+            port_id = 'Gi1/0/' + str(index)
+            if final == '':
+                port = migrate.SwitchPort(switch_id, port_id, 'disabled', '',
+                                          'disabled')
+            else:
+                port = migrate.SwitchPort(
+                    switch_id, port_id, 'connected', '10',
+                    'host-%s-%s' % (switch_id, index), final=final or '')
+            switchports_d[switch_id][port_id] = port
+    return switchports_d
+
+
+def run_plan(switchports_d):
+
+    '''
+    Return the rows flatten plans, after checking that each move takes a
+    port that was free before its wave, and where each host ends up.
+    '''
+    rows = list(migrate.plan_flatten(switchports_d))
+    free = {(switch_id, port_id) for switch_id, ports_d
+            in switchports_d.items() for port_id, port in ports_d.items()
+            if port.status == 'disabled'}
+    hosts_d = {(switch_id, port_id): port.description for switch_id, ports_d
+               in switchports_d.items() for port_id, port in ports_d.items()
+               if port.status != 'disabled'}
+    wave = None
+    freed = set()
+    for row in rows:
+        description, from_switch, from_port, to_switch, to_port = \
+            row[0], row[1], row[2], row[4], row[5]
+        if row[8].split()[1] != wave:
+            wave = row[8].split()[1]
+            free |= freed
+            freed = set()
+        assert (to_switch, to_port) in free
+        free.remove((to_switch, to_port))
+        assert hosts_d.pop((from_switch, from_port)) == description
+        hosts_d[to_switch, to_port] = description
+        freed.add((from_switch, from_port))
+    return rows, {description: location[0]
+                  for location, description in hosts_d.items()}
+
+
+def get_waves(rows):
+    return [row[8] for row in rows]
+
+
+def test_swap_breaks_the_cycle_with_one_temporary_move():
+    switchports_d = get_inventory({'a': ['b', 'b'], 'b': ['a', 'a'],
+                                   'c': ['']})
+    rows, switches_d = run_plan(switchports_d)
+    assert get_waves(rows) == ['Wave 1 Temporary', 'Wave 2', 'Wave 3',
+                               'Wave 4', 'Wave 5']
+    assert rows[0][4] == 'c'
+    assert switches_d == {'host-a-1': 'b', 'host-a-2': 'b',
+                          'host-b-1': 'a', 'host-b-2': 'a'}
+
+
+def test_chain_moves_into_freed_ports_without_temporary_moves():
+    switchports_d = get_inventory({'a': ['b', None], 'b': ['c', 'c'],
+                                   'c': ['', '', None]})
+    rows, switches_d = run_plan(switchports_d)
+    assert get_waves(rows) == ['Wave 1', 'Wave 1', 'Wave 2']
+    assert [(row[1], row[4]) for row in rows] == \
+        [('b', 'c'), ('b', 'c'), ('a', 'b')]
+    assert switches_d['host-a-1'] == 'b'
+
+
+def test_hosts_without_room_on_their_final_switch_stay(caplog):
+    switchports_d = get_inventory({'a': ['b'], 'b': ['a'], 'd': ['b'],
+                                   'c': ['']})
+    with caplog.at_level(logging.INFO):
+        rows, switches_d = run_plan(switchports_d)
+    assert get_waves(rows) == ['Wave 1 Temporary', 'Wave 2', 'Wave 3']
+    # Nobody is left on the temporary port
+    assert switches_d == {'host-a-1': 'b', 'host-b-1': 'a',
+                          'host-d-1': 'd'}
+    assert 'Final switch b has room for 1 of its 2 hosts, 1 stay' in \
+        caplog.text
+    assert 'left on a temporary port' not in caplog.text
+
+
+def test_stuck_hosts_are_not_parked_and_waves_are_counted(caplog):
+    switchports_d = get_inventory({'a': ['b', 'c'], 'b': [None],
+                                   'c': ['']})
+    with caplog.at_level(logging.INFO):
+        rows, switches_d = run_plan(switchports_d)
+    assert get_waves(rows) == ['Wave 1']
+    assert switches_d['host-a-1'] == 'a'
+    assert switches_d['host-a-2'] == 'c'
+    assert '1 moves and 0 temporary moves in 1 waves' in caplog.text
+
+
+def test_cycle_without_a_spare_port_is_reported(caplog):
+    switchports_d = get_inventory({'a': ['b'], 'b': ['a']})
+    with caplog.at_level(logging.INFO):
+        rows, switches_d = run_plan(switchports_d)
+    assert rows == []
+    assert 'No spare port to break a cycle' in caplog.text
+    assert '2 hosts can not reach their final switch' in caplog.text
+    assert 'in 0 waves' in caplog.text
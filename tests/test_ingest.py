@@ -0,0 +1,82 @@
+'''
+ingest of raw show interface status and description captures.
+
+'''
+import logging
+
+import pytest
+
+import migrate
+from conftest import get_estate_rows, write_capture
+
+
+def get_ports(switch_id):
+    return [(port_id, status, vlan, description)
+            for row_switch, port_id, status, vlan, description
+            in get_estate_rows() if row_switch == switch_id]
+
+
+def test_ingest_refreshes_the_switches_captured(tmp_path, estate):
+    confdir, confile = estate
+    ports = get_ports('sw1')
+    ports[0] = ('GigabitEthernet1/0/1', 'connected', '30', 'new-host')
+    write_capture(tmp_path / 'sw1.txt', 'sw1', ports)
+    migrate.ingest_switchports([str(tmp_path / 'sw1.txt')], confdir, confile,
+                               workers=1)
+    switchports_d = migrate.load_switchports(confdir, confile)
+    port = switchports_d['sw1']['Gi1/0/1']
+    assert (port.status, port.vlan, port.description) == \
+        ('connected', '30', 'new-host')
+    assert switchports_d['sw2']['Gi1/0/2'].description == 'host-sw2-2'
+
+
+def test_ingest_reports_status_lines_it_cannot_parse(tmp_path, estate,
+                                                     caplog):
+    confdir, confile = estate
+    write_capture(tmp_path / 'sw1.txt', 'sw1', get_ports('sw1'))
+    capture = (tmp_path / 'sw1.txt').read_text().replace(
+        '\n\nsw1#show interface description',
+        '\nGi1/0/13  garbled line\n\nsw1#show interface description')
+    (tmp_path / 'sw1.txt').write_text(capture)
+    with caplog.at_level(logging.INFO):
+        migrate.ingest_switchports([str(tmp_path / 'sw1.txt')], confdir,
+                                   confile, workers=1)
+    assert "sw1: skipped show interface status line in " in caplog.text
+    assert "'Gi1/0/13  garbled line'" in caplog.text
+    assert '1 status lines skipped' in caplog.text
+    assert len(migrate.load_switchports(confdir, confile)['sw1']) == 12
+
+
+def write_capture_without_prompts(capture_file, switch_id, ports):
+    write_capture(capture_file, switch_id, ports)
+    capture_file.write_text(''.join(
+        line for line in capture_file.read_text().splitlines(True)
+        if not line.startswith(switch_id + '#')))
+
+
+@pytest.mark.parametrize('name, switch_id', [
+    ('sw1.site.example.txt', 'sw1.site.example'),
+    ('sw1.site.example.LOG', 'sw1.site.example'),
+    ('sw1.site.example', 'sw1.site.example')])
+def test_file_name_names_a_switch_without_a_prompt(tmp_path, name,
+                                                   switch_id):
+    capture_file = tmp_path / name
+    write_capture_without_prompts(capture_file, 'sw1', get_ports('sw1'))
+    parsed_id, status_l, description_d, skipped_l = \
+        migrate.parse_capture_file(str(capture_file))
+    assert parsed_id == switch_id
+    assert (len(status_l), skipped_l) == (12, [])
+    assert description_d['Gi1/0/2'] == 'host-sw1-2'
+
+
+def test_ingest_adds_a_switch_named_by_its_file(tmp_path, estate):
+    confdir, confile = estate
+    capture_file = tmp_path / 'sw5.site.example.txt'
+    write_capture_without_prompts(capture_file, 'sw5', get_ports('sw1'))
+    migrate.ingest_switchports([str(capture_file)], confdir, confile,
+                               workers=1)
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert sorted(switchports_d.switch_ids()) == \
+        ['sw1', 'sw2', 'sw3', 'sw4', 'sw5.site.example']
+    assert switchports_d['sw5.site.example']['Gi1/0/2'].description == \
+        'host-sw1-2'
@@ -0,0 +1,105 @@
+'''
+Debug messages cost no formatting unless debug logging is on, and per-port
+tracing is sampled.
+
+'''
+import logging
+
+import pytest
+
+import migrate
+
+
+@pytest.fixture
+def formatted(monkeypatch):
+
+    '''
+    List of the values summarize and pformat were asked to format.
+    '''
+    formatted = []
+    summarize, pformat = migrate.summarize, migrate.pformat
+
+    def record_summarize(value):
+        formatted.append(('summarize', type(value).__name__))
+        return summarize(value)
+
+    def record_pformat(value):
+        formatted.append(('pformat', type(value).__name__))
+        return pformat(value)
+
+    monkeypatch.setattr(migrate, 'summarize', record_summarize)
+    monkeypatch.setattr(migrate, 'pformat', record_pformat)
+    return formatted
+
+
+def move(tmp_path, monkeypatch, estate):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.move_interfaces('rundir', 'runsheet.csv', confdir, confile,
+                            'sw1,sw2', 'sw3,sw4', 'most-free')
+
+
+def test_nothing_is_formatted_at_info_level(tmp_path, monkeypatch, estate,
+                                            formatted, caplog):
+    with caplog.at_level(logging.INFO):
+        move(tmp_path, monkeypatch, estate)
+    assert formatted == []
+    assert 'switches, ' not in caplog.text
+
+
+def test_debug_messages_are_summarized(tmp_path, monkeypatch, estate,
+                                       formatted, caplog):
+    with caplog.at_level(logging.DEBUG):
+        move(tmp_path, monkeypatch, estate)
+    assert ('summarize', 'Inventory') in formatted
+    assert '4 switches, 48 ports: sw1, sw2, sw3, sw4' in caplog.text
+
+
+def test_summarize_cuts_long_containers(monkeypatch):
+    monkeypatch.setattr(migrate, 'SUMMARY_LIMIT', 3)
+    assert migrate.summarize(list(range(5))) == '[0, 1, 2] ... 2 more'
+    assert migrate.summarize({'a': {1: 1}, 'b': {}, 'c': {}, 'd': {}}) == \
+        '4 switches, 1 ports: a, b, c, ...'
+    assert migrate.summarize('text') == "'text'"
+
+
+def test_lazy_format_only_formats_when_emitted(caplog):
+    calls = []
+
+    def format_value(value):
+        calls.append(value)
+        return 'formatted ' + value
+
+    logger = logging.getLogger('test_lazy')
+    with caplog.at_level(logging.INFO):
+        logger.debug('%s', migrate.LazyFormat(format_value, 'a'))
+    assert calls == []
+    with caplog.at_level(logging.DEBUG):
+        logger.debug('%s', migrate.LazyFormat(format_value, 'b'))
+    # Formatted by each of the handlers of pytest
+    assert set(calls) == {'b'}
+    assert 'formatted b' in caplog.text
+
+
+def test_port_tracer_logs_one_call_in_sample(caplog):
+    logger = logging.getLogger('test_trace')
+    with caplog.at_level(logging.DEBUG):
+        trace = migrate.PortTracer(logger, sample=3)
+        assert trace.enabled
+        for index in range(1, 8):
+            trace('port %s', index)
+    assert [record.getMessage() for record in caplog.records] == \
+        ['port 1 [1]', 'port 4 [4]', 'port 7 [7]']
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG):
+        trace = migrate.PortTracer(logger, sample=1)
+        for index in range(1, 4):
+            trace('port %s', index)
+    assert len(caplog.records) == 3
+
+
+def test_port_tracer_is_off_at_info_level(caplog, monkeypatch):
+    monkeypatch.setattr(migrate, 'TRACE_SAMPLE', 50)
+    with caplog.at_level(logging.INFO):
+        trace = migrate.PortTracer(logging.getLogger('test_trace'))
+    assert (trace.enabled, trace.sample) == (False, 50)
@@ -0,0 +1,132 @@
+'''
+update checks every row of a run sheet before applying any, and only moves
+a host onto a free port.
+
+'''
+import csv
+
+import pytest
+
+import migrate
+
+
+def get_switchports(estate):
+
+    '''
+    Return the estate with sw3 Gi1/0/5 configured for a host that is not
+    up, and sw3 Gi1/0/6 free but marked with a final.
+    '''
+    confdir, confile = estate
+    switchports_d = migrate.load_switchports(confdir, confile)
+    reserved = switchports_d['sw3']['Gi1/0/5']
+    reserved.status, reserved.vlan, reserved.description = \
+        'notconnect', '1296', 'host-spare'
+    switchports_d['sw3']['Gi1/0/6'].final = 'sw4'
+    return switchports_d
+
+
+def check(switchports_d, moves):
+    rows = [(number, (description, from_switch, from_port, to_switch,
+                      to_port, '1297'))
+            for number, (description, from_switch, from_port, to_switch,
+                         to_port) in enumerate(moves, 2)]
+    return migrate.check_moves(switchports_d, rows)
+
+
+@pytest.mark.parametrize('to_switch, to_port, message', [
+    ('sw2', 'Gi1/0/2', 'destination sw2:Gi1/0/2 is in use by host-sw2-2'),
+    ('sw3', 'Gi1/0/5', 'destination sw3:Gi1/0/5 is reserved, status '
+                       'notconnect'),
+    ('sw3', 'Gi1/0/6', 'destination sw3:Gi1/0/6 is marked with final sw4')])
+def test_destination_must_be_a_free_port(estate, to_switch, to_port,
+                                         message):
+    moves, errors = check(get_switchports(estate), [
+        ('host-sw1-2', 'sw1', 'Gi1/0/2', to_switch, to_port)])
+    assert (moves, errors) == ([], [(2, message)])
+
+
+def test_destination_taken_by_an_earlier_row_is_refused(estate):
+    moves, errors = check(get_switchports(estate), [
+        ('host-sw1-2', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1'),
+        ('host-sw1-4', 'sw1', 'Gi1/0/4', 'sw3', 'GigabitEthernet1/0/1')])
+    assert [move[:4] for move in moves] == [('sw1', 'Gi1/0/2', 'sw3',
+                                             'Gi1/0/1')]
+    assert errors == [(3, 'destination sw3:Gi1/0/1 is taken by row 2')]
+
+
+def test_destination_freed_by_an_earlier_row_can_be_taken(estate):
+    switchports_d = get_switchports(estate)
+    # sw1 Gi1/0/2 holds a host marked to move, freeing it frees the mark
+    switchports_d['sw1']['Gi1/0/2'].final = 'sw3'
+    moves, errors = check(switchports_d, [
+        ('host-sw1-2', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1'),
+        ('host-sw1-4', 'sw1', 'Gi1/0/4', 'sw1', 'Gi1/0/2')])
+    assert errors == []
+    assert len(moves) == 2
+
+
+def test_update_applies_nothing_when_a_destination_is_not_free(
+        tmp_path, monkeypatch, estate, caplog):
+    confdir, confile = estate
+    migrate.dump_switchports(get_switchports(estate), confdir, confile)
+    monkeypatch.chdir(tmp_path)
+    updatecsv = tmp_path / 'update.csv'
+    with open(updatecsv, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows([
+            ['Description', 'From Switch', 'From Interface', 'To Switch',
+             'To Interface', 'Vlan'],
+            ['host-sw1-2', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1', '1297'],
+            ['host-sw1-4', 'sw1', 'Gi1/0/4', 'sw3', 'Gi1/0/5', '1296'],
+            ['host-sw1-6', 'sw1', 'Gi1/0/6', 'sw3', 'Gi1/0/6', '1297'],
+            ['host-sw1-8', 'sw1', 'Gi1/0/8', 'sw3', 'Gi1/0/1', '1296']])
+    with pytest.raises(ValueError, match='3 rows of .* have errors, nothing '
+                                         'was applied'):
+        migrate.update_switchports(str(updatecsv), confdir, confile,
+                                   'updated', 'updated.yaml')
+    assert 'row 3: destination sw3:Gi1/0/5 is reserved' in caplog.text
+    assert 'row 4: destination sw3:Gi1/0/6 is marked' in caplog.text
+    assert 'row 5: destination sw3:Gi1/0/1 is taken by row 2' in caplog.text
+    assert not (tmp_path / 'updated' / 'updated.yaml').exists()
+
+
+@pytest.mark.parametrize('confile', ['switchports.yaml', 'switchports.db'])
+def test_update_applies_the_run_sheet_of_move_around_marked_ports(
+        tmp_path, monkeypatch, estate, confile):
+    confdir, yamlfile = estate
+    monkeypatch.chdir(tmp_path)
+    if confile != yamlfile:
+        migrate.convert_switchports(confile, confdir, yamlfile)
+    finalcsv = tmp_path / 'final.csv'
+    with open(finalcsv, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows([['switch', 'port', 'final'],
+                                        ['sw3', 'Gi1/0/12', 'sw4']])
+    migrate.mark_switchports_final(str(finalcsv), confdir, confile)
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert 'Gi1/0/12' not in switchports_d.reindex().ports('sw3')
+    migrate.move_interfaces('rundir', 'runsheet.csv', confdir, confile, 'sw1',
+                            'sw3', 'most-free')
+    migrate.update_switchports('rundir/runsheet.csv', confdir, confile,
+                               'updated', 'updated.yaml')
+    switchports_d = migrate.load_switchports('updated', 'updated.yaml')
+    marked = switchports_d['sw3']['Gi1/0/12']
+    assert (marked.status, marked.final) == ('disabled', 'sw4')
+    assert sum(port.status == 'connected'
+               for port in switchports_d['sw3'].values()) == 6
+
+
+def test_update_writes_a_corrected_description(tmp_path, monkeypatch, estate,
+                                               caplog):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    updatecsv = tmp_path / 'update.csv'
+    with open(updatecsv, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows([
+            ['Description', 'From Switch', 'From Interface', 'To Switch',
+             'To Interface', 'Vlan'],
+            ['db-primary', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1', '1297']])
+    migrate.update_switchports(str(updatecsv), confdir, confile, 'updated',
+                               'updated.yaml')
+    assert "sw1:Gi1/0/2 holds 'host-sw1-2', row 2 describes it as " \
+        "'db-primary'" in caplog.text
+    switchports_d = migrate.load_switchports('updated', 'updated.yaml')
+    assert switchports_d['sw3']['Gi1/0/1'].description == 'db-primary'
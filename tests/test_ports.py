@@ -0,0 +1,99 @@
+'''
+Port names are made canonical, so aliases find the same port, and ports
+sort in natural order.
+
+'''
+import csv
+
+import pytest
+
+import migrate
+
+
+def write_csv(csvfile, rows):
+    with open(csvfile, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(rows)
+    return str(csvfile)
+
+
+def write_init(tmp_path, ports):
+    return write_csv(tmp_path / 'init.csv', [
+        ['switch_id', 'port', 'status', 'vlan', 'description']] + [
+        ['sw1', port_id, 'disabled', '', 'disabled'] for port_id in ports])
+
+
+@pytest.mark.parametrize('name, port_id', [
+    ('Gi1/0/2', 'Gi1/0/2'), ('GigabitEthernet1/0/2', 'Gi1/0/2'),
+    ('gi1/0/2', 'Gi1/0/2'), (' Gi 1/0/2 ', 'Gi1/0/2'),
+    ('TenGigabitEthernet1/1/1', 'Te1/1/1'), ('port-channel10', 'Po10'),
+    ('mgmt0', 'mgmt0'), ('not a port', 'not a port')])
+def test_aliases_have_one_canonical_port_id(name, port_id):
+    assert migrate.canonical_port(name) == port_id
+
+
+def test_ports_sort_in_natural_order():
+    assert sorted(['Gi1/0/10', 'Te1/1/1', 'Gi1/0/2', 'Po1', 'Gi2/0/1',
+                   'Gi1/0/1'], key=migrate.port_key) == \
+        ['Gi1/0/1', 'Gi1/0/2', 'Gi1/0/10', 'Gi2/0/1', 'Po1', 'Te1/1/1']
+
+
+def test_init_keeps_ports_in_natural_order(tmp_path):
+    confdir = str(tmp_path / 'switchports')
+    migrate.get_switchports_d(
+        write_init(tmp_path, ['Gi1/0/10', 'GigabitEthernet1/0/2', 'Gi1/0/1',
+                              'Gi1/0/9']), confdir, 'switchports.yaml')
+    switchports_d = migrate.load_switchports(confdir, 'switchports.yaml')
+    assert list(migrate.sort_ports(switchports_d['sw1'])) == \
+        ['Gi1/0/1', 'Gi1/0/2', 'Gi1/0/9', 'Gi1/0/10']
+    assert list(switchports_d.reindex().ports('sw1')) == \
+        ['Gi1/0/1', 'Gi1/0/2', 'Gi1/0/9', 'Gi1/0/10']
+
+
+def test_init_refuses_two_names_of_the_same_port(tmp_path, caplog):
+    confdir = str(tmp_path / 'switchports')
+    initcsv = write_init(tmp_path, ['Gi1/0/1', 'Gi1/0/2',
+                                    'GigabitEthernet1/0/1'])
+    with pytest.raises(ValueError, match='1 rows of .* have errors'):
+        migrate.get_switchports_d(initcsv, confdir, 'switchports.yaml')
+    assert 'row 4: sw1:GigabitEthernet1/0/1 is Gi1/0/1, already read from ' \
+        'row 2' in caplog.text
+    assert not (tmp_path / 'switchports').exists()
+
+
+def test_mark_finds_ports_by_alias(tmp_path, estate):
+    confdir, confile = estate
+    migrate.mark_switchports_final(write_csv(tmp_path / 'final.csv', [
+        ['switch', 'port', 'final'], ['sw1', 'GigabitEthernet1/0/2', 'sw3'],
+        ['sw2', 'gi1/0/4', 'sw4']]), confdir, confile)
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert switchports_d['sw1']['Gi1/0/2'].final == 'sw3'
+    assert switchports_d['sw2']['Gi1/0/4'].final == 'sw4'
+    assert 'GigabitEthernet1/0/2' not in switchports_d['sw1']
+
+
+def test_mark_refuses_aliases_marked_with_two_finals(tmp_path, estate,
+                                                     caplog):
+    confdir, confile = estate
+    finalcsv = write_csv(tmp_path / 'final.csv', [
+        ['switch', 'port', 'final'], ['sw1', 'Gi1/0/2', 'sw3'],
+        ['sw1', 'GigabitEthernet1/0/2', 'sw4']])
+    with pytest.raises(ValueError, match='1 rows of'):
+        migrate.mark_switchports_final(finalcsv, confdir, confile)
+    assert 'sw1:Gi1/0/2 marked with final sw4' in caplog.text
+
+
+def test_update_finds_ports_by_alias(tmp_path, monkeypatch, estate):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    updatecsv = write_csv(tmp_path / 'update.csv', [
+        ['Description', 'From Switch', 'From Interface', 'To Switch',
+         'To Interface', 'Vlan'],
+        ['host-sw1-2', 'sw1', 'GigabitEthernet1/0/2', 'sw3', 'gi1/0/1',
+         '1297']])
+    migrate.update_switchports(updatecsv, confdir, confile, 'updated',
+                               'updated.yaml')
+    switchports_d = migrate.load_switchports('updated', 'updated.yaml')
+    assert switchports_d['sw3']['Gi1/0/1'].description == 'host-sw1-2'
+    assert switchports_d['sw1']['Gi1/0/2'].status == 'disabled'
+    # No port was added under the alias
+    assert len(switchports_d['sw1']) == len(switchports_d['sw3']) == 12
@@ -0,0 +1,133 @@
+'''
+--PROFILE times each phase once, nested phases and generators included,
+and saves the profile as JSON or as a cProfile dump.
+
+'''
+import json
+import pstats
+
+import pytest
+
+import migrate
+
+
+class Clock():
+
+    '''
+    time.perf_counter standing still until advanced.
+    '''
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+CLOCK = Clock()
+
+
+@migrate.profiled()
+def inner():
+    CLOCK.advance(2)
+
+
+@migrate.profiled(rows=len)
+def outer():
+    CLOCK.advance(1)
+    inner()
+    CLOCK.advance(3)
+    inner()
+    return ['a', 'b', 'c']
+
+
+@migrate.profiled()
+def produce(count):
+    for number in range(count):
+        CLOCK.advance(1)
+        yield number
+
+
+@migrate.profiled()
+def consume(count):
+    for number in produce(count):
+        CLOCK.advance(10)
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    monkeypatch.setattr(migrate.time, 'perf_counter', CLOCK)
+    profiler = migrate.Profiler(trace_memory=False)
+    monkeypatch.setattr(migrate, 'PROFILER', profiler)
+    profiler.start()
+    return profiler
+
+
+def get_phases(profiler):
+    return {phase_d['phase']: (phase_d['calls'], phase_d['rows'],
+                               phase_d['seconds'])
+            for phase_d in profiler.report()['phases']}
+
+
+def test_nested_phases_are_only_counted_once(profiler):
+    outer()
+    CLOCK.advance(5)
+    profiler.stop()
+    assert get_phases(profiler) == {'outer': (1, 3, 4.0),
+                                    'inner': (2, 0, 4.0)}
+    report_d = profiler.report()
+    assert (report_d['total_seconds'], report_d['other_seconds']) == \
+        (13.0, 5.0)
+
+
+def test_generator_phases_are_timed_as_they_produce(profiler):
+    consume(3)
+    profiler.stop()
+    assert get_phases(profiler) == {'consume': (1, 0, 30.0),
+                                    'produce': (1, 3, 3.0)}
+    assert profiler.report()['other_seconds'] == 0.0
+
+
+def test_phases_cost_nothing_without_a_profiler(monkeypatch):
+    monkeypatch.setattr(migrate, 'PROFILER', None)
+    assert outer() == ['a', 'b', 'c']
+    assert list(produce(2)) == [0, 1]
+
+
+def profile_status(tmp_path, monkeypatch, estate, report):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    return migrate.profile_command(migrate.parse_args(
+        ['status', '--CONFDIR=' + confdir, '--CONFILE=' + confile,
+         '--PROFILE', '--REPORT=' + report]))
+
+
+def test_json_report(tmp_path, monkeypatch, estate, capsys):
+    profile_status(tmp_path, monkeypatch, estate, 'report.json')
+    assert 'load_switchports' in capsys.readouterr().err
+    with open(tmp_path / 'report.json') as infile:
+        report_d = json.load(infile)
+    assert sorted(report_d) == ['counters', 'other_seconds', 'phases',
+                                'total_seconds', 'trace_memory']
+    assert report_d['trace_memory'] is True
+    phases_d = {phase_d['phase']: phase_d for phase_d in report_d['phases']}
+    for phase_d in phases_d.values():
+        assert sorted(phase_d) == ['calls', 'peak_bytes', 'phase', 'rows',
+                                   'seconds']
+        assert phase_d['seconds'] >= 0
+    assert phases_d['load_switchports']['calls'] == 1
+    assert phases_d['load_switchports']['peak_bytes'] > 0
+    assert report_d['total_seconds'] == pytest.approx(
+        report_d['other_seconds'] + sum(phase_d['seconds'] for phase_d in
+                                        phases_d.values()), abs=1e-5)
+
+
+def test_prof_report_is_a_cprofile_dump(tmp_path, monkeypatch, estate):
+    profiler = profile_status(tmp_path, monkeypatch, estate, 'report.prof')
+    assert profiler.trace_memory is False
+    stats = pstats.Stats(str(tmp_path / 'report.prof'))
+    assert 'status_switchports' in {function for filename, line, function
+                                    in stats.stats}
@@ -0,0 +1,106 @@
+'''
+Rendered port configurations are cached across runs.
+
+'''
+import logging
+
+import migrate
+
+
+def render(cache, template, index=1):
+    return cache.render(template, 'sw1', 'Gi1/0/' + str(index), 'sw3',
+                        'Gi1/0/2', '1296', 'host-1')
+
+
+def test_lookups_count_hits_and_misses():
+    cache = migrate.RenderCache()
+    template = migrate.PortTemplate('test.enable', '{old_port} {vlan}')
+    assert render(cache, template) == 'Gi1/0/1 1296'
+    assert render(cache, template) == 'Gi1/0/1 1296'
+    assert render(cache, template, 2) == 'Gi1/0/2 1296'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_least_recently_used_are_evicted_beyond_max_chars():
+    template = migrate.PortTemplate('test.enable', '{old_port}')
+    # Three configurations of 7 characters
+    cache = migrate.RenderCache(max_chars=21)
+    for index in (1, 2, 3):
+        render(cache, template, index)
+    render(cache, template, 1)
+    render(cache, template, 4)
+    assert [key[2] for key in cache.entries_d] == \
+        ['Gi1/0/3', 'Gi1/0/1', 'Gi1/0/4']
+    assert cache.chars == 21
+
+
+def test_changed_template_misses():
+    cache = migrate.RenderCache()
+    render(cache, migrate.PortTemplate('test.enable', 'old {vlan}'))
+    assert render(cache, migrate.PortTemplate('test.enable',
+                                              'new {vlan}')) == 'new 1296'
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_cache_is_saved_and_loaded_across_runs(tmp_path):
+    path = str(tmp_path / 'render.marshal')
+    template = migrate.PortTemplate('test.enable', '{old_port}')
+    cache = migrate.RenderCache(path)
+    render(cache, template)
+    cache.save()
+    cache = migrate.RenderCache.load(path)
+    assert render(cache, template) == 'Gi1/0/1'
+    assert (cache.hits, cache.misses) == (1, 0)
+    # Loading into a smaller cache evicts the oldest
+    render(cache, template, 2)
+    cache.save()
+    cache = migrate.RenderCache.load(path, max_chars=7)
+    assert [key[2] for key in cache.entries_d] == ['Gi1/0/2']
+
+
+def test_unreadable_cache_loads_empty(tmp_path):
+    path = tmp_path / 'render.marshal'
+    path.write_bytes(b'not marshal')
+    cache = migrate.RenderCache.load(str(path))
+    assert (len(cache.entries_d), cache.chars) == (0, 0)
+
+
+def test_changed_profiles_yaml_renders_again(tmp_path, cache_dir, estate,
+                                             monkeypatch, caplog):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    templatedir = tmp_path / 'templates'
+    templatedir.mkdir()
+    (templatedir / 'alt.enable').write_text('alt {new_port}\n')
+    (templatedir / 'profiles.yaml').write_text("sw9: alt\n")
+
+    def move():
+        migrate.RENDER_CACHE = None
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            migrate.move_interfaces('rundir', 'runsheet.csv', confdir,
+                                    confile, 'sw1', 'sw3', 'most-free',
+                                    str(templatedir))
+        return (tmp_path / 'rundir' / 'runsheet.csv').read_text()
+
+    first = move()
+    assert (cache_dir / 'render.marshal').exists()
+    assert 'Render cache: 0 hits, 12 misses' in caplog.text
+    assert move() == first
+    assert 'Render cache: 12 hits, 0 misses' in caplog.text
+    # sw3 now takes the alt enable template, the disables are unchanged
+    (templatedir / 'profiles.yaml').write_text("sw3: alt\n")
+    changed = move()
+    assert 'Render cache: 6 hits, 6 misses' in caplog.text
+    assert 'alt Gi1/0/' in changed and 'alt Gi1/0/' not in first
+
+
+def test_profile_reports_the_hits_and_misses(tmp_path, estate, monkeypatch):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    docopt_args = migrate.parse_args(
+        ['move', 'sw1', 'sw3', '--CONFDIR=' + confdir,
+         '--CONFILE=' + confile, '--PROFILE'])
+    profiler = migrate.profile_command(docopt_args)
+    assert profiler.report()['counters'] == {'render_cache_hits': 0,
+                                             'render_cache_misses': 12}
@@ -0,0 +1,139 @@
+'''
+CriticalRules select the same hosts as matching each rule in turn, with a
+regex search per description condition.
+
+'''
+import fnmatch
+import itertools
+import re
+
+import pytest
+
+import migrate
+
+RULES_D = {
+    'groups': {'core': ['dist*', 'access_1?']},
+    'include': [
+        {'vlans': [1296, '1297', '2000-2002']},
+        {'name': 'payments', 'description': '^(db|pay)-',
+         'switches': ['core']},
+        {'name': 'pinned', 'ports': ['edge:Gi1/0/3']},
+        {'name': 'cased', 'description': '(?i)ledger', 'switches': 'edge'}],
+    'exclude': [
+        {'description': '(?i)decom'},
+        {'ports': ['dist1:Gi1/0/1'], 'vlans': [1296]}]}
+
+SWITCH_IDS = ('dist1', 'access_12', 'access_123', 'edge')
+VLANS = ('1', '1296', '1297', '1999', '2001', '2002', '2003')
+DESCRIPTIONS = ('', 'db-primary', 'pay-gw', 'x db-primary', 'LEDGER-1',
+                'db-ledger DECOM', 'Decommissioned', 'pay-gw decom')
+
+
+def classify_in_turn(rules_d, port):
+
+    '''
+    Return the name of the include rule selecting port, trying each rule
+    and each of its conditions in turn.
+    '''
+    groups_d = rules_d.get('groups', {})
+
+    def as_list(values):
+        return [str(value) for value in
+                (values if isinstance(values, list) else [values])]
+
+    def matches(rule_d):
+        for key, values in rule_d.items():
+            if key == 'vlans':
+                vlans = set()
+                for vlan in as_list(values):
+                    first, _, last = vlan.partition('-')
+                    vlans.update(str(number) for number in
+                                 range(int(first), int(last or first) + 1))
+                if port.vlan not in vlans:
+                    return False
+            elif key == 'switches':
+                patterns = [pattern for value in as_list(values)
+                            for pattern in groups_d.get(value, [value])]
+                if not any(fnmatch.fnmatchcase(port.switch_id, pattern)
+                           for pattern in patterns):
+                    return False
+            elif key == 'ports':
+                if port.switch_id + ':' + port.port_id not in \
+                        as_list(values):
+                    return False
+            elif key == 'description':
+                if not re.search(values, port.description):
+                    return False
+        return True
+
+    if port.status == 'disabled':
+        return None
+    for number, rule_d in enumerate(rules_d.get('include', []), 1):
+        if matches(rule_d):
+            if any(matches(exclude_d)
+                   for exclude_d in rules_d.get('exclude', [])):
+                return None
+            return rule_d.get('name', 'include %d' % number)
+    return None
+
+
+def get_ports():
+    for switch_id, vlan, description, port_id in itertools.product(
+            SWITCH_IDS, VLANS, DESCRIPTIONS, ('Gi1/0/1', 'Gi1/0/3')):
+        yield migrate.SwitchPort(switch_id, port_id, 'connected', vlan,
+                                 description)
+
+
+def test_rules_select_the_hosts_matched_in_turn():
+    rules = migrate.CriticalRules(RULES_D)
+    assert rules.vlan_d is None
+    classified = [(port, rules.classify(port),
+                   classify_in_turn(RULES_D, port)) for port in get_ports()]
+    assert [(port.switch_id, port.port_id, port.vlan, port.description)
+            for port, name, expected in classified if name != expected] == []
+    # Every rule is exercised, and excludes drop hosts
+    assert {name for port, name, expected in classified} == {
+        None, 'include 1', 'payments', 'pinned', 'cased'}
+    dropped = migrate.SwitchPort('dist1', 'Gi1/0/1', 'connected', '1296',
+                                 'db-primary')
+    assert classify_in_turn(RULES_D, dropped) is None
+    assert rules.classify(dropped) is None
+
+
+def test_description_flags_only_apply_to_their_rule():
+    rules_d = {'include': [{'name': 'cased', 'description': '(?i)ledger'},
+                           {'name': 'exact', 'description': 'Pay'}]}
+    rules = migrate.CriticalRules(rules_d)
+    for description in ('LEDGER', 'pay', 'Pay', 'PAY ledger'):
+        port = migrate.SwitchPort('sw1', 'Gi1/0/1', 'connected', '10',
+                                  description)
+        assert rules.classify(port) == classify_in_turn(rules_d, port)
+    assert rules(migrate.SwitchPort('sw1', 'Gi1/0/1', 'connected', '10',
+                                    'pay')) is False
+
+
+def test_default_rules_are_the_critical_vlans():
+    rules = migrate.get_default_rules()
+    assert rules.signature == 'default'
+    assert set(rules.vlan_d) == set(migrate.DEFAULT_CRITICAL_VLANS)
+    for vlan, status in itertools.product(VLANS, ('connected', 'notconnect',
+                                                  'disabled')):
+        port = migrate.SwitchPort('sw1', 'Gi1/0/1', status, vlan, 'host')
+        assert rules(port) == (status != 'disabled'
+                               and vlan in migrate.DEFAULT_CRITICAL_VLANS)
+        assert rules.classify(port) == classify_in_turn(
+            migrate.DEFAULT_RULES, port)
+
+
+@pytest.mark.parametrize('rules_d, message', [
+    ([], 'Rules in rules are not a mapping'),
+    ({'includes': []}, 'Unknown keys includes in rules'),
+    ({'include': [{}]}, 'Empty include 1 in rules'),
+    ({'include': [{'name': 'x'}]}, 'Rule x in rules needs some of'),
+    ({'include': [{'vlan': 10}]}, 'not vlan'),
+    ({'include': [{'vlans': ['10-x']}]}, 'Bad vlan 10-x in rule include 1'),
+    ({'exclude': [{'description': '('}]},
+     'Bad description regex in rule exclude 1')])
+def test_bad_rules_are_refused(rules_d, message):
+    with pytest.raises(ValueError, match=message):
+        migrate.CriticalRules(rules_d)
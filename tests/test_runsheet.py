@@ -0,0 +1,71 @@
+'''
+Run sheet rows are written as they are planned, and the rows planned before
+an error are kept.
+
+'''
+import csv
+
+import pytest
+
+import migrate
+
+
+def read_rows(runsheet):
+    with open(runsheet, newline='') as csv_file:
+        return list(csv.reader(csv_file))[1:]
+
+
+@pytest.mark.parametrize('flush_rows, on_disk', [
+    # Flushed on the first row, and every flush_rows rows after it
+    (1, [0, 1, 2, 3, 4, 5]),
+    (2, [0, 1, 1, 3, 3, 5])])
+def test_move_writes_rows_as_they_are_planned(tmp_path, monkeypatch, estate,
+                                              flush_rows, on_disk):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(migrate, 'FLUSH_ROWS', flush_rows)
+    runsheet = tmp_path / 'rundir' / 'runsheet.csv'
+    configure_ports = migrate.configure_ports
+    seen = []
+
+    def record(*args, **kwargs):
+        # Rows on disk when the next row is planned
+        seen.append(len(read_rows(runsheet)))
+        return configure_ports(*args, **kwargs)
+
+    monkeypatch.setattr(migrate, 'configure_ports', record)
+    migrate.move_interfaces('rundir', 'runsheet.csv', confdir, confile, 'sw1',
+                            'sw3', 'most-free')
+    assert seen == on_disk
+    assert len(read_rows(runsheet)) == 6
+
+
+def test_rows_before_an_error_are_written(tmp_path, monkeypatch, estate):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(migrate, 'FLUSH_ROWS', 1000)
+    configure_ports = migrate.configure_ports
+    planned = []
+
+    def fail(*args, **kwargs):
+        if len(planned) == 4:
+            raise RuntimeError('template failed')
+        planned.append(configure_ports(*args, **kwargs))
+        return planned[-1]
+
+    monkeypatch.setattr(migrate, 'configure_ports', fail)
+    with pytest.raises(RuntimeError, match='template failed'):
+        migrate.move_interfaces('rundir', 'runsheet.csv', confdir, confile,
+                                'sw1', 'sw3', 'most-free')
+    # The file was closed, so the rows not flushed yet are on disk too
+    assert read_rows(tmp_path / 'rundir' / 'runsheet.csv') == planned
+
+
+def test_write_csv_file_counts_the_rows_of_a_generator(tmp_path,
+                                                       monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows = (['host-%s' % index] + [''] * 7 for index in range(3))
+    assert migrate.write_csv_file(rows, 'rundir', 'runsheet.csv') == 3
+    assert [row[0] for row in read_rows(tmp_path / 'rundir' /
+                                        'runsheet.csv')] == \
+        ['host-0', 'host-1', 'host-2']
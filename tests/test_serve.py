@@ -0,0 +1,164 @@
+'''
+serve runs the commands of clients against the state it keeps in memory,
+and saves it in the background and when it is stopped.
+
+'''
+import csv
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+import migrate
+from conftest import REPO_DIR
+
+# Run serve, with the delay before changed state is saved in the background
+SERVE_CODE = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import migrate
+migrate.SAVE_DELAY = float(sys.argv[3])
+migrate.setup_logging()
+migrate.main(migrate.parse_args(['serve', '--SOCKET=' + sys.argv[2]]))
+'''
+
+
+def write_csv(csvfile, rows):
+    with open(csvfile, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(rows)
+    return str(csvfile)
+
+
+def start_serve(tmp_path, save_delay):
+    # A Unix socket path is limited to about 100 characters
+    socket_file = os.path.join(tempfile.mkdtemp(), 'migrate.sock')
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVE_CODE, REPO_DIR, socket_file,
+         str(save_delay)], cwd=tmp_path, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_file):
+        assert process.poll() is None, 'serve exited'
+        assert time.monotonic() < deadline, 'serve did not start'
+        time.sleep(0.05)
+    return process, socket_file
+
+
+def stop_serve(process):
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(timeout=10) == 0
+
+
+@pytest.fixture
+def served(tmp_path, monkeypatch, estate):
+
+    '''
+    The estate as SQLite under tmp_path/switchports, and a serve started in
+    tmp_path that only saves changed state when it is stopped. Returns a
+    function running a command through it, returning its exit status and
+    output.
+    '''
+    confdir, confile = estate
+    migrate.convert_switchports('switchports.db', confdir, confile)
+    monkeypatch.chdir(tmp_path)
+    process, socket_file = start_serve(tmp_path, 3600)
+
+    def run(*argv):
+        stdout, stderr = sys.stdout, sys.stderr
+        with tempfile.TemporaryFile('w+') as out, \
+                tempfile.TemporaryFile('w+') as err:
+            sys.stdout, sys.stderr = out, err
+            try:
+                status = migrate.run_client(socket_file, list(argv))
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+            out.seek(0)
+            err.seek(0)
+            return status, out.read(), err.read()
+
+    run.process = process
+    yield run
+    if process.poll() is None:
+        stop_serve(process)
+
+
+def get_status(run, *switch_ids):
+    status, out, err = run('status', *switch_ids, '--CONFILE=switchports.db',
+                           '--FORMAT=json')
+    assert status == 0, err
+    return json.loads(out)['switches']
+
+
+def update_in_place(run, updatecsv):
+    return run('update', updatecsv, '--CONFILE=switchports.db',
+               '--UPDATEDIR=switchports', '--UPDATEFILE=switchports.db')
+
+
+UPDATE_ROWS = [['Description', 'From Switch', 'From Interface', 'To Switch',
+                'To Interface', 'Vlan'],
+               ['host-sw1-2', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1', '1297']]
+
+
+def test_move_and_status_round_trip(tmp_path, served):
+    assert get_status(served, 'sw1', 'sw3') == migrate.status_switchports(
+        'switchports', 'switchports.db', ['sw1', 'sw3'], 'json')['switches']
+    status, out, err = served('move', 'sw1', 'sw3', '--CONFILE=switchports.db')
+    assert status == 0, err
+    # Written in the directory of the client
+    with open(tmp_path / 'rundir' / 'runsheet.csv', newline='') as csv_file:
+        assert len(list(csv.reader(csv_file))) == 7
+    status, out, err = served('status', 'sw9', '--CONFILE=switchports.db')
+    assert status == 1
+    assert 'Unknown switch sw9' in err
+    status, out, err = served('serve')
+    assert status == 1
+    assert 'serve is already running' in err
+
+
+def test_update_in_place_goes_through_the_journal(tmp_path, served):
+    updatecsv = write_csv(tmp_path / 'update.csv', UPDATE_ROWS)
+    status, out, err = update_in_place(served, updatecsv)
+    assert status == 0, err
+    journal_file = migrate.get_journal_file('switchports', 'switchports.db')
+    with open(journal_file) as infile:
+        assert len(infile.readlines()) == 1
+    assert get_status(served, 'sw1')['sw1']['free'] == 7
+    # Seen by a command run on its own, which replays the journal
+    port = migrate.load_switchports('switchports',
+                                    'switchports.db')['sw3']['Gi1/0/1']
+    assert (port.status, port.description) == ('connected', 'host-sw1-2')
+    # The same run sheet again is refused, and changes nothing
+    status, out, err = update_in_place(served, updatecsv)
+    assert status == 1
+    assert 'source sw1:Gi1/0/2 is already disabled' in err
+    assert 'nothing was applied' in err
+    with open(journal_file) as infile:
+        assert len(infile.readlines()) == 1
+    assert get_status(served, 'sw1')['sw1']['free'] == 7
+
+
+def test_state_changed_on_disk_is_loaded_again(tmp_path, served):
+    assert get_status(served, 'sw1')['sw1']['off_final'] == 0
+    migrate.mark_switchports_final(write_csv(tmp_path / 'final.csv', [
+        ['switch', 'port', 'final'], ['sw1', 'Gi1/0/2', 'sw3']]),
+        'switchports', 'switchports.db')
+    assert get_status(served, 'sw1')['sw1']['off_final'] == 1
+
+
+def test_changed_state_is_saved_when_serve_stops(tmp_path, served):
+    finalcsv = write_csv(tmp_path / 'final.csv', [
+        ['switch', 'port', 'final'], ['sw1', 'Gi1/0/2', 'sw3']])
+    status, out, err = served('mark', finalcsv, '--CONFILE=switchports.db')
+    assert status == 0, err
+    assert get_status(served, 'sw1')['sw1']['off_final'] == 1
+    # Kept in memory, the save is still pending
+    assert migrate.load_switchports(
+        'switchports', 'switchports.db')['sw1']['Gi1/0/2'].final == ''
+    stop_serve(served.process)
+    assert migrate.load_switchports(
+        'switchports', 'switchports.db')['sw1']['Gi1/0/2'].final == 'sw3'
@@ -0,0 +1,96 @@
+'''
+simulate reports the moves move would plan for each scenario, without
+changing the state.
+
+'''
+import csv
+import json
+
+import pytest
+
+import migrate
+
+
+def write_scenarios(tmp_path, rows):
+    scenariocsv = tmp_path / 'scenarios.csv'
+    with open(scenariocsv, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(
+            [['name', 'source', 'destination', 'policy']] + rows)
+    return str(scenariocsv)
+
+
+def get_hosts(confdir, confile):
+    switchports_d = migrate.load_switchports(confdir, confile)
+    switchports_d.load_all()
+    return {(switch_id, port_id): (port.status, port.description)
+            for switch_id, switch_d in switchports_d.items()
+            for port_id, port in switch_d.items()}
+
+
+def test_simulate_reports_each_scenario(tmp_path, estate, capsys):
+    confdir, confile = estate
+    expected = get_hosts(confdir, confile)
+    result_l = migrate.simulate_switchports(write_scenarios(tmp_path, [
+        ['one', 'sw1', 'sw3', ''],
+        ['both', 'sw1,sw2', 'sw3,sw4', 'round-robin,vlan']]),
+        confdir, confile)
+    assert [(result_d['name'], result_d['policy'], result_d['source'],
+             result_d['destination']) for result_d in result_l] == [
+        ('one', 'most-free', ('sw1',), ('sw3',)),
+        ('both/round-robin', 'round-robin', ('sw1', 'sw2'), ('sw3', 'sw4')),
+        ('both/vlan', 'vlan', ('sw1', 'sw2'), ('sw3', 'sw4'))]
+    one_d = result_l[0]
+    assert (one_d['moves'], one_d['unplaced'], one_d['free'],
+            one_d['min_free'], one_d['off_final'], one_d['spread']) == \
+        (6, 0, 6, 6, 0, 0.0)
+    assert one_d['switches'] == {
+        'sw1': {'ports': 12, 'free': 12, 'critical': 0, 'off_final': 0},
+        'sw3': {'ports': 12, 'free': 6, 'critical': 6, 'off_final': 0}}
+    for result_d in result_l[1:]:
+        assert (result_d['moves'], result_d['unplaced'], result_d['free'],
+                result_d['min_free']) == (12, 0, 12, 6)
+    output = capsys.readouterr().out.splitlines()
+    assert output[0].split() == ['Scenario', 'Policy', 'Moves', 'Unplaced',
+                                 'Free', 'Min', 'free', 'Off', 'final',
+                                 'Spread']
+    assert output[1].split() == ['one', 'most-free', '6', '0', '6', '6', '0',
+                                 '0.0%']
+    # Neither the state on disk nor a later load sees the moves
+    assert get_hosts(confdir, confile) == expected
+
+
+def test_simulate_moves_what_move_plans(tmp_path, monkeypatch, estate,
+                                        capsys):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.move_interfaces('rundir', 'runsheet.csv', confdir, confile,
+                            'sw1,sw2', 'sw3', 'most-free')
+    with open(tmp_path / 'rundir' / 'runsheet.csv', newline='') as csv_file:
+        moves = len(list(csv.reader(csv_file))) - 1
+    capsys.readouterr()
+    result_l = migrate.simulate_switchports(write_scenarios(tmp_path, [
+        ['full', 'sw1,sw2', 'sw3', 'most-free']]), confdir, confile,
+        output_format='json')
+    assert json.loads(capsys.readouterr().out)[0]['moves'] == moves == 12
+    assert (result_l[0]['free'], result_l[0]['min_free']) == (0, 0)
+
+
+def test_all_policies_are_a_scenario_each(tmp_path, estate):
+    confdir, confile = estate
+    result_l = migrate.simulate_switchports(write_scenarios(tmp_path, [
+        ['spread', 'sw1', 'sw3,sw4', 'all']]), confdir, confile)
+    assert [result_d['policy'] for result_d in result_l] == \
+        sorted(migrate.ALLOCATION_POLICIES)
+    assert {result_d['moves'] for result_d in result_l} == {6}
+
+
+@pytest.mark.parametrize('row, message', [
+    (['bad', 'sw1', 'sw9', ''], 'Unknown switch sw9 in scenario bad'),
+    (['bad', 'sw1', 'sw3', 'fair'], 'Unknown allocation policy fair'),
+    (['bad', 'sw1', '', ''], 'Scenario bad of .* needs a source and a '
+                             'destination')])
+def test_bad_scenarios_are_refused(tmp_path, estate, row, message):
+    confdir, confile = estate
+    with pytest.raises(ValueError, match=message):
+        migrate.simulate_switchports(write_scenarios(tmp_path, [row]),
+                                     confdir, confile)
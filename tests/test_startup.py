@@ -0,0 +1,78 @@
+'''
+The modules migrate.py imports to start, and the per-command usage it is
+parsed with. The startup time itself depends on the machine, and is checked
+by benchmark.py startup.
+
+'''
+import csv
+import subprocess
+import sys
+
+import pytest
+from docopt import docopt
+
+import migrate
+
+# Run migrate.py as a script, and write the modules it imported when it exits
+IMPORTED_CODE = '''
+import atexit, runpy, sys
+modules_file, script = sys.argv[1:3]
+atexit.register(lambda: open(modules_file, 'w').write('\\n'.join(sys.modules)))
+sys.argv = sys.argv[2:]
+runpy.run_path(script, run_name='__main__')
+'''
+
+# Modules none of the commands timed by benchmark.py startup need
+SLOW_MODULES = ('yaml', 'pprint', 'logging.config', 'asyncio',
+                'concurrent.futures', 'tracemalloc', 'cProfile')
+
+
+def get_imported(tmp_path, argv):
+    modules_file = tmp_path / 'modules.txt'
+    subprocess.run([sys.executable, '-c', IMPORTED_CODE, str(modules_file),
+                    migrate.__file__] + argv, cwd=tmp_path,
+                   capture_output=True, check=True)
+    with open(modules_file) as infile:
+        return set(infile.read().split('\n'))
+
+
+def test_help_imports_neither_docopt_nor_slow_modules(tmp_path):
+    imported = get_imported(tmp_path, ['--help'])
+    assert 'docopt' not in imported
+    assert [module for module in SLOW_MODULES if module in imported] == []
+
+
+def test_status_on_sqlite_imports_no_slow_modules(tmp_path):
+    initcsv = tmp_path / 'init.csv'
+    with open(initcsv, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows([
+            ['switch_id', 'port', 'status', 'vlan', 'description'],
+            ['sw1', 'Gi1/0/1', 'connected', '1296', 'host-1'],
+            ['sw1', 'Gi1/0/2', 'disabled', '', 'disabled']])
+    migrate.get_switchports_d(str(initcsv), str(tmp_path / 'switchports'),
+                              'switchports.db')
+    imported = get_imported(tmp_path, ['status', '--CONFILE=switchports.db'])
+    assert {'docopt', 'sqlite3'} <= imported
+    assert [module for module in SLOW_MODULES if module in imported] == []
+
+
+@pytest.mark.parametrize('argv', [
+    ['status'],
+    ['status', 'sw1', 'sw2', '--FORMAT=json'],
+    ['move', 'sw1,sw2', 'sw3,sw4', '--POLICY=vlan', '--PROFILE'],
+    ['apply', 'runsheet.csv', 'devices.csv', '--DRYRUN', '--RETRIES=0'],
+    ['diff', '--ASOF=3'],
+    ['serve'],
+    ])
+def test_command_usage_parses_as_the_full_usage(argv):
+    docopt_args = migrate.parse_args(argv)
+    full_args = docopt(migrate.__doc__, argv)
+    # Options of the other commands are left out, but every command is set
+    assert docopt_args == {key: full_args[key] for key in docopt_args}
+    assert set(migrate.get_command_usage()) <= set(docopt_args)
+
+
+def test_help_prints_the_full_usage():
+    process = subprocess.run([sys.executable, migrate.__file__, '--help'],
+                             capture_output=True, text=True, check=True)
+    assert process.stdout == migrate.__doc__.strip('\n') + '\n'
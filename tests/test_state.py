@@ -0,0 +1,196 @@
+'''
+State backends load back what they saved, and the move journal.
+
+'''
+import csv
+import json
+import os
+
+import pytest
+
+import migrate
+
+BACKENDS = ('switchports.yaml', 'switchports.db', 'switchports.json',
+            'switchports.shards')
+
+
+def get_state(switchports_d):
+
+    '''
+    Return the ports and the free port index of switchports_d, to compare
+    inventories.
+    '''
+    switchports_d.load_all()
+    ports_d = {(switch_id, port_id): tuple(
+        getattr(port, field) for field in migrate.SWITCHPORT_FIELDS)
+        for switch_id, switch_d in switchports_d.items()
+        for port_id, port in switch_d.items()}
+    return ports_d, switchports_d.reindex().to_dict()
+
+
+@pytest.fixture
+def marked(estate):
+
+    '''
+    The estate, with hosts marked with a final switch and a description
+    that needs quoting, saved as YAML.
+    '''
+    confdir, confile = estate
+    switchports_d = migrate.load_switchports(confdir, confile)
+    switchports_d['sw1']['Gi1/0/2'].final = 'sw3'
+    switchports_d['sw2']['Gi1/0/4'].final = 'sw4'
+    switchports_d['sw2']['Gi1/0/6'].description = 'db "1", café: x'
+    migrate.dump_switchports(switchports_d, confdir, confile)
+    return confdir, confile
+
+
+@pytest.mark.parametrize('newconfile', BACKENDS)
+def test_backend_round_trip_gives_the_same_inventory(marked, newconfile):
+    confdir, confile = marked
+    expected = get_state(migrate.load_switchports(confdir, confile))
+    migrate.convert_switchports(newconfile, confdir, confile)
+    switchports_d = migrate.load_switchports(confdir, newconfile)
+    assert get_state(switchports_d) == expected
+    assert switchports_d['sw2']['Gi1/0/6'].description == \
+        'db "1", café: x'
+    # Saved again by the backend itself
+    migrate.dump_switchports(switchports_d, confdir, 'again' + newconfile)
+    assert get_state(migrate.load_switchports(
+        confdir, 'again' + newconfile)) == expected
+
+
+def test_unknown_extension_is_refused():
+    with pytest.raises(ValueError, match='No state backend for state.txt'):
+        migrate.get_state_backend('state.txt')
+
+
+def write_update(tmp_path, name, moves):
+
+    '''
+    Write an update CSV of moves, (from switch, from port, to switch, to
+    port), of hosts in vlan 1297.
+    '''
+    updatecsv = tmp_path / name
+    with open(updatecsv, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Description', 'From Switch', 'From Interface',
+                         'To Switch', 'To Interface', 'Vlan'])
+        for from_switch, from_port, to_switch, to_port in moves:
+            writer.writerow(['host-%s-%s' % (from_switch,
+                                             from_port.split('/')[-1]),
+                             from_switch, from_port, to_switch, to_port,
+                             '1297'])
+    return str(updatecsv)
+
+
+def update_in_place(tmp_path, confdir, confile, name, moves):
+    # update writes under the working directory, tmp_path
+    confdir = os.path.relpath(confdir, tmp_path)
+    migrate.update_switchports(write_update(tmp_path, name, moves), confdir,
+                               confile, confdir, confile)
+
+
+def get_host(switchports_d, switch_id, port_id):
+    port = switchports_d[switch_id][port_id]
+    return port.status, port.description
+
+
+@pytest.fixture
+def journaled(tmp_path, monkeypatch, estate):
+
+    '''
+    The estate as SQLite, with two updates journaled in place: entry 1
+    moves host-sw1-2 to sw3, entry 2 host-sw1-6 to sw3.
+    '''
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.convert_switchports('switchports.db', confdir, confile)
+    update_in_place(tmp_path, confdir, 'switchports.db', 'update1.csv',
+                    [('sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1')])
+    update_in_place(tmp_path, confdir, 'switchports.db', 'update2.csv',
+                    [('sw1', 'Gi1/0/6', 'sw3', 'Gi1/0/3')])
+    return confdir, 'switchports.db'
+
+
+def test_journal_is_replayed_on_load(journaled):
+    confdir, confile = journaled
+    journal_file = migrate.get_journal_file(confdir, confile)
+    with open(journal_file) as infile:
+        assert len(infile.readlines()) == 2
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert switchports_d.journal_seq == 2
+    assert get_host(switchports_d, 'sw3', 'Gi1/0/1') == \
+        ('connected', 'host-sw1-2')
+    assert get_host(switchports_d, 'sw3', 'Gi1/0/3') == \
+        ('connected', 'host-sw1-6')
+    assert get_host(switchports_d, 'sw1', 'Gi1/0/2') == ('disabled', '')
+    assert 'Gi1/0/2' in switchports_d.reindex().ports('sw1')
+
+
+def test_as_of_replays_the_journal_up_to_an_entry(journaled):
+    confdir, confile = journaled
+    switchports_d = migrate.load_switchports(confdir, confile, as_of=1)
+    assert switchports_d.journal_seq == 1
+    assert get_host(switchports_d, 'sw3', 'Gi1/0/1') == \
+        ('connected', 'host-sw1-2')
+    assert get_host(switchports_d, 'sw1', 'Gi1/0/6') == \
+        ('connected', 'host-sw1-6')
+    migrate.convert_switchports('asof.json', confdir, confile, as_of=0)
+    assert get_state(migrate.load_switchports(confdir, 'asof.json')) == \
+        get_state(migrate.load_switchports(confdir, confile, as_of=0))
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path,
+                                                        monkeypatch,
+                                                        journaled):
+    confdir, confile = journaled
+    monkeypatch.setattr(migrate, 'COMPACT_ENTRIES', 2)
+    journal_file = migrate.get_journal_file(confdir, confile)
+    # Entry 3 takes the journal over COMPACT_ENTRIES
+    update_in_place(tmp_path, confdir, confile, 'update3.csv',
+                    [('sw2', 'Gi1/0/2', 'sw4', 'Gi1/0/1')])
+    assert not os.path.exists(journal_file)
+    switchports_d = migrate.load_switchports(confdir, confile)
+    assert (switchports_d.journal_seq, switchports_d.journal_base) == (3, 3)
+    assert get_host(switchports_d, 'sw4', 'Gi1/0/1') == \
+        ('connected', 'host-sw2-2')
+    # The entries folded in can not be replayed any more
+    with pytest.raises(ValueError, match='Journal entry 2 is older'):
+        migrate.load_switchports(confdir, confile, as_of=2)
+    # New entries go to a new journal, numbered on
+    update_in_place(tmp_path, confdir, confile, 'update4.csv',
+                    [('sw2', 'Gi1/0/4', 'sw4', 'Gi1/0/3')])
+    with open(journal_file) as infile:
+        assert [json.loads(line)['seq'] for line in infile] == [4]
+    assert get_host(migrate.load_switchports(confdir, confile, as_of=3),
+                    'sw4', 'Gi1/0/3') == ('disabled', 'disabled')
+    assert get_host(migrate.load_switchports(confdir, confile),
+                    'sw4', 'Gi1/0/3') == ('connected', 'host-sw2-4')
+
+
+def get_inodes(directory):
+    return {name: os.stat(os.path.join(directory, name)).st_ino
+            for name in os.listdir(directory)}
+
+
+def test_single_switch_update_rewrites_only_its_shard(tmp_path, monkeypatch,
+                                                      estate):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.convert_switchports('switchports.shards', confdir, confile)
+    shards_dir = os.path.join(confdir, 'switchports.shards')
+    before_d = get_inodes(shards_dir)
+    assert sorted(before_d) == ['manifest.json', 'sw1.json', 'sw2.json',
+                                'sw3.json', 'sw4.json']
+    # Compact on the first entry, so the update saves the shards
+    monkeypatch.setattr(migrate, 'COMPACT_ENTRIES', 0)
+    update_in_place(tmp_path, confdir, 'switchports.shards', 'update.csv',
+                    [('sw1', 'Gi1/0/2', 'sw1', 'Gi1/0/1')])
+    after_d = get_inodes(shards_dir)
+    assert sorted(name for name in after_d
+                  if after_d[name] != before_d.get(name)) == \
+        ['manifest.json', 'sw1.json']
+    switchports_d = migrate.load_switchports(confdir, 'switchports.shards')
+    assert get_host(switchports_d, 'sw1', 'Gi1/0/1') == \
+        ('connected', 'host-sw1-2')
+    assert switchports_d.journal_seq == 1
@@ -0,0 +1,65 @@
+'''
+status reports from the aggregates kept with the state, which stay the
+same as counting the ports again through mark and update.
+
+'''
+import csv
+import os
+
+import pytest
+
+import migrate
+
+
+def write_csv(csvfile, rows):
+    with open(csvfile, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(rows)
+    return str(csvfile)
+
+
+def assert_aggregates_counted(confdir, confile):
+    switchports_d = migrate.load_switchports(confdir, confile)
+    kept = switchports_d.get_aggregates().to_dict()
+    switchports_d.load_all()
+    assert kept == migrate.Aggregates.from_switchports(switchports_d).to_dict()
+
+
+@pytest.mark.parametrize('newconfile', ['switchports.db',
+                                        'switchports.shards'])
+def test_aggregates_stay_counted_through_mark_and_update(
+        tmp_path, monkeypatch, estate, newconfile, capsys):
+    confdir, confile = estate
+    monkeypatch.chdir(tmp_path)
+    migrate.convert_switchports(newconfile, confdir, confile)
+    confdir = os.path.relpath(confdir, tmp_path)
+    migrate.mark_switchports_final(write_csv(tmp_path / 'final.csv', [
+        ['switch', 'port', 'final'], ['sw1', 'Gi1/0/2', 'sw3'],
+        ['sw1', 'Gi1/0/4', 'sw3'], ['sw2', 'Gi1/0/2', 'sw4']]),
+        confdir, newconfile)
+    assert_aggregates_counted(confdir, newconfile)
+    # Journaled in place, and replayed on load
+    migrate.update_switchports(write_csv(tmp_path / 'update.csv', [
+        ['Description', 'From Switch', 'From Interface', 'To Switch',
+         'To Interface', 'Vlan'],
+        ['host-sw1-2', 'sw1', 'Gi1/0/2', 'sw3', 'Gi1/0/1', '1297'],
+        ['host-sw1-4', 'sw1', 'Gi1/0/4', 'sw3', 'Gi1/0/2', '1296']]),
+        confdir, newconfile, confdir, newconfile)
+    assert_aggregates_counted(confdir, newconfile)
+    capsys.readouterr()
+    status_d = migrate.status_switchports(confdir, newconfile,
+                                          ['sw1', 'sw2', 'sw3'], 'json')
+    assert status_d['switches'] == {
+        'sw1': {'ports': 12, 'free': 8, 'critical': 4, 'off_final': 0,
+                'critical_vlans': {'1296': 2, '1297': 2}},
+        'sw2': {'ports': 12, 'free': 6, 'critical': 6, 'off_final': 1,
+                'critical_vlans': {'1296': 3, '1297': 3}},
+        'sw3': {'ports': 12, 'free': 10, 'critical': 2, 'off_final': 0,
+                'critical_vlans': {'1296': 1, '1297': 1}}}
+    assert status_d['totals'] == {'ports': 36, 'free': 24, 'critical': 12,
+                                  'off_final': 1}
+
+
+def test_status_refuses_an_unknown_switch(estate):
+    confdir, confile = estate
+    with pytest.raises(ValueError, match='Unknown switch sw9'):
+        migrate.status_switchports(confdir, confile, ['sw9'])
@@ -0,0 +1,78 @@
+'''
+SwitchPort keeps its attributes and YAML format, with its strings interned
+and no attributes other than its fields.
+
+'''
+import sys
+
+import pytest
+
+import migrate
+
+# A state file as written by yaml.dump of the original SwitchPort objects
+ORIGINAL_YAML = '''\
+sw1:
+  Gi1/0/1: !!python/object:__main__.SwitchPort
+    configuration: ''
+    description: host-1
+    final: sw3
+    port_id: Gi1/0/1
+    status: connected
+    switch_id: sw1
+    vlan: '1296'
+  Gi1/0/2: !!python/object:__main__.SwitchPort
+    configuration: ''
+    description: disabled
+    final: ''
+    port_id: Gi1/0/2
+    status: disabled
+    switch_id: sw1
+    vlan: ''
+'''
+
+
+def get_fields(port):
+    return {field: getattr(port, field) for field in migrate.SWITCHPORT_FIELDS}
+
+
+def test_attributes_are_the_fields():
+    port = migrate.SwitchPort('sw1', 'GigabitEthernet1/0/1', 'connected',
+                              '1296', 'host-1', final='sw3')
+    assert get_fields(port) == {
+        'switch_id': 'sw1', 'port_id': 'Gi1/0/1', 'status': 'connected',
+        'vlan': '1296', 'description': 'host-1', 'configuration': '',
+        'final': 'sw3'}
+    port.description = 'host-2'
+    assert port.description == 'host-2'
+    with pytest.raises(AttributeError):
+        port.owner = 'team'
+    assert not hasattr(port, '__dict__')
+
+
+def test_repeated_values_are_interned():
+    # Built at run time, so the literals are not shared
+    values = [''.join(value) for value in (['s', 'w1'], ['Gi1/0/', '1'],
+                                           ['conn', 'ected'], ['12', '96'],
+                                           ['sw', '3'])]
+    port = migrate.SwitchPort(values[0], values[1], values[2], values[3],
+                              'host-1', final=values[4])
+    for field, value in (('switch_id', 'sw1'), ('port_id', 'Gi1/0/1'),
+                         ('status', 'connected'), ('vlan', '1296'),
+                         ('final', 'sw3')):
+        assert getattr(port, field) is sys.intern(value)
+
+
+def test_original_yaml_loads_and_is_written_back_the_same(tmp_path):
+    (tmp_path / 'original.yaml').write_text(ORIGINAL_YAML)
+    switchports_d = migrate.load_switchports(str(tmp_path), 'original.yaml')
+    assert get_fields(switchports_d['sw1']['Gi1/0/1']) == {
+        'switch_id': 'sw1', 'port_id': 'Gi1/0/1', 'status': 'connected',
+        'vlan': '1296', 'description': 'host-1', 'configuration': '',
+        'final': 'sw3'}
+    assert switchports_d['sw1']['Gi1/0/2'].status == 'disabled'
+    migrate.dump_switchports(switchports_d, str(tmp_path), 'again.yaml')
+    written = (tmp_path / 'again.yaml').read_text()
+    for line in ORIGINAL_YAML.splitlines():
+        assert line in written
+    switchports_d = migrate.load_switchports(str(tmp_path), 'again.yaml')
+    assert switchports_d['sw1']['Gi1/0/1'].final == 'sw3'
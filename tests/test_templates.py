@@ -0,0 +1,46 @@
+'''
+Port templates render as str.format would.
+
+'''
+import pytest
+
+import migrate
+
+FIELDS_D = {'old_switch': 'sw1', 'old_port': 'Gi1/0/1', 'new_switch': 'sw3',
+            'new_port': 'Gi1/0/2', 'vlan': '1296', 'description': 'host-1'}
+
+
+@pytest.mark.parametrize('text', [
+    migrate.DEFAULT_ENABLE_TEMPLATE,
+    migrate.DEFAULT_DISABLE_TEMPLATE,
+    '',
+    'no fields',
+    '{{not a field}} {vlan}{vlan}',
+    '{description:>12}|{new_port!s:<8}|{vlan!r}',
+    '{description:{vlan}}',
+    ])
+def test_render_matches_format(text):
+    assert migrate.PortTemplate('test.enable', text).render(**FIELDS_D) == \
+        text.format(**FIELDS_D)
+
+
+def test_render_formats_values_that_are_not_strings():
+    template = migrate.PortTemplate('test.enable', '{vlan} {description}')
+    assert template.render(**dict(FIELDS_D, vlan=None, description=5)) == \
+        'None 5'
+
+
+@pytest.mark.parametrize('text', ['{host}', '{0}', '{}'])
+def test_unknown_fields_are_refused(text):
+    with pytest.raises(ValueError, match='Unknown field'):
+        migrate.PortTemplate('test.enable', text)
+
+
+def test_default_profile_functions_render_the_default_templates():
+    values = [FIELDS_D[field] for field in ('old_switch', 'old_port',
+                                            'new_switch', 'new_port', 'vlan',
+                                            'description')]
+    assert migrate.get_enable_port(*values) == \
+        migrate.DEFAULT_ENABLE_TEMPLATE.format(**FIELDS_D)
+    assert migrate.get_disable_port(*values) == \
+        migrate.DEFAULT_DISABLE_TEMPLATE.format(**FIELDS_D)